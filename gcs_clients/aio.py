@@ -0,0 +1,296 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Asyncio cache clients, using a shared aiohttp connection pool.  Requires
+the optional aiohttp dependency (pip install uw-gcs-clients[async]).
+"""
+
+import aiohttp
+import asyncio
+import json
+import logging
+import google.auth
+from commonconf import settings
+from datetime import datetime, timezone
+from gcs_clients.base import is_fresh
+from gcs_clients.codec import decompress
+from gcs_clients.restclient import RestclientCachePolicy
+from google.api_core.datetime_helpers import from_rfc3339
+from google.api_core.exceptions import (
+    GoogleAPIError, NotFound, PreconditionFailed, from_http_status)
+from google.auth.transport.requests import Request
+from urllib.parse import quote, urlencode
+from yarl import URL
+
+API_ENDPOINT = "https://storage.googleapis.com"
+SCOPES = ("https://www.googleapis.com/auth/devstorage.read_write",)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class AsyncGCSClient():
+    """
+    A settings-based wrapper around AsyncGCSBucketClient.  All coroutines
+    running on the event loop share the same cache client.
+    """
+
+    def __init__(self):
+        self._client = None
+
+    def __getattr__(self, name, *args, **kwargs):
+        """
+        Pass unshimmed method calls through to the client, and add logging
+        for errors.
+        """
+        async def handler(*args, **kwargs):
+            try:
+                return await getattr(self.client, name)(*args, **kwargs)
+            except (GoogleAPIError, aiohttp.ClientError,
+                    asyncio.TimeoutError) as ex:
+                logging.error("gcp {}: {}".format(name, ex))
+            except AttributeError:
+                raise
+        return handler
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.__client__()
+        return self._client
+
+    def __client__(self):
+        """
+        Create a new client object instance with settings mapped from
+        environment settings
+        """
+        return AsyncGCSBucketClient(
+            getattr(settings, "GCS_BUCKET_NAME", None),
+            timeout=getattr(settings, "GCS_TIMEOUT", 5),
+            num_retries=getattr(settings, "GCS_NUM_RETRIES", 3),
+            pool_maxsize=getattr(settings, "GCS_POOL_MAXSIZE", 10))
+
+
+class AsyncGCSBucketClient():
+    """
+    Cloud storage bucket upload/download using the GCS JSON API over aiohttp
+    """
+
+    def __init__(self, bucket_name, timeout=5, num_retries=3, pool_maxsize=10,
+                 credentials=None, api_endpoint=API_ENDPOINT):
+        """
+        :param bucket_name: Name of the bucket to read/write from
+        :type bucket_name: str
+        :param timeout: Request timeout in seconds, defaults to 5
+        :type timeout: int (optional)
+        :param num_retries: Number of request retries, defaults to 3
+        :type num_retries: int (optional)
+        :param pool_maxsize: Maximum number of pooled connections, defaults
+            to 10
+        :type pool_maxsize: int (optional)
+        :param credentials: Credentials used to authorize requests, defaults
+            to the application default credentials
+        :type credentials: google.auth.credentials.Credentials (optional)
+        :param api_endpoint: GCS API endpoint, defaults to API_ENDPOINT
+        :type api_endpoint: str (optional)
+        """
+        self.bucket_name = bucket_name
+        self.timeout = timeout
+        self.num_retries = num_retries
+        self.pool_maxsize = pool_maxsize
+        self.credentials = credentials
+        self.api_endpoint = api_endpoint.rstrip("/")
+        self._session = None
+        self._credentials_lock = None
+
+    @property
+    def session(self):
+        """
+        Retreive the aiohttp session and its connection pool
+        """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_maxsize),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                auto_decompress=False)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _authorize(self, headers):
+        if self._credentials_lock is None:
+            self._credentials_lock = asyncio.Lock()
+        async with self._credentials_lock:
+            loop = asyncio.get_event_loop()
+            if self.credentials is None:
+                self.credentials, _ = await loop.run_in_executor(
+                    None, lambda: google.auth.default(scopes=SCOPES))
+            if not self.credentials.valid:
+                await loop.run_in_executor(
+                    None, self.credentials.refresh, Request())
+        self.credentials.apply(headers)
+        return headers
+
+    def _object_url(self, url_key, prefix="", **params):
+        url = "{}{}/storage/v1/b/{}/o/{}".format(
+            self.api_endpoint, prefix, quote(self.bucket_name, safe=""),
+            quote(url_key, safe=""))
+        if params:
+            url = "{}?{}".format(url, urlencode(params))
+        return URL(url, encoded=True)
+
+    async def _request(self, method, url, retries=0, **kwargs):
+        """
+        Make an API request, returning a tuple of (status, headers, body).
+        Error responses other than 304 raise a GoogleAPIError.
+        """
+        request_headers = kwargs.pop("headers", {})
+        attempt = 0
+        while True:
+            headers = await self._authorize(dict(request_headers))
+            async with self.session.request(
+                    method, url, headers=headers, **kwargs) as response:
+                body = await response.read()
+                if response.status < 400 or (
+                        response.status not in RETRY_STATUSES or
+                        attempt >= retries):
+                    break
+            attempt += 1
+            await asyncio.sleep(min(2 ** attempt, 32))
+
+        if response.status >= 400:
+            try:
+                message = json.loads(body)["error"]["message"]
+            except (ValueError, KeyError, TypeError):
+                message = body.decode("utf-8", "replace")
+            raise from_http_status(response.status, message)
+        return response.status, response.headers, body
+
+    async def delete(self, url_key):
+        """
+        Delete content matching url_key from GCS bucket
+
+        :param url_key: URL response to cache
+        :type url_key: str
+        """
+        try:
+            await self._request("DELETE", self._object_url(url_key))
+        except NotFound as ex:
+            logging.error("gcp {}: {}".format(url_key, ex))
+            raise
+
+    async def get(self, url_key, expire=0):
+        """
+        Download content from a GCS bucket as bytes, or None if the content
+        is missing or expired
+
+        :param url_key: URL response to cache
+        :type url_key: str
+        :param expire: Number of seconds until the item is expired from the
+            cache, or 0 for no expiry (the default).
+        :type expire: int (optional, default 0)
+        """
+        try:
+            _, headers, content = await self._request(
+                "GET", self._object_url(url_key, prefix="/download",
+                                        alt="media"))
+            content = decompress(content, headers.get("Content-Encoding"))
+            creation_time = self._parse_time(
+                headers.get("X-Goog-Custom-Time"))
+            if creation_time is None:
+                # Custom time wasn't returned with the content, fetch the
+                # metadata for the downloaded generation
+                _, _, body = await self._request(
+                    "GET", self._object_url(
+                        url_key,
+                        ifGenerationMatch=headers.get("X-Goog-Generation")))
+                creation_time = self._parse_time(
+                    json.loads(body).get("customTime"))
+        except (NotFound, PreconditionFailed):
+            return None
+        if creation_time:
+            if is_fresh(creation_time, expire):
+                return content
+            else:
+                return None  # expired content
+
+    async def set(self, url_key, content, expire=0):
+        """
+        Upload a string, bytes or file-like object contents to GCS bucket
+
+        :param url_key: URL response to cache
+        :type url_key: str
+        :param content: Content to cache
+        :type content: str, bytes or file object
+        :param expire: If None, don't update the cache otherwise upload to the
+            cache, the default
+        :type expire: int or None (optional, default update)
+        """
+        if expire is not None:
+            if hasattr(content, "read"):
+                content = content.read()
+            if isinstance(content, bytes):
+                content_type = "application/octet-stream"
+            else:
+                content = str(content).encode("utf-8")
+                content_type = "text/plain"
+            metadata = {
+                "name": url_key,
+                "customTime": datetime.now(timezone.utc).strftime(
+                    "%Y-%m-%dT%H:%M:%S.%fZ"),
+            }
+            with aiohttp.MultipartWriter("related") as body:
+                body.append_json(metadata)
+                body.append(content, {"Content-Type": content_type})
+            url = URL("{}/upload/storage/v1/b/{}/o?{}".format(
+                self.api_endpoint, quote(self.bucket_name, safe=""),
+                urlencode({"uploadType": "multipart"})), encoded=True)
+            await self._request("POST", url, retries=self.num_retries,
+                                data=body)
+
+    @staticmethod
+    def _parse_time(value):
+        if value:
+            try:
+                return from_rfc3339(value)
+            except ValueError:
+                return None
+
+
+class AsyncRestclientGCSClient(RestclientCachePolicy, AsyncGCSClient):
+
+    async def getCache(self, service, url, headers=None):
+        expire = self.get_cache_expiration_time(service, url)
+        if expire is not None:
+            for key in self._create_read_keys(service, url):
+                data = await self.get(key, expire=expire)
+                if data:
+                    return self._parse_data(data)
+
+    async def deleteCache(self, service, url):
+        keys = self._create_read_keys(service, url)
+        for key in keys[1:]:
+            # Remove any legacy copy, which may not exist
+            try:
+                await self.client.delete(key)
+            except (GoogleAPIError, aiohttp.ClientError,
+                    asyncio.TimeoutError):
+                pass
+        return await self.delete(keys[0])
+
+    async def updateCache(self, service, url, response):
+        expire = self.get_cache_expiration_time(service, url, response.status)
+        if expire is not None:
+            key = self._create_key(service, url,
+                                   base_path=self.get_base_path())
+            data = self._format_data(response)
+            try:
+                # Bypass the shim client to log the original URL if needed.
+                await self.client.set(key, data, expire=expire)
+            except (GoogleAPIError, aiohttp.ClientError,
+                    asyncio.TimeoutError) as ex:
+                logging.error("gcs set: {}, url: {}".format(ex, url))
+
+    processResponse = updateCache
@@ -1,16 +1,157 @@
 # Copyright 2021 UW-IT, University of Washington
 # SPDX-License-Identifier: Apache-2.0
 
+import base64
+import google_crc32c
+import hashlib
 import logging
+import os
 import socket
+import time
 
 from commonconf import settings
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from functools import wraps
+from gcs_clients.breaker import CircuitBreaker, CircuitOpenError
+from gcs_clients.cache import (
+    DiskCache, MemoryCache, NegativeCache, SingleFlight)
+from gcs_clients.codec import CODECS, compress, decompress
+from gcs_clients.metrics import PrometheusMetrics
+from gcs_clients.policy import ReadPolicy
+from gcs_clients.stream import CacheStream
+from gcs_clients.writer import WriteBehindQueue
 from google.cloud import storage
-from google.api_core.exceptions import GoogleAPIError
+from google.cloud.storage.batch import Batch
+from google.api_core.exceptions import (
+    ClientError, GoogleAPIError, PreconditionFailed,
+    RequestRangeNotSatisfiable, TooManyRequests, from_http_response)
+from google.auth.exceptions import GoogleAuthError, TransportError
 from google.cloud.exceptions import NotFound
+from google.cloud.storage.retry import DEFAULT_RETRY
+from google.resumable_media import DataCorruption
 from io import IOBase
-from threading import local
+from requests import ConnectionError as RequestsConnectionError
+from requests import RequestException, Timeout
+from requests.adapters import HTTPAdapter
+from threading import local, RLock
+from uuid import uuid4
+from urllib3.connection import HTTPConnection
+
+
+def _crc32c(content):
+    return base64.b64encode(
+        google_crc32c.Checksum(content).digest()).decode("utf-8")
+
+
+def timed(operation):
+    """
+    Decorate a GCSBucketClient method to observe its latency and errors
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            if self.metrics is None:
+                return fn(self, *args, **kwargs)
+            with self.metrics.timer("gcs_operation", operation=operation):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def is_outage(ex):
+    """
+    Whether an error indicates that GCS is unavailable, rather than a
+    problem with the request or a bug in the caller
+    """
+    if isinstance(ex, ClientError):
+        return isinstance(ex, TooManyRequests)
+    return isinstance(ex, (
+        GoogleAPIError, TransportError, RequestsConnectionError, Timeout,
+        ConnectionError, TimeoutError, socket.gaierror))
+
+
+def is_fresh(custom_time, expire):
+    """
+    Whether content written at custom_time is still valid for an expiry of
+    expire seconds, where 0 means no expiry.
+    """
+    creation_time = custom_time.replace(tzinfo=timezone.utc)
+    time_since_creation = \
+        (datetime.now(timezone.utc) - creation_time).total_seconds()
+    return round(time_since_creation, 2) <= expire or expire == 0
+
+
+class CacheBlob(storage.Blob):
+    """
+    A storage.Blob that also reads the object's custom time from the headers
+    of a media download, so that content and expiry can be fetched with a
+    single request.
+    """
+
+    def _extract_headers_from_download(self, response):
+        super()._extract_headers_from_download(response)
+        self._properties["customTime"] = response.headers.get(
+            "X-Goog-Custom-Time", None)
+        self._properties["size"] = response.headers.get(
+            "X-Goog-Stored-Content-Length", None)
+
+    @property
+    def custom_time(self):
+        try:
+            return super().custom_time
+        except ValueError:
+            return None
+
+    @custom_time.setter
+    def custom_time(self, value):
+        storage.Blob.custom_time.fset(self, value)
+
+
+class ResponseBatch(Batch):
+    """
+    A storage Batch that keeps the response of every deferred request,
+    rather than raising an error for the first failed request.
+    """
+
+    def _finish_futures(self, responses):
+        self.responses = responses
+
+
+class PoolAdapter(HTTPAdapter):
+    """
+    A requests HTTPAdapter with optional TCP keep-alive, exposing
+    connection pool statistics.
+    """
+
+    def __init__(self, tcp_keepalive=False, **kwargs):
+        self.tcp_keepalive = tcp_keepalive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.tcp_keepalive:
+            kwargs["socket_options"] = \
+                HTTPConnection.default_socket_options + [
+                    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super().init_poolmanager(*args, **kwargs)
+
+    def stats(self):
+        """
+        Return a dict of connection pool counts, summed over hosts
+        """
+        stats = {"pools": 0, "maxsize": self._pool_maxsize, "connections": 0,
+                 "idle": 0, "requests": 0}
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats["pools"] += 1
+            stats["connections"] += pool.num_connections
+            stats["requests"] += pool.num_requests
+            stats["idle"] += sum(
+                1 for conn in list(pool.pool.queue) if conn is not None)
+        return stats
 
 
 class GCSClient():
@@ -21,6 +162,19 @@ class GCSClient():
 
     def __init__(self):
         self._local = local()
+        self._lock = RLock()
+        self._shared_client = None
+        self._memory_cache = None
+        self._negative_cache = None
+        self._disk_cache = None
+        self._single_flight = None
+        self._write_behind = None
+        self._executor = None
+        self._transfer_executor = None
+        self._circuit_breaker = None
+        self._read_policy = None
+        self._metrics = None
+        self._configured = set()
 
     def __getattr__(self, name, *args, **kwargs):
         """
@@ -29,7 +183,10 @@ class GCSClient():
         """
         def handler(*args, **kwargs):
             try:
-                return getattr(self.client, name)(*args, **kwargs)
+                return self._guarded(
+                    getattr(self.client, name), *args, **kwargs)
+            except CircuitOpenError:
+                return None
             except (GoogleAPIError, socket.gaierror) as ex:
                 logging.error("gcp {}: {}".format(name, ex))
             except AttributeError:
@@ -38,10 +195,222 @@ class GCSClient():
 
     @property
     def client(self):
+        if getattr(settings, "GCS_SHARED_CLIENT", False):
+            if self._shared_client is None:
+                with self._lock:
+                    if self._shared_client is None:
+                        self._shared_client = self.__client__()
+            return self._shared_client
         if not hasattr(self._local, "client"):
             self._local.client = self.__client__()
         return self._local.client
 
+    @property
+    def memory_cache(self):
+        """
+        The in-memory cache shared by all threads, or None if disabled
+        """
+        with self._lock:
+            if self._memory_cache is None:
+                max_entries = getattr(settings, "GCS_MEMORY_CACHE_ENTRIES", 0)
+                if max_entries:
+                    self._memory_cache = MemoryCache(
+                        max_entries=max_entries,
+                        max_bytes=getattr(
+                            settings, "GCS_MEMORY_CACHE_BYTES",
+                            64 * 1024 * 1024),
+                        ttl=getattr(settings, "GCS_MEMORY_CACHE_TTL", 60))
+            return self._memory_cache
+
+    @property
+    def disk_cache(self):
+        """
+        The local disk cache shared by all threads, and by other processes
+        using the same directory, or None if disabled
+        """
+        with self._lock:
+            if self._disk_cache is None:
+                path = getattr(settings, "GCS_DISK_CACHE_DIR", None)
+                if path:
+                    self._disk_cache = DiskCache(path, max_bytes=getattr(
+                        settings, "GCS_DISK_CACHE_BYTES", 1024 * 1024 * 1024))
+            return self._disk_cache
+
+    @property
+    def negative_cache(self):
+        """
+        The cache of absent keys shared by all threads, or None if disabled
+        """
+        with self._lock:
+            if self._negative_cache is None:
+                ttl = getattr(settings, "GCS_NEGATIVE_CACHE_TTL", 0)
+                if ttl:
+                    self._negative_cache = NegativeCache(
+                        ttl=ttl, max_entries=getattr(
+                            settings, "GCS_NEGATIVE_CACHE_ENTRIES", 10000))
+            return self._negative_cache
+
+    @property
+    def single_flight(self):
+        """
+        The request coalescer and refresh claims shared by all threads.
+        Reads are only coalesced with GCS_SINGLE_FLIGHT.
+        """
+        with self._lock:
+            if self._single_flight is None:
+                self._single_flight = SingleFlight(claim_timeout=getattr(
+                    settings, "GCS_REFRESH_CLAIM_TIMEOUT", 30))
+            return self._single_flight
+
+    @property
+    def write_behind(self):
+        """
+        The queue of background cache writes, or None if disabled
+        """
+        if "write_behind" in self._configured:
+            return self._write_behind
+        with self._lock:
+            if (self._write_behind is None and
+                    getattr(settings, "GCS_WRITE_BEHIND", False)):
+                self._write_behind = WriteBehindQueue(
+                    self._write,
+                    max_size=getattr(
+                        settings, "GCS_WRITE_BEHIND_QUEUE_SIZE", 1000),
+                    workers=getattr(settings, "GCS_WRITE_BEHIND_WORKERS", 2),
+                    block=getattr(settings, "GCS_WRITE_BEHIND_BLOCK", False))
+            self._configured.add("write_behind")
+            return self._write_behind
+
+    @property
+    def read_policy(self):
+        """
+        The retry and hedging of reads shared by all threads, or None for
+        the defaults
+        """
+        with self._lock:
+            if self._read_policy is None and (
+                    getattr(settings, "GCS_READ_DEADLINE", None) is not None
+                    or getattr(settings, "GCS_READ_HEDGE", False)):
+                self._read_policy = ReadPolicy(
+                    deadline=getattr(settings, "GCS_READ_DEADLINE", None),
+                    initial=getattr(settings, "GCS_READ_BACKOFF_INITIAL", 0.1),
+                    maximum=getattr(settings, "GCS_READ_BACKOFF_MAXIMUM", 1.0),
+                    hedge=getattr(settings, "GCS_READ_HEDGE", False),
+                    hedge_percentile=getattr(
+                        settings, "GCS_READ_HEDGE_PERCENTILE", 95),
+                    hedge_delay=getattr(settings, "GCS_READ_HEDGE_DELAY", 0.1),
+                    workers=getattr(settings, "GCS_READ_HEDGE_WORKERS", 4))
+            return self._read_policy
+
+    @property
+    def metrics(self):
+        """
+        The metrics sink shared by all threads, or None if disabled
+        """
+        if "metrics" in self._configured:
+            return self._metrics
+        with self._lock:
+            if (self._metrics is None and
+                    getattr(settings, "GCS_METRICS", False)):
+                self._metrics = self.__metrics__()
+            self._configured.add("metrics")
+            return self._metrics
+
+    def __metrics__(self):
+        """
+        Overridable method creating the metrics sink, defaults to an
+        in-memory PrometheusMetrics
+        """
+        return PrometheusMetrics()
+
+    @property
+    def circuit_breaker(self):
+        """
+        The circuit breaker shared by all threads, or None if disabled
+        """
+        if "circuit_breaker" in self._configured:
+            return self._circuit_breaker
+        with self._lock:
+            if (self._circuit_breaker is None and
+                    getattr(settings, "GCS_CIRCUIT_BREAKER", False)):
+                self._circuit_breaker = CircuitBreaker(
+                    error_rate=getattr(
+                        settings, "GCS_CIRCUIT_ERROR_RATE", 0.5),
+                    min_calls=getattr(settings, "GCS_CIRCUIT_MIN_CALLS", 20),
+                    window=getattr(settings, "GCS_CIRCUIT_WINDOW", 100),
+                    slow_call=getattr(settings, "GCS_CIRCUIT_SLOW_CALL", 0),
+                    cool_down=getattr(settings, "GCS_CIRCUIT_COOL_DOWN", 30),
+                    on_change=self.on_circuit_change)
+            self._configured.add("circuit_breaker")
+            return self._circuit_breaker
+
+    def on_circuit_change(self, old_state, new_state):
+        """
+        Overridable method called when the circuit breaker changes state
+        """
+        logging.warning("gcs circuit {}: was {}".format(new_state, old_state))
+        if self._metrics is not None:
+            self._metrics.increment("gcs_circuit_changes_total",
+                                    state=new_state)
+
+    def _guarded(self, fn, *args, **kwargs):
+        """
+        Call fn, raising CircuitOpenError without calling it while the
+        circuit breaker is open
+        """
+        breaker = self.circuit_breaker
+        if breaker is None:
+            return fn(*args, **kwargs)
+        if not breaker.allow():
+            raise CircuitOpenError()
+        start = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as ex:
+            breaker.record(not is_outage(ex), time.monotonic() - start)
+            raise
+        breaker.record(True, time.monotonic() - start)
+        return result
+
+    def _write(self, url_key, content, expire):
+        try:
+            self._guarded(self.client.set, url_key, content, expire=expire)
+        except CircuitOpenError:
+            pass  # dropped while GCS is unavailable
+
+    def flush(self, timeout=None):
+        """
+        Wait for queued background cache writes to complete, e.g. before
+        shutdown.  Returns False if the timeout expired first.
+        """
+        if self._write_behind is not None:
+            return self._write_behind.flush(timeout=timeout)
+        return True
+
+    @property
+    def executor(self):
+        """
+        The thread pool shared by all threads for bulk operations
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, "GCS_MAX_WORKERS", 10))
+            return self._executor
+
+    @property
+    def transfer_executor(self):
+        """
+        The thread pool shared by all threads for parallel transfers of
+        large objects, or None if disabled
+        """
+        with self._lock:
+            if (self._transfer_executor is None and
+                    getattr(settings, "GCS_TRANSFER_THRESHOLD", 0)):
+                self._transfer_executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, "GCS_TRANSFER_WORKERS", 4))
+            return self._transfer_executor
+
     def __client__(self):
         """
         Create a new client object instance with settings mapped from
@@ -51,7 +420,39 @@ class GCSClient():
             getattr(settings, "GCS_BUCKET_NAME", None),
             replace=getattr(settings, "GCS_REPLACE", False),
             timeout=getattr(settings, "GCS_TIMEOUT", 5),
-            num_retries=getattr(settings, "GCS_NUM_RETRIES", 3))
+            num_retries=getattr(settings, "GCS_NUM_RETRIES", 3),
+            memory_cache=self.memory_cache,
+            negative_cache=self.negative_cache,
+            disk_cache=self.disk_cache,
+            single_flight=(self.single_flight if getattr(
+                settings, "GCS_SINGLE_FLIGHT", False) else None),
+            executor=self.executor,
+            pool_connections=getattr(settings, "GCS_POOL_CONNECTIONS", 10),
+            pool_maxsize=getattr(settings, "GCS_POOL_MAXSIZE", 10),
+            pool_block=getattr(settings, "GCS_POOL_BLOCK", False),
+            tcp_keepalive=getattr(settings, "GCS_TCP_KEEPALIVE", False),
+            lazy_bucket=getattr(settings, "GCS_LAZY_BUCKET", False),
+            compression=getattr(settings, "GCS_COMPRESSION", None),
+            compression_threshold=getattr(
+                settings, "GCS_COMPRESSION_THRESHOLD", 1024),
+            transfer_threshold=getattr(settings, "GCS_TRANSFER_THRESHOLD", 0),
+            transfer_chunk_size=getattr(
+                settings, "GCS_TRANSFER_CHUNK_SIZE", 8 * 1024 * 1024),
+            transfer_executor=self.transfer_executor,
+            read_policy=self.read_policy,
+            metrics=self.metrics)
+
+    def warm_up(self):
+        """
+        Create the client, credentials and pooled connections ahead of the
+        first request, e.g. from a gunicorn post_fork hook.  With a thread
+        local client (the default) only the calling thread is warmed up.
+        """
+        try:
+            self.client.warm_up()
+        except (GoogleAPIError, GoogleAuthError, RequestException,
+                socket.gaierror, ConnectionError) as ex:
+            logging.error("gcp warm_up: {}".format(ex))
 
 
 class GCSBucketClient():
@@ -60,7 +461,21 @@ class GCSBucketClient():
     google.cloud.storage.Client
     """
 
-    def __init__(self, bucket_name, replace=False, timeout=5, num_retries=3):
+    batch_size = 100
+    max_compose_parts = 32
+    stream_chunk_size = 1024 * 1024
+    warm_up_key = "gcs-clients-warm-up"
+
+    def __init__(self, bucket_name, replace=False, timeout=5, num_retries=3,
+                 memory_cache=None, negative_cache=None, single_flight=None,
+                 max_workers=10, executor=None, pool_connections=10,
+                 pool_maxsize=10, pool_block=False, tcp_keepalive=False,
+                 lazy_bucket=False, compression=None,
+                 compression_threshold=1024, transfer_threshold=0,
+                 transfer_chunk_size=8 * 1024 * 1024, transfer_workers=4,
+                 transfer_executor=None, read_policy=None, metrics=None,
+                 project=None, credentials=None, api_endpoint=None,
+                 disk_cache=None):
         """
         :param bucket_name: Name of the bucket to read/write from
         :type bucket_name: str
@@ -70,11 +485,101 @@ class GCSBucketClient():
         :type timeout: bool (optional)
         :param num_retries: Number of request retries, defaults to 3
         :type num_retries: int (optional)
+        :param memory_cache: In-memory cache checked before GCS, defaults to
+            None
+        :type memory_cache: gcs_clients.cache.MemoryCache (optional)
+        :param negative_cache: Cache of keys known to be absent, defaults to
+            None
+        :type negative_cache: gcs_clients.cache.NegativeCache (optional)
+        :param single_flight: Coalescer for concurrent requests of the same
+            key, defaults to None
+        :type single_flight: gcs_clients.cache.SingleFlight (optional)
+        :param max_workers: Number of threads used for bulk operations,
+            defaults to 10
+        :type max_workers: int (optional)
+        :param executor: Thread pool used for bulk operations, defaults to a
+            pool of max_workers threads
+        :type executor: concurrent.futures.Executor (optional)
+        :param pool_connections: Number of hosts to pool connections for,
+            defaults to 10
+        :type pool_connections: int (optional)
+        :param pool_maxsize: Maximum number of pooled connections per host,
+            defaults to 10
+        :type pool_maxsize: int (optional)
+        :param pool_block: Whether to wait for a free connection when the
+            pool is full, defaults to False
+        :type pool_block: bool (optional)
+        :param tcp_keepalive: Whether to enable TCP keep-alive on pooled
+            connections, defaults to False
+        :type tcp_keepalive: bool (optional)
+        :param lazy_bucket: Whether to use a bucket handle without fetching
+            its metadata, defaults to False
+        :type lazy_bucket: bool (optional)
+        :param compression: Content encoding used to compress string content,
+            one of gcs_clients.codec.CODECS, defaults to None
+        :type compression: str (optional)
+        :param compression_threshold: Minimum size of content to compress,
+            defaults to 1024
+        :type compression_threshold: int (optional)
+        :param transfer_threshold: Size in bytes above which objects are
+            transferred in parallel parts, or 0 to disable parallel
+            transfers (the default)
+        :type transfer_threshold: int (optional)
+        :param transfer_chunk_size: Size in bytes of each part of a
+            parallel transfer, and of each chunk of a file upload, a
+            multiple of 256 KiB, defaults to 8 MiB
+        :type transfer_chunk_size: int (optional)
+        :param transfer_workers: Number of threads used for parallel
+            transfers, defaults to 4
+        :type transfer_workers: int (optional)
+        :param transfer_executor: Thread pool used for parallel transfers,
+            defaults to a pool of transfer_workers threads
+        :type transfer_executor: concurrent.futures.Executor (optional)
+        :param read_policy: Retry and hedging of reads, defaults to None
+        :type read_policy: gcs_clients.policy.ReadPolicy (optional)
+        :param metrics: Receives operation metrics, defaults to None
+        :type metrics: gcs_clients.metrics.MetricsSink (optional)
+        :param project: Project used by the storage client, defaults to the
+            project inferred from the environment
+        :type project: str (optional)
+        :param credentials: Credentials used to authorize requests, defaults
+            to the application default credentials
+        :type credentials: google.auth.credentials.Credentials (optional)
+        :param api_endpoint: GCS API endpoint, e.g. of a local emulator,
+            defaults to the storage.googleapis.com endpoint
+        :type api_endpoint: str (optional)
+        :param disk_cache: Local disk cache checked after memory_cache,
+            defaults to None
+        :type disk_cache: gcs_clients.cache.DiskCache (optional)
         """
+        if compression and compression not in CODECS:
+            raise ValueError("Unsupported compression: {}".format(compression))
         self.bucket_name = bucket_name
         self.replace = replace
         self.timeout = timeout
         self.num_retries = num_retries
+        self.memory_cache = memory_cache
+        self.negative_cache = negative_cache
+        self.single_flight = single_flight
+        self.max_workers = max_workers
+        self._executor = executor
+        self.lazy_bucket = lazy_bucket
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.transfer_threshold = transfer_threshold
+        self.transfer_chunk_size = transfer_chunk_size
+        self.transfer_workers = transfer_workers
+        self._transfer_executor = transfer_executor
+        self.read_policy = read_policy
+        self.metrics = metrics
+        self.project = project
+        self.credentials = credentials
+        self.api_endpoint = api_endpoint
+        self.disk_cache = disk_cache
+        self.adapter = PoolAdapter(
+            tcp_keepalive=tcp_keepalive, pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize, pool_block=pool_block)
+        self._lock = RLock()
         self._bucket = None
         self._client = None
 
@@ -84,11 +589,23 @@ class GCSBucketClient():
         Retreive GCS client object
         """
         if self._client is None:
-            client = storage.Client()
-            self._client = client
-            return self._client
-        else:
-            return self._client
+            with self._lock:
+                if self._client is None:
+                    kwargs = {}
+                    if self.project is not None:
+                        kwargs["project"] = self.project
+                    if self.credentials is not None:
+                        kwargs["credentials"] = self.credentials
+                    if self.api_endpoint is not None:
+                        kwargs["client_options"] = {
+                            "api_endpoint": self.api_endpoint}
+                    client = storage.Client(**kwargs)
+                    for session in (client._http,
+                                    client._http._auth_request.session):
+                        session.mount("https://", self.adapter)
+                        session.mount("http://", self.adapter)
+                    self._client = client
+        return self._client
 
     @client.setter
     def client(self, value):
@@ -100,16 +617,71 @@ class GCSBucketClient():
         Retreive GCS bucket object
         """
         if self._bucket is None:
-            bucket = self.client.get_bucket(self.bucket_name)
-            self._bucket = bucket
-            return self._bucket
-        else:
-            return self._bucket
+            with self._lock:
+                if self._bucket is None and self.lazy_bucket:
+                    self._bucket = self.client.bucket(self.bucket_name)
+                elif self._bucket is None:
+                    self._bucket = self.client.get_bucket(self.bucket_name)
+        return self._bucket
 
     @bucket.setter
     def bucket(self, value):
         self._bucket = value
 
+    @property
+    def executor(self):
+        """
+        Retreive thread pool for bulk operations
+        """
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers)
+        return self._executor
+
+    @property
+    def transfer_executor(self):
+        """
+        Retreive thread pool for parallel transfers
+        """
+        if self._transfer_executor is None:
+            with self._lock:
+                if self._transfer_executor is None:
+                    self._transfer_executor = ThreadPoolExecutor(
+                        max_workers=self.transfer_workers)
+        return self._transfer_executor
+
+    def warm_up(self):
+        """
+        Create the GCS client and bucket, refresh credentials and open a
+        pooled connection
+        """
+        client = self.client
+        auth_request = client._http._auth_request
+        if not client._credentials.valid:
+            client._credentials.refresh(auth_request)
+        # Give up within the timeout rather than the library's retry deadline
+        retry = DEFAULT_RETRY.with_deadline(self.timeout)
+        if self._bucket is None and not self.lazy_bucket:
+            with self._lock:
+                if self._bucket is None:
+                    self._bucket = client.get_bucket(
+                        self.bucket_name, timeout=self.timeout, retry=retry)
+        self.bucket.blob(self.warm_up_key).exists(timeout=self.timeout,
+                                                  retry=retry)
+
+    def _count(self, name, value=1, **labels):
+        if self.metrics is not None:
+            self.metrics.increment(name, value, **labels)
+
+    def pool_stats(self):
+        """
+        Return a dict of HTTP connection pool counts
+        """
+        return self.adapter.stats()
+
+    @timed("delete")
     def delete(self, url_key):
         """
         Delete content matching url_key from GCS bucket
@@ -117,49 +689,356 @@ class GCSBucketClient():
         :param url_key: URL response to cache
         :type url_key: str
         """
+        if self.memory_cache is not None:
+            self.memory_cache.delete(url_key)
+        if self.disk_cache is not None:
+            self.disk_cache.delete(url_key)
         try:
             self.bucket.get_blob(url_key).delete(timeout=self.timeout)
         except NotFound as ex:
             logging.error("gcp {}: {}".format(url_key, ex))
             raise
+        if self.negative_cache is not None:
+            self.negative_cache.add(url_key)
 
     def get(self, url_key, expire=0):
         """
-        Download content from a GCS bucket as a string
+        Download content from a GCS bucket as bytes, or None if the content
+        is missing or expired
+
+        :param url_key: URL response to cache
+        :type url_key: str
+        :param expire: Number of seconds until the item is expired from the
+            cache, or 0 for no expiry (the default).
+        :type expire: int (optional, default 0)
+        """
+        return self.get_stale(url_key, expire=expire)[0]
+
+    @timed("get")
+    def get_stale(self, url_key, expire=0, grace=0):
+        """
+        Download content from a GCS bucket as bytes, including content that
+        expired less than grace seconds ago.  Returns a tuple of (content,
+        stale), where content is None if missing or expired, and stale is
+        True for content within the grace period.
 
         :param url_key: URL response to cache
         :type url_key: str
         :param expire: Number of seconds until the item is expired from the
             cache, or 0 for no expiry (the default).
         :type expire: int (optional, default 0)
+        :param grace: Number of seconds that expired content may be returned
+            as stale, defaults to 0
+        :type grace: int (optional, default 0)
+        """
+        since = time.monotonic()
+        if self.memory_cache is not None:
+            entry = self.memory_cache.get(url_key)
+            if entry is not None and is_fresh(entry[1], expire):
+                self._count("gcs_reads_total", result="memory")
+                return entry[0], False
+        entry = None
+        if self.disk_cache is not None:
+            entry = self.disk_cache.get(url_key)
+            if entry is not None and is_fresh(entry.custom_time, expire):
+                if self.memory_cache is not None:
+                    self.memory_cache.set(url_key, entry.content,
+                                          entry.custom_time, since=since)
+                self._count("gcs_reads_total", result="disk")
+                return entry.content, False
+        if self.negative_cache is not None and url_key in self.negative_cache:
+            self._count("gcs_reads_total", result="negative")
+            return None, False
+        # Revalidate an expired local copy
+        args = (url_key,) if entry is None else (url_key, entry)
+        if self.single_flight is not None:
+            content, creation_time = self.single_flight.do(
+                url_key, self._fetch, *args)
+        else:
+            content, creation_time = self._fetch(*args)
+        if creation_time:
+            if is_fresh(creation_time, expire):
+                if self.memory_cache is not None:
+                    self.memory_cache.set(url_key, content, creation_time,
+                                          since=since)
+                self._count("gcs_reads_total", result="hit")
+                return content, False
+            elif grace and is_fresh(creation_time, expire + grace):
+                self._count("gcs_reads_total", result="stale")
+                return content, True
+            self._count("gcs_reads_total", result="expired")
+        else:
+            self._count("gcs_reads_total", result="miss")
+        return None, False  # missing or expired content
+
+    @timed("get_entry")
+    def get_entry(self, url_key):
+        """
+        Download content and its custom time without checking expiry,
+        returning a tuple of (content, custom_time), or (None, None) if the
+        content is missing
+
+        :param url_key: URL response to cache
+        :type url_key: str
+        """
+        since = time.monotonic()
+        if self.memory_cache is not None:
+            entry = self.memory_cache.get(url_key)
+            if entry is not None:
+                self._count("gcs_reads_total", result="memory")
+                return entry
+        if self.disk_cache is not None:
+            entry = self.disk_cache.get(url_key)
+            if entry is not None:
+                if self.memory_cache is not None:
+                    self.memory_cache.set(url_key, entry.content,
+                                          entry.custom_time, since=since)
+                self._count("gcs_reads_total", result="disk")
+                return entry.content, entry.custom_time
+        if self.negative_cache is not None and url_key in self.negative_cache:
+            self._count("gcs_reads_total", result="negative")
+            return None, None
+        if self.single_flight is not None:
+            content, creation_time = self.single_flight.do(
+                url_key, self._fetch, url_key)
+        else:
+            content, creation_time = self._fetch(url_key)
+        if creation_time is None:
+            self._count("gcs_reads_total", result="miss")
+            return None, None
+        if self.memory_cache is not None:
+            self.memory_cache.set(url_key, content, creation_time,
+                                  since=since)
+        self._count("gcs_reads_total", result="hit")
+        return content, creation_time
+
+    @timed("touch")
+    def touch(self, url_key):
+        """
+        Restart the expiry of content by updating its custom time, without
+        uploading the content
+
+        :param url_key: URL response to cache
+        :type url_key: str
+        """
+        blob = self.bucket.blob(url_key)
+        blob.custom_time = datetime.now(timezone.utc)
+        blob.patch(timeout=self.timeout)
+        self._touch_local(url_key, blob)
+
+    def _touch_local(self, url_key, blob):
         """
+        Update the custom time of the local copies of a patched blob,
+        removing a disk copy of another generation
+        """
+        if self.memory_cache is not None:
+            entry = self.memory_cache.get(url_key)
+            if entry is not None:
+                self.memory_cache.set(url_key, entry[0], blob.custom_time)
+        if self.disk_cache is not None:
+            entry = self.disk_cache.get(url_key)
+            if entry is not None and entry.generation not in (
+                    None, blob.generation):
+                self.disk_cache.delete(url_key)
+            elif entry is not None:
+                self.disk_cache.set(url_key, entry.content, blob.custom_time,
+                                    blob.generation, blob.metageneration)
+
+    def _fetch(self, url_key, entry=None):
+        """
+        Download content and its custom time, returning a tuple of
+        (content, custom_time), or (None, None) if the content is missing.
+        A local copy with a known generation is revalidated instead.
+        """
+        if entry is not None and entry.generation:
+            fetch, args = self._revalidate, (url_key, entry)
+        else:
+            fetch, args = self._download, (url_key,)
+        if self.read_policy is not None:
+            return self.read_policy.call(fetch, *args)
+        return fetch(*args)
+
+    def _revalidate(self, url_key, entry):
+        """
+        Check an expired local copy against the object's metadata, and
+        download the content only if its generation has changed
+        """
+        blob = self.bucket.blob(url_key)
         try:
-            blob = self.bucket.get_blob(url_key)
-            if blob:
+            blob.reload(if_generation_match=entry.generation,
+                        timeout=self.timeout, **self._read_kwargs)
+        except PreconditionFailed:
+            self._count("gcs_revalidations_total", result="changed")
+            return self._download(url_key)
+        except NotFound:
+            self._count("gcs_revalidations_total", result="missing")
+            self.disk_cache.delete(url_key)
+            if self.negative_cache is not None:
+                self.negative_cache.add(url_key)
+            return None, None
+        self._count("gcs_revalidations_total", result="unchanged")
+        if blob.metageneration != entry.metageneration:
+            # The custom time has been updated
+            self.disk_cache.set(url_key, entry.content, blob.custom_time,
+                                blob.generation, blob.metageneration)
+        return entry.content, blob.custom_time
+
+    @property
+    def _read_kwargs(self):
+        if self.read_policy is not None:
+            return {"retry": self.read_policy.retry}
+        return {}
+
+    def _download(self, url_key, attempts=2):
+        blob = CacheBlob(url_key, self.bucket)
+        try:
+            if self.transfer_threshold:
+                content = self._download_parts(blob)
+            else:
+                content = blob.download_as_bytes(
+                    raw_download=True, timeout=self.timeout,
+                    **self._read_kwargs)
+            self._count("gcs_bytes_total", len(content),
+                        direction="download")
+            content = decompress(content, blob.content_encoding)
+            creation_time = blob.custom_time
+            if creation_time is None:
+                # Custom time wasn't returned with the content, fetch the
+                # metadata for the downloaded generation
+                blob.reload(if_generation_match=blob.generation,
+                            timeout=self.timeout, **self._read_kwargs)
                 creation_time = blob.custom_time
-                if creation_time:
-                    creation_time = creation_time.replace(tzinfo=timezone.utc)
-                    time_since_creation = \
-                        (datetime.now(timezone.utc) - creation_time) \
-                        .total_seconds()
-                    if (round(time_since_creation, 2) <=
-                            expire or expire == 0):
-                        content = blob.download_as_string(timeout=self.timeout)
-                        return content
-                    else:
-                        return None  # expired content
-        except NotFound as ex:
-            logging.error("gcp {}: {}".format(url_key, ex))
-            raise
+        except NotFound:
+            if self.negative_cache is not None:
+                self.negative_cache.add(url_key)
+            return None, None
+        except PreconditionFailed:
+            # Replaced during the download, so read the new generation
+            if attempts > 1:
+                return self._download(url_key, attempts - 1)
+            return None, None
+        if self.disk_cache is not None and creation_time:
+            self.disk_cache.set(url_key, content, creation_time,
+                                blob.generation, blob.metageneration)
+        return content, creation_time
+
+    def _download_parts(self, blob):
+        """
+        Download up to transfer_threshold bytes, and the remainder of a
+        larger object as concurrent byte range requests for the same
+        generation
+        """
+        try:
+            content = blob.download_as_bytes(
+                start=0, end=self.transfer_threshold - 1, raw_download=True,
+                checksum=None, timeout=self.timeout, **self._read_kwargs)
+        except RequestRangeNotSatisfiable:
+            # Empty object
+            return blob.download_as_bytes(raw_download=True,
+                                          timeout=self.timeout,
+                                          **self._read_kwargs)
+        size = blob.size
+        if size is None or len(content) >= size:
+            return self._verify(blob, content)
+
+        def download(start):
+            part = CacheBlob(blob.name, self.bucket)
+            return part.download_as_bytes(
+                start=start, end=min(start + self.transfer_chunk_size,
+                                     size) - 1,
+                raw_download=True, if_generation_match=blob.generation,
+                checksum=None, timeout=self.timeout, **self._read_kwargs)
+
+        parts = self.transfer_executor.map(download, range(
+            len(content), size, self.transfer_chunk_size))
+        return self._verify(blob, b"".join([content] + list(parts)))
+
+    @staticmethod
+    def _verify(blob, content):
+        """
+        Check ranged download content against the object's CRC32C hash
+        """
+        if blob.crc32c:
+            checksum = _crc32c(content)
+            if checksum != blob.crc32c:
+                raise DataCorruption(
+                    None, "Checksum mismatch downloading {}: {} != {}".format(
+                        blob.name, checksum, blob.crc32c))
+        return content
+
+    def _upload_parts(self, blob, content):
+        """
+        Upload content as concurrent parts, composed into the blob
+        """
+        count = min(-(-len(content) // self.transfer_chunk_size),
+                    self.max_compose_parts)
+        size = -(-len(content) // count)
+        prefix = "{}.part-{}".format(blob.name, uuid4().hex)
+        parts = [self.bucket.blob("{}-{}".format(prefix, i))
+                 for i in range(count)]
+        # Parts left behind by an interrupted upload are removed by sweep
+        now = datetime.now(timezone.utc)
+        for part in parts:
+            part.custom_time = now
+
+        def upload(i):
+            parts[i].upload_from_string(
+                content[i * size:(i + 1) * size],
+                content_type="application/octet-stream",
+                num_retries=self.num_retries, timeout=self.timeout)
+
+        def delete(part):
+            try:
+                part.delete(timeout=self.timeout)
+            except NotFound:
+                pass
+            except GoogleAPIError as ex:
+                logging.error("gcp {}: {}".format(part.name, ex))
+
+        try:
+            list(self.transfer_executor.map(upload, range(count)))
+            blob.compose(parts, timeout=self.timeout)
+        finally:
+            list(self.transfer_executor.map(delete, parts))
+
+    @timed("get_stream")
+    def get_stream(self, url_key, expire=0, chunk_size=None):
+        """
+        Open content in a GCS bucket as a file-like CacheStream, which
+        downloads the content in chunks as it's read, or None if the content
+        is missing or expired
+
+        :param url_key: URL response to cache
+        :type url_key: str
+        :param expire: Number of seconds until the item is expired from the
+            cache, or 0 for no expiry (the default).
+        :type expire: int (optional, default 0)
+        :param chunk_size: Number of bytes per download, defaults to
+            stream_chunk_size
+        :type chunk_size: int (optional)
+        """
+        if self.negative_cache is not None and url_key in self.negative_cache:
+            return None
+        blob = CacheBlob(url_key, self.bucket)
+        try:
+            blob.reload(timeout=self.timeout)
+        except NotFound:
+            if self.negative_cache is not None:
+                self.negative_cache.add(url_key)
+            return None
+        if blob.custom_time and is_fresh(blob.custom_time, expire):
+            return CacheStream(blob, chunk_size=(
+                chunk_size or self.stream_chunk_size), timeout=self.timeout)
 
+    @timed("set")
     def set(self, url_key, content, expire=0):
         """
-        Upload a string or file-like object contents to GCS bucket
+        Upload a string, bytes or file-like object contents to GCS bucket
 
         :param url_key: URL response to cache
         :type url_key: str
         :param content: Content to cache
-        :type content: str or file object
+        :type content: str, bytes or file object
         :param expire: If None, don't update the cache otherwise upload to the
             cache, the default
         :type expire: int or None (optional, default update)
@@ -171,11 +1050,264 @@ class GCSBucketClient():
             if not blob:
                 blob = self.bucket.blob(url_key)
             blob.custom_time = datetime.now(timezone.utc)
+            unchanged = False
             if isinstance(content, IOBase):
+                kwargs = {}
+                if self.transfer_threshold:
+                    size = self._file_size(content)
+                    if size is None or size > self.transfer_threshold:
+                        blob.chunk_size = self.transfer_chunk_size
+                    else:
+                        # A known size is uploaded in a single request
+                        kwargs["size"] = size
+                self._count("gcs_writes_total", result="uploaded")
                 blob.upload_from_file(content,
                                       num_retries=self.num_retries,
-                                      timeout=self.timeout)
+                                      timeout=self.timeout, **kwargs)
+            else:
+                if not isinstance(content, bytes):
+                    content = str(content)
+                encoding = None
+                if (self.compression and
+                        len(content) >= self.compression_threshold):
+                    if isinstance(content, str):
+                        content = content.encode("utf-8")
+                    content = compress(content, self.compression)
+                    encoding = self.compression
+                unchanged = self._patch_unchanged(blob, content, encoding)
+                if not unchanged:
+                    if blob.content_encoding != encoding:
+                        blob.content_encoding = encoding
+                    self._upload(blob, content)
+            if unchanged:
+                # Keep the local copies of the unchanged content
+                self._touch_local(url_key, blob)
+            else:
+                if self.memory_cache is not None:
+                    self.memory_cache.delete(url_key)
+                if self.disk_cache is not None:
+                    self.disk_cache.delete(url_key)
+            if self.negative_cache is not None:
+                self.negative_cache.delete(url_key)
+
+    @staticmethod
+    def _file_size(content):
+        """
+        Return the number of bytes from the file position to its end, or
+        None if the file isn't seekable
+        """
+        try:
+            position = content.tell()
+            size = content.seek(0, os.SEEK_END) - position
+            content.seek(position)
+        except (AttributeError, OSError, ValueError):
+            return None
+        return size
+
+    def _upload(self, blob, content):
+        self._count("gcs_writes_total", result="uploaded")
+        self._count("gcs_bytes_total", len(content), direction="upload")
+        if (self.transfer_threshold and
+                len(content) > self.transfer_threshold):
+            if isinstance(content, str):
+                content = content.encode("utf-8")
+            self._upload_parts(blob, content)
+        else:
+            blob.upload_from_string(content, num_retries=self.num_retries,
+                                    timeout=self.timeout)
+
+    def _patch_unchanged(self, blob, content, encoding):
+        """
+        Update only the custom time of an existing object with identical
+        content, returning False if the content needs to be uploaded
+        """
+        if not blob.generation or blob.content_encoding != encoding:
+            return False
+        if blob.crc32c is None and blob.md5_hash is None:
+            return False
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        if blob.crc32c and _crc32c(content) != blob.crc32c:
+            return False
+        if blob.md5_hash and base64.b64encode(
+                hashlib.md5(content).digest()).decode("utf-8") != \
+                blob.md5_hash:
+            return False
+        try:
+            blob.patch(if_generation_match=blob.generation,
+                       timeout=self.timeout)
+        except PreconditionFailed:
+            return False
+        self._count("gcs_writes_total", result="unchanged")
+        return True
+
+    @timed("get_many")
+    def get_many(self, url_keys, expire=0):
+        """
+        Download content for multiple keys concurrently.  Returns a tuple of
+        a dict of content (or None) by key, and a dict of errors by key.
+
+        :param url_keys: URL responses to get
+        :type url_keys: list of str
+        :param expire: Number of seconds until items are expired from the
+            cache, or 0 for no expiry (the default).  May also be a dict of
+            expiry by key.
+        :type expire: int or dict (optional, default 0)
+        """
+        def get(url_key):
+            return self.get(url_key, expire=(
+                expire[url_key] if isinstance(expire, dict) else expire))
+
+        results, errors = {}, {}
+        for url_key, (content, ex) in zip(url_keys, self._map(get, url_keys)):
+            if ex is not None:
+                errors[url_key] = ex
+            else:
+                results[url_key] = content
+        return results, errors
+
+    @timed("set_many")
+    def set_many(self, items, expire=0):
+        """
+        Upload content for multiple keys concurrently.  Returns a dict of
+        errors by key.
+
+        :param items: Content to cache by URL key
+        :type items: dict
+        :param expire: If None, don't update the cache otherwise upload to the
+            cache, the default
+        :type expire: int or None (optional, default update)
+        """
+        def set(url_key):
+            self.set(url_key, items[url_key], expire=expire)
+
+        url_keys = list(items)
+        return {url_key: ex for url_key, (_, ex) in zip(
+            url_keys, self._map(set, url_keys)) if ex is not None}
+
+    @timed("delete_many")
+    def delete_many(self, url_keys, versions=None):
+        """
+        Delete content for multiple keys using concurrent batch requests.
+        Returns a dict of errors by key.
+
+        :param url_keys: URL responses to delete
+        :type url_keys: list of str
+        :param versions: A (generation, metageneration) tuple by key, for
+            keys that are only deleted if their object hasn't changed since,
+            defaults to None
+        :type versions: dict (optional)
+        """
+        def delete(batch_keys):
+            # Fetch the bucket before its request can be deferred by the batch
+            bucket = self.bucket
+            batch = ResponseBatch(self.client)
+            with batch:
+                for url_key in batch_keys:
+                    kwargs = {}
+                    if versions and url_key in versions:
+                        generation, metageneration = versions[url_key]
+                        kwargs = {"if_generation_match": generation,
+                                  "if_metageneration_match": metageneration}
+                    bucket.delete_blob(url_key, timeout=self.timeout,
+                                       **kwargs)
+            return {url_key: from_http_response(response)
+                    for url_key, response in zip(batch_keys, batch.responses)
+                    if not 200 <= response.status_code < 300}
+
+        url_keys = list(url_keys)
+        if self.memory_cache is not None:
+            for url_key in url_keys:
+                self.memory_cache.delete(url_key)
+        if self.disk_cache is not None:
+            for url_key in url_keys:
+                self.disk_cache.delete(url_key)
+        batches = [url_keys[i:i + self.batch_size]
+                   for i in range(0, len(url_keys), self.batch_size)]
+        errors = {}
+        for batch_keys, (batch_errors, ex) in zip(
+                batches, self._map(delete, batches)):
+            if ex is not None:
+                errors.update(dict.fromkeys(batch_keys, ex))
             else:
-                blob.upload_from_string(str(content),
-                                        num_retries=self.num_retries,
-                                        timeout=self.timeout)
+                errors.update(batch_errors)
+        if self.negative_cache is not None:
+            for url_key in url_keys:
+                if url_key not in errors:
+                    self.negative_cache.add(url_key)
+        return errors
+
+    @timed("sweep")
+    def sweep(self, prefix, expire=0, match=None, page_size=1000,
+              all=False):
+        """
+        Delete the objects under prefix whose content expired more than
+        expire seconds ago, or every object with all, a page of listed
+        objects at a time, using concurrent batch requests.  Objects updated
+        since they were listed are not deleted.  Returns a dict of the
+        number of objects listed, selected for deletion, deleted, skipped
+        and failed.
+
+        :param prefix: Object name prefix, e.g. base_path/service/
+        :type prefix: str
+        :param expire: Number of seconds after which content has expired,
+            required unless all is True
+        :type expire: int
+        :param match: Called with each object name, returning whether to
+            select it, defaults to selecting every object
+        :type match: callable (optional)
+        :param page_size: Number of objects listed per request, defaults to
+            1000
+        :type page_size: int (optional)
+        :param all: Whether to select objects whatever their expiry,
+            defaults to False
+        :type all: bool (optional)
+        """
+        if not all and not (expire and expire > 0):
+            # An expiry of 0 means content never expires
+            raise ValueError(
+                "expire must be a positive number of seconds: {}".format(
+                    expire))
+        counts = dict.fromkeys(
+            ("listed", "selected", "deleted", "skipped", "errors"), 0)
+        blobs = self.client.list_blobs(
+            self.bucket, prefix=prefix, page_size=page_size,
+            timeout=self.timeout,
+            fields="items(name,generation,metageneration,customTime),"
+                   "nextPageToken")
+        for page in blobs.pages:
+            versions = {}
+            for blob in page:
+                counts["listed"] += 1
+                if match is not None and not match(blob.name):
+                    continue
+                if not all and (blob.custom_time is None or
+                                is_fresh(blob.custom_time, expire)):
+                    continue
+                versions[blob.name] = (blob.generation, blob.metageneration)
+            if not versions:
+                continue
+            counts["selected"] += len(versions)
+            errors = self.delete_many(list(versions), versions=versions)
+            counts["deleted"] += len(versions) - len(errors)
+            for url_key, ex in errors.items():
+                if isinstance(ex, (NotFound, PreconditionFailed)):
+                    counts["skipped"] += 1  # deleted or updated since
+                else:
+                    counts["errors"] += 1
+                    logging.error("gcs sweep {}: {}".format(url_key, ex))
+        return counts
+
+    def _map(self, fn, items):
+        """
+        Apply fn to items using the thread pool, returning a list of
+        (result, error) tuples in item order
+        """
+        futures = [self.executor.submit(fn, item) for item in items]
+        results = []
+        for future in futures:
+            try:
+                results.append((future.result(), None))
+            except Exception as ex:
+                results.append((None, ex))
+        return results
@@ -0,0 +1,259 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Compare the stored size and transfer time of cached content for each
+available codec:
+
+    python -m gcs_clients.benchmark [--bandwidth MBPS] [FILE ...]
+
+Or, from a source checkout, measure the throughput and latency of the cache
+clients against a local fake GCS server, with settings from the [GCS]
+section of a config file, defaulting to conf/test.conf:
+
+    python -m gcs_clients.benchmark --clients [--conf FILE]
+        [--sizes BYTES,...] [--threads COUNT,...] [--operations COUNT]
+        [--latency MS] [--error-rate RATE]
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+from commonconf.backends import use_configparser_backend
+from concurrent.futures import ThreadPoolExecutor
+from gcs_clients.codec import CODECS, compress, decompress
+from gcs_clients.restclient import CachedHTTPResponse, RestclientGCSClient
+from google.auth.credentials import AnonymousCredentials
+
+BUCKET_NAME = "benchmark"
+
+
+def _timed(fn, *args, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn(*args)
+    return result, (time.perf_counter() - start) / repeat
+
+
+def sample_content(size=64 * 1024):
+    """
+    Return a JSON-formatted cache entry of roughly size bytes
+    """
+    rows, row = [], 0
+    data = {"status": 200, "headers": {"Content-Type": "application/json"},
+            "data": ""}
+    while len(json.dumps(rows)) < size:
+        rows.append({"id": row, "name": "Name {}".format(row),
+                     "email": "user{}@example.edu".format(row),
+                     "active": row % 3 == 0})
+        row += 1
+    data["data"] = json.dumps(rows)
+    return json.dumps(data).encode("utf-8")
+
+
+def compare(content, bandwidth=10):
+    """
+    Return a result dict for each codec, with transfer times estimated at
+    bandwidth megabits per second
+    """
+    bytes_per_second = bandwidth * 1000000 / 8
+    results = [{"codec": "none", "bytes": len(content), "ratio": 1.0,
+                "compress_ms": 0.0, "decompress_ms": 0.0,
+                "transfer_ms": len(content) / bytes_per_second * 1000}]
+    for encoding in sorted(CODECS):
+        compressed, compress_time = _timed(compress, content, encoding)
+        _, decompress_time = _timed(decompress, compressed, encoding)
+        results.append({
+            "codec": encoding,
+            "bytes": len(compressed),
+            "ratio": len(content) / len(compressed),
+            "compress_ms": compress_time * 1000,
+            "decompress_ms": decompress_time * 1000,
+            "transfer_ms": len(compressed) / bytes_per_second * 1000,
+        })
+    return results
+
+
+def report(name, results):
+    print(name)
+    print("  {:<6} {:>10} {:>7} {:>12} {:>14} {:>12} {:>10}".format(
+        "codec", "bytes", "ratio", "compress ms", "decompress ms",
+        "transfer ms", "saved ms"))
+    baseline = results[0]["transfer_ms"]
+    for result in results:
+        saved = baseline - result["transfer_ms"] - result["decompress_ms"]
+        print("  {codec:<6} {bytes:>10} {ratio:>7.2f} {compress_ms:>12.3f} "
+              "{decompress_ms:>14.3f} {transfer_ms:>12.3f} {saved:>10.3f}"
+              .format(saved=saved, **result))
+
+
+def percentile(values, percent):
+    """
+    Return the nearest-rank percentile of a list of values
+    """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = max(int(round(percent / 100 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def measure(fn, calls, executor):
+    """
+    Make each call of fn(*args) from the executor's threads, returning a
+    result dict of the call count, errors, throughput and latency
+    percentiles
+    """
+    def call(args):
+        start = time.perf_counter()
+        try:
+            fn(*args)
+            failed = False
+        except Exception:
+            failed = True
+        return time.perf_counter() - start, failed
+
+    start = time.perf_counter()
+    timings = list(executor.map(call, calls))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for latency, _ in timings]
+    return {
+        "ops": len(timings),
+        "errors": sum(1 for _, failed in timings if failed),
+        "ops_per_sec": len(timings) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+class BenchmarkGCSClient(RestclientGCSClient):
+    """
+    A RestclientGCSClient whose bucket clients use a fake GCS server
+    """
+
+    def __init__(self, api_endpoint):
+        super().__init__()
+        self.api_endpoint = api_endpoint
+
+    def __client__(self):
+        client = super().__client__()
+        client.bucket_name = BUCKET_NAME
+        client.project = BUCKET_NAME
+        client.credentials = AnonymousCredentials()
+        client.api_endpoint = self.api_endpoint
+        return client
+
+
+def benchmark_clients(sizes=(1024, 64 * 1024), threads=(1, 8),
+                      operations=200, latency=0, error_rate=0):
+    """
+    Return a result dict for each client operation, payload size and thread
+    count, measured against a fake GCS server adding latency seconds to
+    each request and failing a proportion error_rate of requests
+    """
+    # The fake server is part of the tests, which aren't installed
+    from gcs_clients.tests.fake_gcs import FakeGCSServer
+
+    server = FakeGCSServer(latency=latency, error_rate=error_rate,
+                           seed=0).start()
+    try:
+        gcs_client = BenchmarkGCSClient(server.url)
+        results = []
+        for size in sizes:
+            content = sample_content(size)
+            response = CachedHTTPResponse(
+                status=200, data=content,
+                headers={"Content-Type": "application/json"})
+            for count in threads:
+                keys = ["benchmark/{}/{}/{}".format(size, count, op)
+                        for op in range(operations)]
+                urls = ["/api/v1/{}/{}/{}".format(size, count, op)
+                        for op in range(operations)]
+                executor = ThreadPoolExecutor(max_workers=count)
+                # Create each thread's client before timing requests
+                measure(lambda key: gcs_client.client.bucket,
+                        [(key,) for key in keys[:count * 2]], executor)
+                # Bucket operations bypass the shim to count their errors
+                for operation, fn, calls in (
+                        ("set", lambda key: gcs_client.client.set(
+                            key, content), keys),
+                        ("get", lambda key: gcs_client.client.get(key), keys),
+                        ("delete", lambda key: gcs_client.client.delete(key),
+                         keys),
+                        ("updateCache", lambda url: gcs_client.updateCache(
+                            "benchmark", url, response), urls),
+                        ("getCache", lambda url: gcs_client.getCache(
+                            "benchmark", url), urls)):
+                    result = measure(
+                        fn, [(call,) for call in calls], executor)
+                    result.update(operation=operation, size=size,
+                                  threads=count)
+                    results.append(result)
+                executor.shutdown()
+        return results
+    finally:
+        server.stop()
+
+
+def report_clients(results):
+    print("  {:<12} {:>8} {:>8} {:>6} {:>7} {:>10} {:>9} {:>9}".format(
+        "operation", "bytes", "threads", "ops", "errors", "ops/sec",
+        "p50 ms", "p99 ms"))
+    for result in results:
+        print("  {operation:<12} {size:>8} {threads:>8} {ops:>6} "
+              "{errors:>7} {ops_per_sec:>10.1f} {p50_ms:>9.3f} "
+              "{p99_ms:>9.3f}".format(**result))
+
+
+def _counts(value):
+    return [int(count) for count in value.split(",")]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("files", nargs="*",
+                        help="sample content, defaults to generated JSON")
+    parser.add_argument("--bandwidth", type=float, default=10,
+                        help="bandwidth in megabits per second")
+    parser.add_argument("--clients", action="store_true",
+                        help="benchmark the cache clients against a local "
+                             "fake GCS server")
+    parser.add_argument("--conf", default=os.path.join(
+                            os.path.dirname(os.path.dirname(
+                                os.path.abspath(__file__))),
+                            "conf", "test.conf"),
+                        help="settings file for the cache clients")
+    parser.add_argument("--sizes", type=_counts, default=[1024, 64 * 1024],
+                        help="comma separated payload sizes in bytes")
+    parser.add_argument("--threads", type=_counts, default=[1, 8],
+                        help="comma separated thread counts")
+    parser.add_argument("--operations", type=int, default=200,
+                        help="calls per operation, size and thread count")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="milliseconds added to each fake GCS request")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="proportion of fake GCS requests that fail")
+    args = parser.parse_args(args)
+
+    if args.clients:
+        use_configparser_backend(args.conf, "GCS")
+        # Injected errors are counted rather than logged
+        logging.disable(logging.ERROR)
+        report_clients(benchmark_clients(
+            sizes=args.sizes, threads=args.threads,
+            operations=args.operations, latency=args.latency / 1000,
+            error_rate=args.error_rate))
+    elif args.files:
+        for path in args.files:
+            with open(path, "rb") as f:
+                report(path, compare(f.read(), args.bandwidth))
+    else:
+        for size in (1024, 16 * 1024, 256 * 1024):
+            report("{} byte sample".format(size),
+                   compare(sample_content(size), args.bandwidth))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import time
+from collections import deque
+from threading import Lock
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker():
+    """
+    A thread-safe circuit breaker.  The circuit opens when the proportion
+    of failed or slow calls among recent calls reaches error_rate, after
+    which calls are refused until cool_down seconds have passed.  The
+    circuit is then half-open, allowing a single trial call that closes the
+    circuit if it succeeds, or opens it again if it fails.
+    """
+
+    def __init__(self, error_rate=0.5, min_calls=20, window=100,
+                 slow_call=0, cool_down=30, on_change=None):
+        """
+        :param error_rate: Proportion of failed calls that opens the
+            circuit, defaults to 0.5
+        :type error_rate: float (optional)
+        :param min_calls: Minimum number of recent calls before the circuit
+            can open, defaults to 20
+        :type min_calls: int (optional)
+        :param window: Number of recent calls counted, defaults to 100
+        :type window: int (optional)
+        :param slow_call: Seconds after which a successful call counts as a
+            failure, or 0 to ignore latency (the default)
+        :type slow_call: float (optional)
+        :param cool_down: Seconds the circuit stays open before a trial
+            call, defaults to 30
+        :type cool_down: float (optional)
+        :param on_change: Called as on_change(old_state, new_state) when the
+            state changes
+        :type on_change: callable (optional)
+        """
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.slow_call = slow_call
+        self.cool_down = cool_down
+        self.on_change = on_change
+        self.state = CLOSED
+        self._calls = deque(maxlen=window)
+        self._opened = 0
+        self._trial = False
+        self._lock = Lock()
+
+    def allow(self):
+        """
+        Whether a call may proceed.  Every allowed call must be followed by
+        a call to record.
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if (self.state == OPEN and
+                    time.monotonic() - self._opened >= self.cool_down):
+                changed = self._change(HALF_OPEN)
+            elif self.state == HALF_OPEN and not self._trial:
+                changed = None
+            else:
+                return False
+            self._trial = True
+        self._notify(changed)
+        return True
+
+    def record(self, success, duration=0):
+        """
+        Record the outcome of an allowed call
+        """
+        failed = not success or bool(
+            self.slow_call and duration >= self.slow_call)
+        with self._lock:
+            changed = None
+            if self.state == CLOSED:
+                self._calls.append(failed)
+                failures = sum(self._calls)
+                if (len(self._calls) >= self.min_calls and
+                        failures >= self.error_rate * len(self._calls)):
+                    changed = self._change(OPEN)
+            elif self._trial:
+                self._trial = False
+                changed = self._change(OPEN if failed else CLOSED)
+        self._notify(changed)
+
+    def reset(self):
+        with self._lock:
+            changed = self._change(CLOSED)
+            self._trial = False
+        self._notify(changed)
+
+    def _change(self, state):
+        old, self.state = self.state, state
+        if state == OPEN:
+            self._opened = time.monotonic()
+        if state != HALF_OPEN:
+            self._calls.clear()
+        return (old, state) if old != state else None
+
+    def _notify(self, changed):
+        if changed is not None and self.on_change is not None:
+            self.on_change(*changed)
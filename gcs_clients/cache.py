@@ -0,0 +1,420 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta, timezone
+from threading import Event, Lock
+
+DISK_MAGIC = b"GCSD"
+DISK_VERSION = 1
+# magic, version, generation, metageneration, custom time in microseconds
+# since the epoch, key length
+DISK_HEADER = struct.Struct(">4sBQQQI")
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+DiskEntry = namedtuple(
+    "DiskEntry", ["content", "custom_time", "generation", "metageneration"])
+
+
+class MemoryCache():
+    """
+    A thread-safe, in-process LRU cache of downloaded content, bounded by
+    number of entries and total size in bytes.  A single instance is shared
+    by the GCSBucketClient instances of a GCSClient.  Entries are trusted
+    for at most ttl seconds, so that content replaced by other clients is
+    read again from GCS, whatever expiry the caller checks.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024, ttl=60):
+        """
+        :param max_entries: Maximum number of cached entries, defaults to 1000
+        :type max_entries: int (optional)
+        :param max_bytes: Maximum total size of cached content in bytes, or 0
+            for no size limit, defaults to 64 MiB
+        :type max_bytes: int (optional)
+        :param ttl: Number of seconds an entry is kept, or 0 to keep entries
+            until evicted, defaults to 60
+        :type ttl: float (optional)
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()
+        self._deleted = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Return a (content, custom_time) tuple for key, or None if the key is
+        not cached or has been cached for longer than ttl.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self.ttl and time.monotonic() - entry[2] > self.ttl:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[:2]
+
+    def set(self, key, content, custom_time, since=None):
+        """
+        Cache content for key, evicting the least recently used entries as
+        needed.  Content larger than max_bytes is not cached.  Content read
+        at monotonic time since is not cached if the key has been deleted
+        since then, and its ttl starts from since.
+        """
+        size = len(content)
+        now = time.monotonic()
+        with self._lock:
+            deleted = self._deleted.get(key)
+            if since is not None and deleted is not None and deleted >= since:
+                return
+            self._remove(key)
+            if self.max_bytes and size > self.max_bytes:
+                return
+            self._entries[key] = (content, custom_time,
+                                  now if since is None else since)
+            self.size += size
+            while (len(self._entries) > self.max_entries or
+                    (self.max_bytes and self.size > self.max_bytes)):
+                _, (evicted, _, _) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+            # Remember recent deletes, so reads started earlier can't
+            # restore the deleted content
+            self._deleted.pop(key, None)
+            self._deleted[key] = time.monotonic()
+            if len(self._deleted) > self.max_entries:
+                self._deleted.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._deleted.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+
+class DiskCache():
+    """
+    A bounded cache of downloaded content in a local directory, shared by
+    every process on a host that uses the same path.  Entries are written
+    atomically, and the least recently read entries are evicted once the
+    directory holds more than max_bytes.
+    """
+
+    tmp_prefix = ".tmp-"
+
+    def __init__(self, path, max_bytes=1024 * 1024 * 1024, touch_interval=60):
+        """
+        :param path: Directory holding the cached entries
+        :type path: str
+        :param max_bytes: Maximum total size of cached entries in bytes,
+            defaults to 1 GiB
+        :type max_bytes: int (optional)
+        :param touch_interval: Seconds between updates of an entry's last
+            read time, defaults to 60
+        :type touch_interval: int (optional)
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self.size = None
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._scan())
+
+    def get(self, key):
+        """
+        Return a DiskEntry of (content, custom_time, generation,
+        metageneration) for key, or None if the key is not cached.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = self._read(key, f)
+                read_time = os.fstat(f.fileno()).st_mtime
+        except OSError:
+            return None
+        if entry is not None and \
+                time.time() - read_time > self.touch_interval:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return entry
+
+    def set(self, key, content, custom_time, generation=None,
+            metageneration=None):
+        """
+        Cache content for key, evicting the least recently read entries as
+        needed.  Content larger than max_bytes is not cached.
+        """
+        key_bytes = key.encode("utf-8")
+        header = DISK_HEADER.pack(
+            DISK_MAGIC, DISK_VERSION, int(generation or 0),
+            int(metageneration or 0), self._microseconds(custom_time),
+            len(key_bytes))
+        size = len(header) + len(key_bytes) + len(content)
+        if size > self.max_bytes:
+            self.delete(key)
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=self.tmp_prefix,
+                                            dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(header)
+                    f.write(key_bytes)
+                    f.write(content)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as ex:
+            logging.warning("gcs disk cache {}: {}".format(key, ex))
+            return
+        with self._lock:
+            if self.size is not None:
+                self.size += size
+            evict = self.size is None or self.size > self.max_bytes
+        if evict:
+            self.evict()
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for path, _, _ in self._scan():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        with self._lock:
+            self.size = 0
+
+    def evict(self):
+        """
+        Remove the least recently read entries until the cache holds at
+        most 90% of max_bytes, and refresh the total size
+        """
+        entries = sorted(self._scan(), key=lambda entry: entry[2])
+        size = sum(entry_size for _, entry_size, _ in entries)
+        if size > self.max_bytes:
+            low_water = self.max_bytes * 0.9
+            for path, entry_size, _ in entries:
+                if size <= low_water:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                size -= entry_size
+        with self._lock:
+            self.size = size
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, digest[:2], digest)
+
+    def _scan(self):
+        """
+        Return a list of (path, size, last read time) for the cached entries,
+        removing temporary files abandoned by interrupted writes
+        """
+        entries = []
+        now = time.time()
+        try:
+            shards = [shard.path for shard in os.scandir(self.path)
+                      if shard.is_dir()]
+        except OSError:
+            return entries
+        for shard in shards:
+            try:
+                files = list(os.scandir(shard))
+            except OSError:
+                continue
+            for entry in files:
+                try:
+                    stat = entry.stat()
+                    if entry.name.startswith(self.tmp_prefix):
+                        if now - stat.st_mtime > 3600:
+                            os.unlink(entry.path)
+                        continue
+                except OSError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    @staticmethod
+    def _microseconds(custom_time):
+        if custom_time is None:
+            return 0
+        delta = custom_time.replace(tzinfo=timezone.utc) - EPOCH
+        return (delta.days * 86400 + delta.seconds) * 1000000 + \
+            delta.microseconds
+
+    @staticmethod
+    def _read(key, f):
+        header = f.read(DISK_HEADER.size)
+        if len(header) < DISK_HEADER.size:
+            return None
+        magic, version, generation, metageneration, custom_time, length = \
+            DISK_HEADER.unpack(header)
+        if magic != DISK_MAGIC or version != DISK_VERSION:
+            return None
+        if f.read(length) != key.encode("utf-8"):
+            return None  # hash collision
+        return DiskEntry(
+            f.read(),
+            EPOCH + timedelta(microseconds=custom_time)
+            if custom_time else None,
+            generation or None, metageneration or None)
+
+
+class NegativeCache():
+    """
+    A thread-safe, bounded set of keys known to be absent from the bucket,
+    each remembered for ttl seconds.  A single instance is shared by the
+    GCSBucketClient instances of a GCSClient.
+    """
+
+    def __init__(self, ttl=5, max_entries=10000):
+        """
+        :param ttl: Seconds to remember an absent key, defaults to 5
+        :type ttl: int (optional)
+        :param max_entries: Maximum number of absent keys, defaults to 10000
+        :type max_entries: int (optional)
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            expires = self._entries.get(key)
+            if expires is None:
+                return False
+            if expires > time.monotonic():
+                return True
+            del self._entries[key]
+            return False
+
+    def add(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = time.monotonic() + self.ttl
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SingleFlight():
+    """
+    Coalesces concurrent calls for the same key into a single in-flight
+    call, and tracks keys that a caller has claimed to refresh.  A single
+    instance is shared by the GCSBucketClient instances of a GCSClient.
+    """
+
+    def __init__(self, claim_timeout=30):
+        """
+        :param claim_timeout: Seconds after which an unreleased refresh
+            claim lapses, defaults to 30
+        :type claim_timeout: int (optional)
+        """
+        self.claim_timeout = claim_timeout
+        self._calls = {}
+        self._claims = {}
+        self._lock = Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Call fn, or wait for and share the result of a call for key that's
+        already in flight
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def claim(self, key):
+        """
+        Claim the refresh of key, returning False if another caller holds
+        the claim
+        """
+        now = time.monotonic()
+        with self._lock:
+            claimed = self._claims.get(key)
+            if claimed is not None and now - claimed < self.claim_timeout:
+                return False
+            self._claims[key] = now
+            return True
+
+    def release(self, key):
+        with self._lock:
+            self._claims.pop(key, None)
+
+    def is_claimed(self, key):
+        with self._lock:
+            claimed = self._claims.get(key)
+            return (claimed is not None and
+                    time.monotonic() - claimed < self.claim_timeout)
+
+
+class _Call():
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.error = None
@@ -0,0 +1,76 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Codecs for cached content, recorded as the object's content encoding.  The
+zstd and lz4 codecs require the optional zstandard and lz4 packages.
+"""
+
+import gzip
+import zlib
+from io import BytesIO
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+
+def _gzip_compress(content):
+    # A fixed mtime keeps the output identical for identical content.
+    # gzip.compress only accepts mtime from Python 3.8.
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=6,
+                       mtime=0) as f:
+        f.write(content)
+    return buf.getvalue()
+
+
+CODECS = {"gzip": (_gzip_compress, gzip.decompress)}
+
+# Incremental decompressors for streamed content
+DECOMPRESSORS = {"gzip": lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)}
+
+if zstandard is not None:
+    # zstandard compressors aren't thread-safe, so one is created per call
+    CODECS["zstd"] = (
+        lambda content: zstandard.ZstdCompressor().compress(content),
+        lambda content: zstandard.ZstdDecompressor().decompress(content))
+    DECOMPRESSORS["zstd"] = \
+        lambda: zstandard.ZstdDecompressor().decompressobj()
+
+if lz4 is not None:
+    CODECS["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+    DECOMPRESSORS["lz4"] = lz4.frame.LZ4FrameDecompressor
+
+
+def compress(content, encoding):
+    """
+    Compress bytes with the named codec
+    """
+    return CODECS[encoding][0](content)
+
+
+def decompress(content, encoding):
+    """
+    Decompress bytes stored with a content encoding.  Content with no or
+    an unknown encoding is returned unchanged.
+    """
+    if encoding in CODECS:
+        return CODECS[encoding][1](content)
+    return content
+
+
+def decompressor(encoding):
+    """
+    Return an object with a decompress(chunk) method for incrementally
+    decompressing content stored with a content encoding, or None for
+    content with no or an unknown encoding.
+    """
+    if encoding in DECOMPRESSORS:
+        return DECOMPRESSORS[encoding]()
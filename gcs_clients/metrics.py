@@ -0,0 +1,169 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import time
+from threading import Lock
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _NullContext():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_CONTEXT = _NullContext()
+
+
+class MetricsSink():
+    """
+    Receives counters and latencies of cache operations.  The base class
+    discards metrics, and is extended to forward them to a metrics system.
+    Spans are started with an OpenTelemetry-compatible tracer, if given.
+    """
+
+    def __init__(self, tracer=None):
+        """
+        :param tracer: Tracer with a start_as_current_span(name, attributes)
+            method, defaults to None
+        :type tracer: opentelemetry.trace.Tracer (optional)
+        """
+        self.tracer = tracer
+
+    def increment(self, name, value=1, **labels):
+        """
+        Add value to a counter
+        """
+
+    def observe(self, name, value, **labels):
+        """
+        Add a value to a histogram
+        """
+
+    def span(self, name, **attributes):
+        """
+        Return a context manager for a span around an operation
+        """
+        if self.tracer is None:
+            return NULL_CONTEXT
+        return self.tracer.start_as_current_span(name, attributes=attributes)
+
+    def timer(self, name, **labels):
+        """
+        Return a context manager that observes the duration of an operation
+        as name_seconds, counts errors as name_errors_total, and wraps the
+        operation in a span
+        """
+        return _Timer(self, name, labels)
+
+
+class _Timer():
+    def __init__(self, sink, name, labels):
+        self.sink = sink
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.span = self.sink.span(self.name, **self.labels)
+        self.span.__enter__()
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.sink.observe("{}_seconds".format(self.name),
+                          time.monotonic() - self.start, **self.labels)
+        if exc_type is not None:
+            self.sink.increment("{}_errors_total".format(self.name),
+                                **self.labels)
+        return self.span.__exit__(exc_type, exc_value, traceback)
+
+
+class PrometheusMetrics(MetricsSink):
+    """
+    A thread-safe, in-memory MetricsSink, rendered in the Prometheus text
+    exposition format.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, tracer=None):
+        """
+        :param buckets: Upper bounds of histogram buckets, defaults to
+            DEFAULT_BUCKETS
+        :type buckets: tuple of float (optional)
+        """
+        super().__init__(tracer=tracer)
+        self.buckets = tuple(sorted(buckets))
+        self._counters = {}
+        self._histograms = {}
+        self._lock = Lock()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [
+                    [0] * len(self.buckets), 0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def get(self, name, **labels):
+        """
+        Return the value of a counter, or the number of values observed by
+        a histogram
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key][2]
+            return self._counters.get(key, 0)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {} counter".format(name))
+            lines.append("{}{} {}".format(name, _labels(labels), value))
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {} histogram".format(name))
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append("{}_bucket{} {}".format(
+                    name, _labels(labels + (("le", bound),)), bucket_count))
+            lines.append("{}_bucket{} {}".format(
+                name, _labels(labels + (("le", "+Inf"),)), count))
+            lines.append("{}_sum{} {}".format(name, _labels(labels), total))
+            lines.append("{}_count{} {}".format(name, _labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(",".join('{}="{}"'.format(
+        name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels))
@@ -0,0 +1,146 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud.storage.retry import DEFAULT_RETRY
+from threading import Event, Lock
+
+_SKIPPED = object()
+
+
+class ReadPolicy():
+    """
+    Retry and hedging of cache reads.  Failed reads are retried with
+    exponential backoff and full jitter until deadline seconds have passed.
+    With hedging, the first request is made on the calling thread, and a
+    second request is made from a separate pool if the first hasn't
+    completed after the hedge_percentile latency of recent reads.  The
+    second result is used if the first request fails.  A single instance is
+    shared by the GCSBucketClient instances of a GCSClient.
+    """
+
+    def __init__(self, deadline=None, initial=0.1, maximum=1.0,
+                 multiplier=2, hedge=False, hedge_percentile=95,
+                 hedge_delay=0.1, window=1000, min_samples=20, workers=4):
+        """
+        :param deadline: Seconds to retry failed reads for, 0 to disable
+            retries, or None for the google-cloud-storage default (the
+            default)
+        :type deadline: float (optional)
+        :param initial: Maximum delay before the first retry, defaults to 0.1
+        :type initial: float (optional)
+        :param maximum: Maximum delay between retries, defaults to 1
+        :type maximum: float (optional)
+        :param multiplier: Multiplier of the delay after each retry, defaults
+            to 2
+        :type multiplier: float (optional)
+        :param hedge: Whether to hedge slow reads, defaults to False
+        :type hedge: bool (optional)
+        :param hedge_percentile: Percentile of recent read latencies after
+            which a read is hedged, defaults to 95
+        :type hedge_percentile: float (optional)
+        :param hedge_delay: Minimum seconds before a read is hedged, also
+            used until min_samples reads have completed, defaults to 0.1
+        :type hedge_delay: float (optional)
+        :param window: Number of recent read latencies kept, defaults to 1000
+        :type window: int (optional)
+        :param min_samples: Number of reads between updates of the hedge
+            delay, defaults to 20
+        :type min_samples: int (optional)
+        :param workers: Number of threads making hedged reads, defaults to 4
+        :type workers: int (optional)
+        """
+        self.deadline = deadline
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.min_samples = min_samples
+        self.workers = workers
+        self.retry = self._retry()
+        self.hedged = 0
+        self._delay = hedge_delay
+        self._latencies = deque(maxlen=window)
+        self._samples = 0
+        self._executor = None
+        self._lock = Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _retry(self):
+        """
+        The google.api_core Retry for reads, or None to disable retries
+        """
+        if self.deadline is None:
+            return DEFAULT_RETRY
+        if not self.deadline:
+            return None
+        return DEFAULT_RETRY.with_deadline(self.deadline).with_delay(
+            initial=self.initial, maximum=self.maximum,
+            multiplier=self.multiplier)
+
+    def delay(self):
+        """
+        The number of seconds after which a read is hedged
+        """
+        return self._delay
+
+    def record(self, latency):
+        """
+        Record the latency of a successful read
+        """
+        with self._lock:
+            self._latencies.append(latency)
+            self._samples += 1
+            if self._samples >= self.min_samples:
+                self._samples = 0
+                latencies = sorted(self._latencies)
+                index = min(int(len(latencies) * self.hedge_percentile / 100),
+                            len(latencies) - 1)
+                self._delay = max(latencies[index], self.hedge_delay)
+
+    def call(self, fn, *args):
+        """
+        Call fn, hedged if enabled, recording the latency of the result
+        """
+        if not self.hedge:
+            return self._timed(fn, *args)
+        done = Event()
+        hedge = self.executor.submit(
+            self._hedge, done, time.monotonic() + self.delay(), fn, *args)
+        try:
+            result = self._timed(fn, *args)
+        except Exception:
+            done.set()
+            if hedge.cancel() or hedge.exception() is not None or \
+                    hedge.result() is _SKIPPED:
+                raise
+            return hedge.result()
+        done.set()
+        return result
+
+    def _hedge(self, done, start, fn, *args):
+        """
+        Call fn unless the first request completes before start, including
+        while waiting for a free thread
+        """
+        if done.wait(max(start - time.monotonic(), 0)):
+            return _SKIPPED
+        with self._lock:
+            self.hedged += 1
+        return self._timed(fn, *args)
+
+    def _timed(self, fn, *args):
+        start = time.monotonic()
+        result = fn(*args)
+        self.record(time.monotonic() - start)
+        return result
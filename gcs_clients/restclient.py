@@ -1,63 +1,169 @@
 # Copyright 2021 UW-IT, University of Washington
 # SPDX-License-Identifier: Apache-2.0
 
+import hashlib
 import logging
 import json
 import os
+import struct
 from commonconf import settings
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from gcs_clients import GCSClient
+from gcs_clients.base import is_fresh
+from gcs_clients.breaker import CircuitOpenError
 from google.api_core.exceptions import GoogleAPIError
-from urllib.parse import urlparse
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+# Framed cache payloads start with a fixed header of magic bytes, format
+# version and header block length
+PAYLOAD_MAGIC = b"GCSC"
+PAYLOAD_VERSION = 1
+PAYLOAD_HEADER = struct.Struct(">4sBI")
+
+# Number of hex digits in the shard prefix of hashed keys
+KEY_SHARD_LENGTH = 4
 
 
 class CachedHTTPResponse():
     """
-    Represents an HTTPResponse, implementing methods as needed.
+    Represents an HTTPResponse, implementing methods as needed.  The body
+    of a framed cache payload is kept as a memoryview of the downloaded
+    content, and only copied to bytes when data is read.  A response backed
+    by a stream reads the body as it's consumed.
     """
+    __slots__ = ("status", "_headers", "_data", "_stream", "_lower_headers",
+                 "_offset")
+
     def __init__(self, **kwargs):
         self.headers = kwargs.get("headers", {})
         self.status = kwargs.get("status")
-        self.data = kwargs.get("data")
+        self._data = kwargs.get("data")
+        self._stream = kwargs.get("stream")
+        self._offset = 0
+
+    @property
+    def headers(self):
+        return self._headers
+
+    @headers.setter
+    def headers(self, value):
+        self._headers = value
+        self._lower_headers = None
+
+    @property
+    def data(self):
+        if self._stream is not None:
+            self._data = self._stream.read()
+            self.close()
+        if isinstance(self._data, memoryview):
+            self._data = self._data.tobytes()
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._offset = 0
+
+    @property
+    def body(self):
+        """
+        The response body as a memoryview, without copying
+        """
+        if self._stream is None and isinstance(self._data, memoryview):
+            return self._data
+        data = self.data
+        if isinstance(data, (bytes, bytearray)):
+            return memoryview(data)
+        return data
 
-    def read(self):
-        return self.data
+    def read(self, amt=None):
+        """
+        Read up to amt bytes of the body, or the rest of it, returning an
+        empty value once the body has been read
+        """
+        if amt is not None and self._stream is not None:
+            return self._stream.read(amt)
+        data = self.data
+        if not isinstance(data, (bytes, bytearray, str)):
+            # Other bodies, e.g. decoded data, are only read whole
+            return data if amt is None else b""
+        end = len(data) if amt is None else self._offset + amt
+        chunk = data[self._offset:end]
+        self._offset += len(chunk)
+        return chunk
+
+    def stream(self, amt=2 ** 16):
+        """
+        Yield the body in chunks of up to amt bytes
+        """
+        if self._stream is not None:
+            while True:
+                chunk = self._stream.read(amt)
+                if not chunk:
+                    break
+                yield chunk
+            self.close()
+        elif self.data:
+            yield self.data
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
 
     def getheader(self, val, default=''):
-        for header in self.headers:
-            if val.lower() == header.lower():
-                return self.headers[header]
-        return default
+        if self._lower_headers is None:
+            self._lower_headers = {
+                header.lower(): value
+                for header, value in self.headers.items()
+            } if hasattr(self.headers, "items") else {}
+        return self._lower_headers.get(val.lower(), default)
 
 
-class RestclientGCSClient(GCSClient):
+def split_shard(path):
+    """
+    Return the url path and query of a hashed key's path, without its
+    shard prefix, or None if the path has no valid shard prefix
+    """
+    shard, _, path = path.partition("/")
+    if shard == hashlib.sha256("?".join(path.partition("?")[::2]).encode(
+            "utf-8")).hexdigest()[:KEY_SHARD_LENGTH]:
+        return path
+
 
-    def getCache(self, service, url, headers=None):
-        expire = self.get_cache_expiration_time(service, url)
-        if expire is not None:
-            data = self.get(self._create_key(service, url,
-                                             base_path=self.get_base_path()),
-                            expire=expire,)
-            if data:
-                parsed_data = json.loads(data)
-                return {"response": CachedHTTPResponse(**parsed_data)}
+def parse_cache_control(value):
+    """
+    Parse a Cache-Control header into a dict of lower case directives
+    """
+    directives = {}
+    for directive in (value or "").split(","):
+        name, _, argument = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
 
-    def deleteCache(self, service, url):
-        return self.delete(self._create_key(service, url,
-                                            base_path=self.get_base_path()))
 
-    def updateCache(self, service, url, response):
-        expire = self.get_cache_expiration_time(service, url, response.status)
-        if expire is not None:
-            key = self._create_key(service, url,
-                                   base_path=self.get_base_path())
-            data = self._format_data(response)
-            try:
-                # Bypass the shim client to log the original URL if needed.
-                self.client.set(key, data, expire=expire)
-            except (GoogleAPIError, ConnectionError) as ex:
-                logging.error("gcs set: {}, url: {}".format(ex, url))
+def parse_http_date(value):
+    """
+    Parse an HTTP date header, or return None if missing or invalid
+    """
+    if value:
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        return date
 
-    processResponse = updateCache
+
+class RestclientCachePolicy():
+    """
+    Cache key, expiry and payload format shared by the restclients cache
+    implementations.
+    """
 
     def get_cache_expiration_time(self, service, url, status=None):
         """
@@ -69,6 +175,51 @@ class RestclientGCSClient(GCSClient):
         """
         return getattr(settings, "RESTCLIENTS_GCS_DEFAULT_EXPIRY", 0)
 
+    def get_cache_grace_time(self, service, url):
+        """
+        Overridable method for setting the number of seconds per service and
+        url that expired responses may be returned as stale while being
+        refreshed.  Zero disables stale responses.
+        """
+        return getattr(settings, "RESTCLIENTS_GCS_DEFAULT_GRACE", 0)
+
+    def use_cache_headers(self, service, url):
+        """
+        Overridable method for enabling per service and url the expiry of
+        responses by their Cache-Control, Expires and Last-Modified headers,
+        and the revalidation of expired responses by conditional requests
+        """
+        return getattr(settings, "RESTCLIENTS_GCS_CACHE_HEADERS", False)
+
+    def get_cache_header_expiration_time(self, service, url, response):
+        """
+        Overridable method for deriving the number of seconds a response may
+        be cached from its headers.  Valid return values are:
+          * Number of seconds until the item is expired from the cache,
+          * Zero, if the item must be revalidated before use,
+          * None, if the headers don't set an expiry.
+        """
+        directives = parse_cache_control(response.getheader("Cache-Control"))
+        if "no-cache" in directives:
+            return 0
+        for directive in ("s-maxage", "max-age"):
+            try:
+                return max(int(directives[directive]), 0)
+            except (KeyError, TypeError, ValueError):
+                pass
+        date = parse_http_date(response.getheader("Date")) or \
+            datetime.now(timezone.utc)
+        expires = response.getheader("Expires")
+        if expires:
+            expires = parse_http_date(expires)
+            if expires is None:
+                return 0  # invalid dates are in the past
+            return max(int((expires - date).total_seconds()), 0)
+        last_modified = parse_http_date(response.getheader("Last-Modified"))
+        if last_modified is not None:
+            # A heuristic of 10% of the time since modification
+            return max(int((date - last_modified).total_seconds() / 10), 0)
+
     def get_base_path(self):
         """
         Overridable method for setting the base path to be appended to
@@ -77,27 +228,475 @@ class RestclientGCSClient(GCSClient):
         return os.getenv("GCS_BASE_PATH", default='')
 
     @staticmethod
-    def _create_key(service, url, base_path=''):
+    def _create_key(service, url, base_path='', hashed=None):
+        """
+        Create the object name for a url.  Hashed keys, enabled by
+        RESTCLIENTS_GCS_HASHED_KEYS, sort the query parameters, replace
+        queries longer than RESTCLIENTS_GCS_MAX_QUERY_LENGTH with their
+        hash, and prefix the url with a hash-derived shard, spreading
+        similar urls over the bucket's key ranges.
+        """
+        if hashed is None:
+            hashed = getattr(settings, "RESTCLIENTS_GCS_HASHED_KEYS", False)
         parsed = urlparse(url)
         base_path = base_path.strip("/")
         parsed_url_path = parsed.path.lstrip("/")
-        path = "/".join([base_path, service, parsed_url_path]).lstrip("/")
         query = parsed.query
+        if hashed:
+            # Sort by name, keeping the order of repeated parameters
+            query = urlencode(sorted(
+                parse_qsl(query, keep_blank_values=True),
+                key=lambda param: param[0]))
+            if len(query) > getattr(
+                    settings, "RESTCLIENTS_GCS_MAX_QUERY_LENGTH", 256):
+                query = "sha256={}".format(
+                    hashlib.sha256(query.encode("utf-8")).hexdigest())
+            shard = hashlib.sha256("?".join([
+                parsed_url_path, query]).encode("utf-8")).hexdigest()
+            parsed_url_path = "/".join([
+                shard[:KEY_SHARD_LENGTH], parsed_url_path])
+        path = "/".join([base_path, service, parsed_url_path]).lstrip("/")
         if path and query:
             url_key = "?".join([path, query])
         else:
             url_key = path
         return url_key
 
+    def _create_read_keys(self, service, url):
+        """
+        Return the keys to read a url from, in order: its key, followed by
+        its legacy key while hashed keys are being migrated to
+        """
+        base_path = self.get_base_path()
+        keys = [self._create_key(service, url, base_path=base_path)]
+        if getattr(settings, "RESTCLIENTS_GCS_HASHED_KEYS", False) and \
+                getattr(settings, "RESTCLIENTS_GCS_LEGACY_KEYS", True):
+            legacy_key = self._create_key(service, url, base_path=base_path,
+                                          hashed=False)
+            if legacy_key != keys[0]:
+                keys.append(legacy_key)
+        return keys
+
     @staticmethod
     def _format_data(response):
+        """
+        Frame a response as a versioned header block of the status and
+        headers, followed by the raw body bytes
+        """
         # This step is needed because HTTPHeaderDict isn't serializable
         headers = {}
         if response.headers is not None:
             for header in response.headers:
                 headers[header] = response.getheader(header)
-        return json.dumps({
+        header_block = json.dumps({
             "status": response.status,
             "headers": headers,
-            "data": response.data.decode('utf-8')
-        })
+        }).encode("utf-8")
+        body = response.data
+        if body is None:
+            body = b""
+        elif isinstance(body, str):
+            body = body.encode("utf-8")
+        return b"".join([
+            PAYLOAD_HEADER.pack(PAYLOAD_MAGIC, PAYLOAD_VERSION,
+                                len(header_block)),
+            header_block, body])
+
+    @staticmethod
+    def _parse_data(data):
+        """
+        Parse a framed payload, or a JSON payload written by an earlier
+        version
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)) and \
+                bytes(data[:len(PAYLOAD_MAGIC)]) == PAYLOAD_MAGIC:
+            _, version, length = PAYLOAD_HEADER.unpack_from(data)
+            if version != PAYLOAD_VERSION:
+                raise ValueError(
+                    "Unsupported cache payload version: {}".format(version))
+            view = memoryview(data)
+            start = PAYLOAD_HEADER.size
+            kwargs = json.loads(view[start:start + length].tobytes())
+            kwargs["data"] = view[start + length:]
+            return {"response": CachedHTTPResponse(**kwargs)}
+        return {"response": CachedHTTPResponse(**json.loads(data))}
+
+    @classmethod
+    def _parse_stream(cls, stream):
+        """
+        Parse a framed payload from a file-like stream, leaving the body to
+        be read from the stream
+        """
+        prefix = stream.read(PAYLOAD_HEADER.size)
+        if prefix[:len(PAYLOAD_MAGIC)] != PAYLOAD_MAGIC:
+            # A JSON payload written by an earlier version
+            data = prefix + stream.read()
+            stream.close()
+            return cls._parse_data(data)
+        _, version, length = PAYLOAD_HEADER.unpack(prefix)
+        if version != PAYLOAD_VERSION:
+            stream.close()
+            raise ValueError(
+                "Unsupported cache payload version: {}".format(version))
+        kwargs = json.loads(stream.read(length))
+        kwargs["stream"] = stream
+        return {"response": CachedHTTPResponse(**kwargs)}
+
+
+class RestclientGCSClient(RestclientCachePolicy, GCSClient):
+
+    def __init__(self):
+        super().__init__()
+        self._refresh_executor = None
+
+    @property
+    def refresh_executor(self):
+        """
+        The thread pool shared by all threads for background refreshes of
+        stale responses, kept apart from the bulk operation pool so that
+        slow upstream requests can't hold up bulk operations
+        """
+        with self._lock:
+            if self._refresh_executor is None:
+                self._refresh_executor = ThreadPoolExecutor(
+                    max_workers=getattr(
+                        settings, "RESTCLIENTS_GCS_REFRESH_WORKERS", 2))
+            return self._refresh_executor
+
+    def getCache(self, service, url, headers=None, fetch=None):
+        """
+        Get a cached response.  If fetch is given, a response that expired
+        less than get_cache_grace_time seconds ago is returned flagged as
+        stale, and a single background refresh calls fetch() for a new
+        response to cache.
+        """
+        if self.metrics is None:
+            return self._getCache(service, url, fetch)
+        with self.metrics.timer("restclient_cache", operation="getCache",
+                                service=service):
+            cached = self._getCache(service, url, fetch)
+        if cached is None:
+            result = "miss"
+        else:
+            result = "stale" if cached.get("stale") else "hit"
+        self.metrics.increment("restclient_cache_requests_total",
+                               service=service, result=result)
+        return cached
+
+    def _getCache(self, service, url, fetch):
+        expire = self.get_cache_expiration_time(service, url)
+        if expire is not None:
+            for key in self._create_read_keys(service, url):
+                if self.use_cache_headers(service, url):
+                    cached = self._getCacheByHeaders(service, url, key,
+                                                     expire, fetch)
+                else:
+                    cached = self._getCacheByKey(service, url, key, expire,
+                                                 fetch)
+                if cached:
+                    return cached
+
+    def _getCacheByKey(self, service, url, key, expire, fetch):
+        grace = self.get_cache_grace_time(service, url) if fetch else 0
+        if expire and grace:
+            data, stale = self.get_stale(
+                key, expire=expire, grace=grace) or (None, False)
+            if stale and self.claimRefresh(service, url):
+                self.refresh_executor.submit(
+                    self._refresh, service, url, fetch)
+        else:
+            data, stale = self.get(key, expire=expire), False
+        if data:
+            cached = self._parse_data(data)
+            if stale:
+                cached["stale"] = True
+            return cached
+
+    def _getCacheByHeaders(self, service, url, key, expire, fetch):
+        """
+        Get a cached response, expired by its cache headers, or by expire
+        if the headers don't set an expiry
+        """
+        data, custom_time = self.get_entry(key) or (None, None)
+        if not data:
+            return None
+        cached = self._parse_data(data)
+        max_age = self.get_cache_header_expiration_time(
+            service, url, cached["response"])
+        if max_age is None:
+            max_age = expire
+            fresh = is_fresh(custom_time, expire)
+        else:
+            fresh = max_age > 0 and is_fresh(custom_time, max_age)
+        if fresh:
+            return cached
+        grace = self.get_cache_grace_time(service, url) if fetch else 0
+        if max_age and grace and is_fresh(custom_time, max_age + grace):
+            if self.claimRefresh(service, url):
+                self.refresh_executor.submit(
+                    self._refresh, service, url, fetch)
+            cached["stale"] = True
+            return cached
+
+    def getCacheValidators(self, service, url):
+        """
+        Return the conditional request headers for revalidating a cached
+        response with the upstream service, from its ETag and Last-Modified
+        headers, whether or not the response has expired.  Pass a 304 Not
+        Modified response to updateCache to restart the cached response's
+        expiry.
+        """
+        validators = {}
+        for key in self._create_read_keys(service, url):
+            data, _ = self.get_entry(key) or (None, None)
+            if data:
+                break
+        if data:
+            response = self._parse_data(data)["response"]
+            for header, validator in (("ETag", "If-None-Match"),
+                                      ("Last-Modified", "If-Modified-Since")):
+                value = response.getheader(header, None)
+                if value:
+                    validators[validator] = value
+        return validators
+
+    def getCacheStream(self, service, url, headers=None):
+        """
+        Get a cached response backed by a stream, which downloads the body
+        in chunks as it's read
+        """
+        expire = self.get_cache_expiration_time(service, url)
+        if expire is not None:
+            for key in self._create_read_keys(service, url):
+                stream = self.get_stream(key, expire=expire)
+                if stream is not None:
+                    return self._parse_stream(stream)
+
+    def getCacheMany(self, service, urls, headers=None):
+        """
+        Concurrently get cached responses for multiple urls, returning a dict
+        of {"response": CachedHTTPResponse} (or None) by url.
+        """
+        keys, expires = {}, {}
+        for url in urls:
+            expire = self.get_cache_expiration_time(service, url)
+            if expire is not None:
+                keys[url] = self._create_read_keys(service, url)
+                expires[keys[url][0]] = expire
+        try:
+            data, errors = self._guarded(
+                self.client.get_many, list(expires), expire=expires)
+            # Read the legacy keys of missing urls
+            legacy = {url_keys[1]: expires[url_keys[0]]
+                      for url_keys in keys.values() if len(url_keys) > 1
+                      and not data.get(url_keys[0])}
+            if legacy:
+                legacy_data, legacy_errors = self._guarded(
+                    self.client.get_many, list(legacy), expire=legacy)
+                data.update(legacy_data)
+                errors.update(legacy_errors)
+        except CircuitOpenError:
+            data, errors = {}, {}
+        cached = {}
+        for url in urls:
+            cached[url] = None
+            for key in keys.get(url, []):
+                if key in errors:
+                    logging.error("gcs get: {}, url: {}".format(
+                        errors[key], url))
+                if data.get(key):
+                    cached[url] = self._parse_data(data[key])
+                    break
+        return cached
+
+    def deleteCache(self, service, url):
+        keys = self._create_read_keys(service, url)
+        if len(keys) > 1:
+            # Remove any legacy copy, which may not exist
+            try:
+                self._guarded(self.client.delete_many, keys[1:])
+            except CircuitOpenError:
+                pass
+        return self.delete(keys[0])
+
+    def updateCache(self, service, url, response):
+        """
+        Cache a response.  With cache headers enabled, a 304 Not Modified
+        response restarts the expiry of the cached response without
+        uploading it again.
+        """
+        if self.metrics is None:
+            return self._updateCache(service, url, response)
+        with self.metrics.timer("restclient_cache", operation="updateCache",
+                                service=service):
+            self._updateCache(service, url, response)
+
+    def _updateCache(self, service, url, response):
+        expire = self._get_update_expiration_time(service, url, response)
+        if expire is not None:
+            key = self._create_key(service, url,
+                                   base_path=self.get_base_path())
+            try:
+                if self._is_not_modified(service, url, response):
+                    self._guarded(self.client.touch, key)
+                elif self.write_behind is not None:
+                    self.write_behind.put(
+                        key, self._format_data(response), expire=expire)
+                else:
+                    # Bypass the shim client to log the original URL if
+                    # needed.
+                    self._guarded(self.client.set, key,
+                                  self._format_data(response), expire=expire)
+            except CircuitOpenError:
+                pass  # dropped while GCS is unavailable
+            except (GoogleAPIError, ConnectionError) as ex:
+                logging.error("gcs set: {}, url: {}".format(ex, url))
+            finally:
+                self.single_flight.release(key)
+        else:
+            self.releaseRefresh(service, url)
+
+    processResponse = updateCache
+
+    def _get_update_expiration_time(self, service, url, response):
+        if self.use_cache_headers(service, url):
+            if response.status == 304:
+                return self.get_cache_expiration_time(service, url)
+            if "no-store" in parse_cache_control(
+                    response.getheader("Cache-Control")):
+                return None
+        return self.get_cache_expiration_time(service, url, response.status)
+
+    def _is_not_modified(self, service, url, response):
+        return response.status == 304 and self.use_cache_headers(service, url)
+
+    def _refresh(self, service, url, fetch):
+        try:
+            response = fetch()
+        except Exception as ex:
+            logging.error("gcs refresh: {}, url: {}".format(ex, url))
+            response = None
+        if response is not None:
+            self.updateCache(service, url, response)
+        else:
+            self.releaseRefresh(service, url)
+
+    def claimRefresh(self, service, url):
+        """
+        Claim the upstream refresh of a url, returning False if another
+        thread already has a refresh in progress.  The claim is released by
+        updateCache or releaseRefresh.
+        """
+        return self.single_flight.claim(
+            self._create_key(service, url, base_path=self.get_base_path()))
+
+    def releaseRefresh(self, service, url):
+        """
+        Release a refresh claim without updating the cache, e.g. when the
+        upstream request fails
+        """
+        self.single_flight.release(self._create_key(
+            service, url, base_path=self.get_base_path()))
+
+    def deleteCacheMany(self, service, urls):
+        """
+        Delete cached responses for multiple urls using batch requests
+        """
+        keys, legacy_keys = {}, []
+        for url in urls:
+            url_keys = self._create_read_keys(service, url)
+            keys[url_keys[0]] = url
+            legacy_keys.extend(url_keys[1:])
+        try:
+            errors = self._guarded(self.client.delete_many, list(keys))
+            if legacy_keys:
+                # Legacy copies may not exist
+                self._guarded(self.client.delete_many, legacy_keys)
+        except CircuitOpenError:
+            return
+        for key, ex in errors.items():
+            logging.error("gcs delete: {}, url: {}".format(ex, keys[key]))
+
+    def _get_prefix(self, service=None):
+        """
+        Return the object name prefix of the base path, or of a service's
+        responses
+        """
+        parts = [self.get_base_path().strip("/"), service]
+        prefix = "/".join(part for part in parts if part)
+        return prefix + "/" if prefix else prefix
+
+    def sweep_expired(self, expire, service=None, page_size=1000):
+        """
+        Delete the cached responses under the base path, or a service's
+        cached responses, that expired more than expire seconds ago.
+        Returns a dict of counts, see GCSBucketClient.sweep.  Raises
+        ValueError unless expire is a positive number of seconds, as an
+        expiry of 0 means that responses never expire.
+        """
+        if not (expire and expire > 0):
+            raise ValueError(
+                "expire must be a positive number of seconds: {}".format(
+                    expire))
+        return self._guarded(self.client.sweep, self._get_prefix(service),
+                             expire=expire, page_size=page_size)
+
+    def invalidate_prefix(self, service, url_prefix, page_size=1000):
+        """
+        Delete a service's cached responses for urls starting with
+        url_prefix, e.g. "/api/v1/person/".  Returns a dict of counts, see
+        GCSBucketClient.sweep.
+        """
+        prefix = self._create_key(service, url_prefix,
+                                  base_path=self.get_base_path(),
+                                  hashed=False)
+        if not getattr(settings, "RESTCLIENTS_GCS_HASHED_KEYS", False):
+            return self._guarded(self.client.sweep, prefix,
+                                 page_size=page_size, all=True)
+
+        # Hashed keys aren't ordered by url, so match every key of the
+        # service against the url prefix
+        service_prefix = self._get_prefix(service)
+        path_prefix = prefix[len(service_prefix):]
+        legacy = getattr(settings, "RESTCLIENTS_GCS_LEGACY_KEYS", True)
+
+        def match(name):
+            path = name[len(service_prefix):]
+            if legacy and path.startswith(path_prefix):
+                return True
+            path = split_shard(path)
+            return path is not None and path.startswith(path_prefix)
+
+        return self._guarded(self.client.sweep, service_prefix, match=match,
+                             page_size=page_size, all=True)
+
+    def updateCacheMany(self, service, responses):
+        """
+        Concurrently update the cache for a dict of responses by url
+        """
+        items, urls = {}, {}
+        for url, response in responses.items():
+            expire = self._get_update_expiration_time(service, url, response)
+            if expire is not None:
+                key = self._create_key(service, url,
+                                       base_path=self.get_base_path())
+                if self._is_not_modified(service, url, response):
+                    try:
+                        self._guarded(self.client.touch, key)
+                    except CircuitOpenError:
+                        pass
+                    except (GoogleAPIError, ConnectionError) as ex:
+                        logging.error("gcs set: {}, url: {}".format(ex, url))
+                    continue
+                items[key] = self._format_data(response)
+                urls[key] = url
+        if self.write_behind is not None:
+            for key, data in items.items():
+                self.write_behind.put(key, data)
+            return
+        try:
+            errors = self._guarded(self.client.set_many, items)
+        except CircuitOpenError:
+            return  # dropped while GCS is unavailable
+        for key, ex in errors.items():
+            logging.error("gcs set: {}, url: {}".format(ex, urls[key]))
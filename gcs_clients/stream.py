@@ -0,0 +1,82 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import io
+from gcs_clients.codec import decompressor
+
+
+class CacheStream(io.BufferedIOBase):
+    """
+    A file-like reader of cached content, downloading byte ranges of a
+    single object generation as they're read, so that memory use is bounded
+    by the chunk size rather than the object size.  Iterating yields chunks
+    of content.
+    """
+
+    def __init__(self, blob, chunk_size=1024 * 1024, timeout=5):
+        """
+        :param blob: Blob with loaded metadata, for the generation to read
+        :type blob: google.cloud.storage.Blob
+        :param chunk_size: Number of bytes per download, defaults to 1 MiB
+        :type chunk_size: int (optional)
+        :param timeout: Request timeout in seconds, defaults to 5
+        :type timeout: int (optional)
+        """
+        self.blob = blob
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.custom_time = blob.custom_time
+        self._decompressor = decompressor(blob.content_encoding)
+        self._offset = 0
+        self._buffer = b""
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        while not self._buffer and not self._eof:
+            if self._offset >= (self.blob.size or 0):
+                self._eof = True
+                flush = getattr(self._decompressor, "flush", None)
+                if flush is not None:
+                    self._buffer = flush()
+                break
+            end = min(self._offset + self.chunk_size, self.blob.size) - 1
+            chunk = self.blob.download_as_bytes(
+                start=self._offset, end=end, raw_download=True,
+                if_generation_match=self.blob.generation, checksum=None,
+                timeout=self.timeout)
+            if not chunk:
+                raise IOError("Unexpected end of {}".format(self.blob.name))
+            self._offset += len(chunk)
+            if self._decompressor is not None:
+                chunk = self._decompressor.decompress(chunk)
+            self._buffer = chunk
+
+    def read1(self, size=-1):
+        self._checkClosed()
+        self._fill()
+        if size is None or size < 0 or size >= len(self._buffer):
+            chunk, self._buffer = self._buffer, b""
+        else:
+            chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+    def read(self, size=-1):
+        chunks = []
+        while size is None or size < 0 or size > 0:
+            chunk = self.read1(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if size is not None and size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read1()
+            if not chunk:
+                return
+            yield chunk
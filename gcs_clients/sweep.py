@@ -0,0 +1,60 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Delete expired cached responses under the GCS_BASE_PATH, or under a
+service:
+
+    python -m gcs_clients.sweep [--conf FILE] --expire SECONDS [--service NAME]
+
+Or delete a service's cached responses for urls starting with a prefix:
+
+    python -m gcs_clients.sweep [--conf FILE] --service NAME
+        --invalidate URL_PREFIX
+
+Settings are read from the [GCS] section of the --conf file, or else from
+Django settings.
+"""
+
+import argparse
+import json
+from commonconf.backends import use_configparser_backend
+from gcs_clients.restclient import RestclientGCSClient
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conf", help="settings file for the cache client")
+    parser.add_argument("--service", help="service name")
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument("--expire", type=int,
+                        help="delete responses cached more than this many "
+                             "seconds ago")
+    action.add_argument("--invalidate", metavar="URL_PREFIX",
+                        help="delete responses for urls starting with this "
+                             "prefix")
+    parser.add_argument("--page-size", type=int, default=1000,
+                        help="objects listed per request")
+    args = parser.parse_args(args)
+    if args.invalidate is not None and not args.service:
+        parser.error("--invalidate requires --service")
+    if args.expire is not None and args.expire <= 0:
+        parser.error("--expire must be a positive number of seconds")
+    if args.conf:
+        use_configparser_backend(args.conf, "GCS")
+
+    client = RestclientGCSClient()
+    if args.invalidate is not None:
+        counts = client.invalidate_prefix(args.service, args.invalidate,
+                                          page_size=args.page_size)
+    else:
+        counts = client.sweep_expired(args.expire, service=args.service,
+                                      page_size=args.page_size)
+    print(json.dumps(counts, sort_keys=True))
+    return counts
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+A minimal, in-process stand-in for the GCS JSON API, for testing clients
+against a real HTTP endpoint.
+"""
+
+import base64
+import hashlib
+import json
+import random
+import re
+import sys
+import time
+import uuid
+import google_crc32c
+from datetime import datetime, timezone
+from email.parser import Parser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+
+def _b64(digest):
+    return base64.b64encode(digest).decode("utf-8")
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Ignore clients closing their pooled connections
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeGCSServer():
+    """
+    Serves objects for any bucket name from an in-memory dict of
+    {name: (metadata, content)}, optionally delaying every response by
+    latency plus up to jitter seconds, and answering a proportion
+    error_rate of requests with a 503 error.
+    """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.errors = 0
+        self._random = random.Random(seed)
+        self.objects = {}
+        self.uploads = {}
+        self.requests = []
+        self._lock = Lock()
+        self._generation = int(time.time() * 1000000)
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGCSHandler)
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self._server.server_port)
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever,
+                              kwargs={"poll_interval": 0.05}, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def put(self, bucket, name, content, metadata=None):
+        """
+        Store an object, returning its metadata
+        """
+        with self._lock:
+            self._generation += 1
+            metadata = dict(metadata or {})
+            metadata.update({
+                "kind": "storage#object",
+                "bucket": bucket,
+                "name": name,
+                "id": "{}/{}/{}".format(bucket, name, self._generation),
+                "generation": str(self._generation),
+                "metageneration": "1",
+                "size": str(len(content)),
+                "md5Hash": _b64(hashlib.md5(content).digest()),
+                "crc32c": _b64(google_crc32c.Checksum(content).digest()),
+                "updated": datetime.now(timezone.utc).isoformat().replace(
+                    "+00:00", "Z"),
+                "mediaLink": "{}/download/storage/v1/b/{}/o/{}?alt=media"
+                             "&generation={}".format(
+                                 self.url, bucket, quote(name, safe=""),
+                                 self._generation),
+            })
+            metadata.setdefault("contentType", "application/octet-stream")
+            self.objects[name] = (metadata, content)
+            return metadata
+
+    def patch(self, name, changes):
+        with self._lock:
+            metadata, content = self.objects[name]
+            metadata = dict(metadata, **changes)
+            metadata["metageneration"] = str(
+                int(metadata["metageneration"]) + 1)
+            self.objects[name] = (metadata, content)
+            return metadata
+
+    def inject(self):
+        """
+        Wait for the injected latency, returning True if the request should
+        fail with an injected error
+        """
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if delay:
+            time.sleep(delay)
+        return failed
+
+
+class FakeGCSHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send responses without waiting for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def _route(self):
+        """
+        Parse the request, returning False if an injected error response
+        has been sent
+        """
+        parsed = urlparse(self.path)
+        self.query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        path = parsed.path
+        for prefix in ("/download", "/upload"):
+            if path.startswith(prefix):
+                path = path[len(prefix):]
+        self.fake.requests.append((self.command, parsed.path))
+        # /storage/v1/b/{bucket}[/o[/{name}]]
+        parts = path.split("/")
+        self.is_bucket = len(parts) == 5
+        self.bucket = unquote(parts[4]) if len(parts) > 4 else None
+        self.action = None
+        if len(parts) > 7:
+            self.action = parts.pop()
+        self.name = unquote("/".join(parts[6:])) if len(parts) > 6 else None
+        length = int(self.headers.get("Content-Length") or 0)
+        self.body = self.rfile.read(length) if length else b""
+        if self.fake.inject():
+            self._error(503, "Injected error")
+            return False
+        return True
+
+    def _send(self, status, body=b"", headers=None):
+        if isinstance(body, dict):
+            body = json.dumps(body).encode("utf-8")
+            headers = dict(headers or {}, **{
+                "Content-Type": "application/json; charset=UTF-8"})
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _error(self, status, message):
+        self._send(status, {"error": {"code": status, "message": message}})
+
+    def _lookup(self):
+        """
+        Find the requested object, checking generation preconditions.
+        Returns (metadata, content), or None if a response has been sent.
+        """
+        found = self.fake.objects.get(self.name)
+        if found is None:
+            self._error(404, "No such object: {}".format(self.name))
+            return None
+        metadata = found[0]
+        generation = metadata["generation"]
+        if self.query.get("ifGenerationMatch", generation) != generation:
+            self._error(412, "Precondition Failed")
+            return None
+        if self.query.get("ifGenerationNotMatch") == generation:
+            self._send(304)
+            return None
+        if self.query.get("ifMetagenerationMatch",
+                          metadata["metageneration"]) != \
+                metadata["metageneration"]:
+            self._error(412, "Precondition Failed")
+            return None
+        return found
+
+    def do_GET(self):
+        if not self._route():
+            return
+        if self.is_bucket:
+            return self._send(200, {"kind": "storage#bucket",
+                                    "name": self.bucket, "id": self.bucket})
+        if self.name is None:
+            return self._list()
+        found = self._lookup()
+        if found is None:
+            return
+        metadata, content = found
+        if self.query.get("alt") != "media":
+            return self._send(200, metadata)
+        headers = {
+            "Content-Type": metadata.get("contentType"),
+            "X-Goog-Generation": metadata["generation"],
+            "X-Goog-Metageneration": metadata["metageneration"],
+            "X-Goog-Hash": ",".join(
+                "{}={}".format(name, metadata[field]) for name, field in (
+                    ("crc32c", "crc32c"), ("md5", "md5Hash"))
+                if field in metadata),
+            "X-Goog-Stored-Content-Length": metadata["size"],
+            "ETag": '"{}"'.format(metadata.get("md5Hash") or
+                                  metadata["generation"]),
+        }
+        if metadata.get("customTime"):
+            headers["X-Goog-Custom-Time"] = metadata["customTime"]
+        if metadata.get("contentEncoding"):
+            headers["Content-Encoding"] = metadata["contentEncoding"]
+        byte_range = self.headers.get("Range")
+        if byte_range:
+            start, _, end = byte_range.split("=")[1].partition("-")
+            start = int(start)
+            if start >= len(content):
+                return self._error(416, "Requested range not satisfiable")
+            end = min(int(end) if end else len(content) - 1,
+                      len(content) - 1)
+            headers["Content-Range"] = "bytes {}-{}/{}".format(
+                start, end, len(content))
+            return self._send(206, content[start:end + 1], headers)
+        self._send(200, content, headers)
+
+    def _list(self):
+        prefix = self.query.get("prefix", "")
+        names = sorted(name for name in self.fake.objects
+                       if name.startswith(prefix))
+        start = self.query.get("pageToken")
+        if start:
+            names = [name for name in names if name >= start]
+        max_results = int(self.query.get("maxResults", 1000))
+        page, rest = names[:max_results], names[max_results:]
+        result = {"kind": "storage#objects",
+                  "items": [self.fake.objects[name][0] for name in page]}
+        if rest:
+            result["nextPageToken"] = rest[0]
+        self._send(200, result)
+
+    def do_POST(self):
+        if not self._route():
+            return
+        if self.path.startswith("/batch/"):
+            return self._batch()
+        if "/copyTo/" in self.path:
+            return self._copy()
+        if self.action == "compose":
+            return self._compose()
+        upload_type = self.query.get("uploadType")
+        if upload_type == "resumable":
+            metadata = json.loads(self.body.decode("utf-8"))
+            metadata.setdefault("name", self.query.get("name"))
+            upload_id = uuid.uuid4().hex
+            self.fake.uploads[upload_id] = (metadata, b"")
+            return self._send(200, headers={
+                "Location": "{}/upload/storage/v1/b/{}/o?uploadType="
+                            "resumable&upload_id={}".format(
+                                self.fake.url, self.bucket, upload_id)})
+        if upload_type == "multipart":
+            content_type = self.headers["Content-Type"]
+            boundary = content_type.split("boundary=")[1].strip('"')
+            parts = []
+            for part in self.body.split(b"--" + boundary.encode("utf-8")):
+                if part in (b"", b"--", b"--\r\n"):
+                    continue
+                _, _, payload = part.partition(b"\r\n\r\n")
+                parts.append(payload[:-2] if payload.endswith(b"\r\n")
+                             else payload)
+            metadata = json.loads(parts[0].decode("utf-8"))
+            content = parts[1]
+        elif upload_type == "media":
+            metadata = {"name": self.query["name"]}
+            content = self.body
+        else:
+            return self._error(400, "Unsupported upload")
+        metadata.setdefault("name", self.query.get("name"))
+        self._send(200, self.fake.put(
+            self.bucket, metadata["name"], content, metadata))
+
+    def do_PUT(self):
+        """
+        Upload a chunk of a resumable upload
+        """
+        if not self._route():
+            return
+        upload_id = self.query.get("upload_id")
+        if upload_id not in self.fake.uploads:
+            return self._error(404, "No such upload")
+        metadata, content = self.fake.uploads[upload_id]
+        content += self.body
+        self.fake.uploads[upload_id] = (metadata, content)
+        total = re.search(r"/(\d+|\*)$",
+                          self.headers.get("Content-Range", "")).group(1)
+        if total != "*" and len(content) >= int(total):
+            del self.fake.uploads[upload_id]
+            return self._send(200, self.fake.put(
+                self.bucket, metadata["name"], content, metadata))
+        headers = {}
+        if content:
+            headers["Range"] = "bytes=0-{}".format(len(content) - 1)
+        self._send(308, headers=headers)
+
+    def _compose(self):
+        request = json.loads(self.body.decode("utf-8"))
+        content = b""
+        for source in request["sourceObjects"]:
+            found = self.fake.objects.get(source["name"])
+            if found is None:
+                return self._error(404, "No such object: {}".format(
+                    source["name"]))
+            content += found[1]
+        destination = request.get("destination") or {}
+        metadata = {field: destination[field] for field in (
+            "contentType", "contentEncoding", "customTime", "metadata")
+            if destination.get(field)}
+        metadata["componentCount"] = len(request["sourceObjects"])
+        metadata = self.fake.put(self.bucket, self.name, content, metadata)
+        # Composite objects have no MD5 hash
+        del metadata["md5Hash"]
+        self._send(200, metadata)
+
+    def _copy(self):
+        """
+        Copy an object, with its metadata
+        """
+        source, destination = urlparse(self.path).path.split("/copyTo/")
+        found = self.fake.objects.get(unquote(source.split("/o/", 1)[1]))
+        if found is None:
+            return self._error(404, "No such object: {}".format(source))
+        metadata, content = found
+        bucket, name = destination[len("b/"):].split("/o/", 1)
+        self._send(200, self.fake.put(
+            unquote(bucket), unquote(name), content, {
+                field: metadata[field] for field in (
+                    "contentType", "contentEncoding", "customTime",
+                    "metadata") if metadata.get(field)}))
+
+    def _batch(self):
+        """
+        Run a batch of deletes, responding with a multipart/mixed response
+        of their statuses
+        """
+        message = Parser().parsestr("Content-Type: {}\n\n{}".format(
+            self.headers["Content-Type"], self.body.decode("utf-8")))
+        boundary = "batch_{}".format(uuid.uuid4().hex)
+        parts = []
+        for index, part in enumerate(message.get_payload()):
+            request_line = part.get_payload().lstrip().splitlines()[0]
+            method, uri, _ = request_line.split(" ", 2)
+            parsed = urlparse(uri)
+            self.fake.requests.append((method, parsed.path))
+            query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+            status, body = self._batch_delete(method, parsed.path, query)
+            parts.append(
+                "--{}\r\nContent-Type: application/http\r\n"
+                "Content-ID: <response-{}>\r\n\r\n"
+                "HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n"
+                "Content-Length: {}\r\n\r\n{}\r\n".format(
+                    boundary, index + 1, status, self.responses[status][0],
+                    len(body), body))
+        parts.append("--{}--\r\n".format(boundary))
+        self._send(200, "".join(parts).encode("utf-8"), {
+            "Content-Type": "multipart/mixed; boundary={}".format(
+                boundary)})
+
+    def _batch_delete(self, method, path, query):
+        def error(status, message):
+            return status, json.dumps(
+                {"error": {"code": status, "message": message}})
+
+        if method != "DELETE" or "/o/" not in path:
+            return error(501, "Unsupported batch request")
+        name = unquote(path.split("/o/", 1)[1])
+        with self.fake._lock:
+            found = self.fake.objects.get(name)
+            if found is None:
+                return error(404, "No such object: {}".format(name))
+            metadata = found[0]
+            for param, field in (("ifGenerationMatch", "generation"),
+                                 ("ifMetagenerationMatch", "metageneration")):
+                if query.get(param, metadata[field]) != metadata[field]:
+                    return error(412, "Precondition Failed")
+            del self.fake.objects[name]
+        return 204, ""
+
+    def do_PATCH(self):
+        if not self._route():
+            return
+        if self._lookup() is None:
+            return
+        changes = json.loads(self.body.decode("utf-8")) if self.body else {}
+        self._send(200, self.fake.patch(self.name, changes))
+
+    def do_DELETE(self):
+        if not self._route():
+            return
+        if self._lookup() is None:
+            return
+        del self.fake.objects[self.name]
+        self._send(204)
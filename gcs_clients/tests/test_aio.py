@@ -0,0 +1,136 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase, skipIf
+from gcs_clients.codec import compress
+from gcs_clients.restclient import CachedHTTPResponse
+from gcs_clients.tests.fake_gcs import FakeGCSServer
+from google.api_core.exceptions import NotFound
+from google.auth.credentials import AnonymousCredentials
+from mock import patch
+
+try:
+    from gcs_clients.aio import (
+        AsyncGCSClient, AsyncGCSBucketClient, AsyncRestclientGCSClient)
+except ImportError:
+    AsyncGCSClient = None
+
+
+def custom_time(**kwargs):
+    return (datetime.now(timezone.utc) - timedelta(**kwargs)).strftime(
+        "%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+@skipIf(AsyncGCSClient is None, "aiohttp not installed")
+class TestAsyncGCSBucketClient(TestCase):
+    def setUp(self):
+        self.server = FakeGCSServer().start()
+        self.client = AsyncGCSBucketClient(
+            "test", credentials=AnonymousCredentials(),
+            api_endpoint=self.server.url)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.wait(self.client.close())
+        self.loop.close()
+        self.server.stop()
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_get(self):
+        self.server.put("test", "abc/api/v1/test", b"content",
+                        {"customTime": custom_time(minutes=1)})
+        self.assertEqual(
+            self.wait(self.client.get("abc/api/v1/test", expire=120)),
+            b"content")
+        self.assertEqual(
+            self.wait(self.client.get("abc/api/v1/test")), b"content")
+        self.assertEqual(
+            self.wait(self.client.get("abc/api/v1/test", expire=30)), None)
+        self.assertEqual(self.wait(self.client.get("missing")), None)
+        self.assertEqual(self.server.requests[-1],
+                         ("GET", "/download/storage/v1/b/test/o/missing"))
+
+    def test_get_compressed(self):
+        self.server.put("test", "abc/api/v1/test",
+                        compress(b"content", "gzip"),
+                        {"customTime": custom_time(minutes=1),
+                         "contentEncoding": "gzip"})
+        self.assertEqual(
+            self.wait(self.client.get("abc/api/v1/test")), b"content")
+
+    def test_get_no_custom_time(self):
+        self.server.put("test", "abc/api/v1/test", b"content")
+        self.assertEqual(
+            self.wait(self.client.get("abc/api/v1/test")), None)
+        self.assertEqual(self.server.requests[-1],
+                         ("GET", "/storage/v1/b/test/o/abc%2Fapi%2Fv1%2Ftest"))
+
+    def test_set(self):
+        self.wait(self.client.set("abc/api/v1/test?a=1", "content"))
+        metadata, content = self.server.objects["abc/api/v1/test?a=1"]
+        self.assertEqual(content, b"content")
+        self.assertIn("customTime", metadata)
+        self.assertEqual(
+            self.wait(self.client.get("abc/api/v1/test?a=1", expire=60)),
+            b"content")
+        self.wait(self.client.set("abc/api/v1/test?a=1", b"\x00\xff"))
+        self.assertEqual(self.server.objects["abc/api/v1/test?a=1"][1],
+                         b"\x00\xff")
+        self.wait(self.client.set("abc/api/v1/test", "content", expire=None))
+        self.assertNotIn("abc/api/v1/test", self.server.objects)
+
+    def test_delete(self):
+        self.server.put("test", "abc/api/v1/test", b"content")
+        self.wait(self.client.delete("abc/api/v1/test"))
+        self.assertEqual(self.server.objects, {})
+        with self.assertRaises(NotFound):
+            self.wait(self.client.delete("abc/api/v1/test"))
+
+
+@skipIf(AsyncGCSClient is None, "aiohttp not installed")
+class TestAsyncRestclientGCSClient(TestCase):
+    def setUp(self):
+        self.server = FakeGCSServer().start()
+        self.client = AsyncRestclientGCSClient()
+        self.client._client = AsyncGCSBucketClient(
+            "test", credentials=AnonymousCredentials(),
+            api_endpoint=self.server.url)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.client.close())
+        self.loop.close()
+        self.server.stop()
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_default_settings(self):
+        client = AsyncGCSClient().client
+        self.assertEqual(client.bucket_name, '')
+        self.assertEqual(client.timeout, 5)
+        self.assertEqual(client.num_retries, 3)
+        self.assertEqual(client.pool_maxsize, 10)
+
+    def test_cache(self):
+        self.assertEqual(
+            self.wait(self.client.getCache("abc", "/api/v1/test")), None)
+        response = CachedHTTPResponse(
+            status=200, data=b'{"a": 1}', headers={"Content-Type": "json"})
+        self.wait(self.client.updateCache("abc", "/api/v1/test", response))
+        self.assertIn("abc/api/v1/test", self.server.objects)
+        cached = self.wait(self.client.getCache("abc", "/api/v1/test"))
+        self.assertEqual(cached["response"].status, 200)
+        self.assertEqual(cached["response"].data, b'{"a": 1}')
+        self.assertEqual(cached["response"].getheader("content-type"),
+                         "json")
+        self.wait(self.client.deleteCache("abc", "/api/v1/test"))
+        self.assertEqual(self.server.objects, {})
+        # errors are logged by the shim
+        with patch("logging.error") as mock_log:
+            self.wait(self.client.deleteCache("abc", "/api/v1/test"))
+        self.assertTrue(mock_log.called)
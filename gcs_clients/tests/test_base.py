@@ -1,18 +1,41 @@
 # Copyright 2021 UW-IT, University of Washington
 # SPDX-License-Identifier: Apache-2.0
 
-from datetime import datetime, timedelta
+import os
+import shutil
+import socket
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
 from unittest import TestCase
-from io import StringIO
-from gcs_clients import GCSClient
-from mock import MagicMock, patch
+from io import BytesIO, StringIO
+from commonconf import override_settings
+from gcs_clients import GCSClient, GCSBucketClient
+from gcs_clients.base import CacheBlob, is_fresh, is_outage
+from gcs_clients.cache import (
+    DiskCache, MemoryCache, NegativeCache, SingleFlight)
+from gcs_clients.codec import CODECS
+from gcs_clients.metrics import PrometheusMetrics
+from gcs_clients.tests.fake_gcs import FakeGCSServer
+from google.api_core.exceptions import (
+    GoogleAPIError, PreconditionFailed, RetryError, ServiceUnavailable,
+    TooManyRequests)
+from google.auth.credentials import AnonymousCredentials
+from google.auth.exceptions import RefreshError
+from google.cloud import storage
+from google.cloud.exceptions import NotFound
+from google.resumable_media import DataCorruption
+from mock import ANY, MagicMock, patch
+from requests import ConnectionError as RequestsConnectionError
+from requests import Request, Response, Timeout
+from threading import Thread
 
 
 def get_default_client():
     # mock blob
     mock_blob = MagicMock()
     mock_blob.upload_from_file = MagicMock(return_value=True)
-    mock_blob.download_as_string = \
+    mock_blob.download_as_bytes = \
         MagicMock(
             return_value=(
                 '{'
@@ -43,11 +66,218 @@ class TestGCSClient(TestCase):
         self.assertEqual(client.bucket_name, '')
         self.assertEqual(client.timeout, 5)
         self.assertEqual(client.num_retries, 3)
+        self.assertEqual(client.memory_cache, None)
+
+    @override_settings(GCS_SHARED_CLIENT=True, GCS_POOL_MAXSIZE=32,
+                       GCS_TCP_KEEPALIVE=True)
+    def test_shared_client(self):
+        gcs_client = GCSClient()
+        client = gcs_client.client
+        thread = Thread(target=lambda: self.assertIs(gcs_client.client,
+                                                     client))
+        thread.start()
+        thread.join()
+        self.assertEqual(client.adapter._pool_maxsize, 32)
+        self.assertTrue(client.adapter.tcp_keepalive)
+
+    def test_thread_local_client(self):
+        clients = []
+        thread = Thread(target=lambda: clients.append(self.gcs_client.client))
+        thread.start()
+        thread.join()
+        self.assertIsNot(clients[0], self.gcs_client.client)
+
+    @override_settings(GCS_LAZY_BUCKET=True)
+    def test_lazy_bucket(self):
+        client = GCSClient().client
+        self.assertTrue(client.lazy_bucket)
+        client._client = MagicMock()
+        self.assertEqual(client.bucket, client._client.bucket.return_value)
+        client._client.bucket.assert_called_once_with(client.bucket_name)
+        assert not client._client.get_bucket.called
+
+    @override_settings(GCS_TRANSFER_THRESHOLD=1000000,
+                       GCS_TRANSFER_WORKERS=8)
+    def test_transfer_settings(self):
+        gcs_client = GCSClient()
+        client = gcs_client.client
+        self.assertEqual(client.transfer_threshold, 1000000)
+        self.assertEqual(client.transfer_chunk_size, 8 * 1024 * 1024)
+        self.assertIs(client.transfer_executor, gcs_client.transfer_executor)
+        self.assertEqual(client.transfer_executor._max_workers, 8)
+
+    @override_settings(GCS_CIRCUIT_BREAKER=True, GCS_CIRCUIT_MIN_CALLS=2,
+                       GCS_CIRCUIT_COOL_DOWN=60)
+    def test_circuit_breaker(self):
+        gcs_client = GCSClient()
+        gcs_client.on_circuit_change = MagicMock()
+        gcs_client._local.client = MagicMock()
+        mock_get = gcs_client._local.client.get
+        mock_get.side_effect = NotFound("missing")
+        # client errors don't open the circuit
+        for _ in range(3):
+            self.assertEqual(gcs_client.get("abc"), None)
+        self.assertEqual(gcs_client.circuit_breaker.state, "closed")
+
+        mock_get.side_effect = ServiceUnavailable("unavailable")
+        for _ in range(3):
+            self.assertEqual(gcs_client.get("abc"), None)
+        self.assertEqual(gcs_client.circuit_breaker.state, "open")
+        gcs_client.on_circuit_change.assert_called_once_with(
+            "closed", "open")
+        self.assertEqual(mock_get.call_count, 6)
+        # calls fail fast while open
+        self.assertEqual(gcs_client.get("abc"), None)
+        gcs_client._write("abc", "content", 0)
+        self.assertEqual(mock_get.call_count, 6)
+        assert not gcs_client._local.client.set.called
+
+        gcs_client.circuit_breaker.reset()
+        mock_get.side_effect = None
+        mock_get.return_value = b"content"
+        self.assertEqual(gcs_client.get("abc"), b"content")
+
+        # errors that don't come from GCS don't open the circuit
+        mock_get.side_effect = AttributeError("delete")
+        for _ in range(3):
+            self.assertRaises(AttributeError, gcs_client.get, "abc")
+        self.assertEqual(gcs_client.circuit_breaker.state, "closed")
+
+    def test_is_outage(self):
+        for ex in (ServiceUnavailable("unavailable"),
+                   TooManyRequests("slow down"), RetryError("retry", None),
+                   RequestsConnectionError("reset"), Timeout("timeout"),
+                   ConnectionResetError(), socket.timeout()):
+            self.assertTrue(is_outage(ex), ex)
+        for ex in (NotFound("missing"), PreconditionFailed("replaced"),
+                   AttributeError("delete"), TypeError("args"),
+                   ValueError("value")):
+            self.assertFalse(is_outage(ex), ex)
+
+    def test_disabled_features(self):
+        gcs_client = GCSClient()
+        self.assertIsNone(gcs_client.metrics)
+        self.assertIsNone(gcs_client.circuit_breaker)
+        self.assertIsNone(gcs_client.write_behind)
+        # the settings are only read once, and the lock isn't taken again
+        with override_settings(GCS_METRICS=True, GCS_CIRCUIT_BREAKER=True,
+                               GCS_WRITE_BEHIND=True), \
+                patch.object(gcs_client, "_lock") as mock_lock:
+            self.assertIsNone(gcs_client.metrics)
+            self.assertIsNone(gcs_client.circuit_breaker)
+            self.assertIsNone(gcs_client.write_behind)
+        self.assertEqual(mock_lock.mock_calls, [])
+
+    @override_settings(GCS_READ_DEADLINE=2, GCS_READ_HEDGE=True)
+    def test_read_policy(self):
+        self.assertEqual(self.gcs_client.client.read_policy, None)
+        gcs_client = GCSClient()
+        client = gcs_client.client
+        self.assertIs(client.read_policy, gcs_client.read_policy)
+        self.assertEqual(client.read_policy.deadline, 2)
+        self.assertTrue(client.read_policy.hedge)
+        client._bucket = MagicMock()
+        with patch('gcs_clients.base.CacheBlob') as mock_cache_blob:
+            mock_blob = mock_cache_blob.return_value
+            mock_blob.download_as_bytes.return_value = b"content"
+            mock_blob.content_encoding = None
+            mock_blob.custom_time = datetime.now(timezone.utc)
+            self.assertEqual(client.get("abc"), b"content")
+            mock_blob.download_as_bytes.assert_called_once_with(
+                raw_download=True, timeout=5,
+                retry=client.read_policy.retry)
+
+    @override_settings(GCS_METRICS=True)
+    def test_metrics_settings(self):
+        self.assertEqual(self.gcs_client.client.metrics, None)
+        gcs_client = GCSClient()
+        self.assertIsInstance(gcs_client.metrics, PrometheusMetrics)
+        self.assertIs(gcs_client.client.metrics, gcs_client.metrics)
+
+    def test_warm_up(self):
+        client = self.gcs_client.client
+        client._client._credentials.valid = False
+        self.gcs_client.warm_up()
+        client._client._credentials.refresh.assert_called_once_with(
+            client._client._http._auth_request)
+        client._bucket.blob.assert_called_once_with(client.warm_up_key)
+        exists = client._bucket.blob().exists
+        exists.assert_called_once_with(timeout=client.timeout, retry=ANY)
+        self.assertEqual(exists.call_args[1]["retry"].deadline,
+                         client.timeout)
+        for ex in (GoogleAPIError("fail"), RefreshError("fail"),
+                   RequestsConnectionError("fail")):
+            with patch('logging.error') as mock_log:
+                exists.side_effect = ex
+                self.gcs_client.warm_up()
+            self.assertTrue(mock_log.called)
+
+    @override_settings(GCS_NEGATIVE_CACHE_TTL=10)
+    def test_negative_cache_settings(self):
+        gcs_client = GCSClient()
+        self.assertIsInstance(gcs_client.client.negative_cache, NegativeCache)
+        self.assertEqual(gcs_client.client.negative_cache.ttl, 10)
+        self.assertEqual(gcs_client.client.negative_cache.max_entries, 10000)
+
+    @override_settings(GCS_SINGLE_FLIGHT=True)
+    def test_single_flight_settings(self):
+        self.assertEqual(self.gcs_client.client.single_flight, None)
+        self.assertIsInstance(self.gcs_client.single_flight, SingleFlight)
+        gcs_client = GCSClient()
+        self.assertIsInstance(gcs_client.client.single_flight, SingleFlight)
+        self.assertEqual(gcs_client.client.single_flight.claim_timeout, 30)
+        self.assertIs(gcs_client.single_flight,
+                      gcs_client.client.single_flight)
+
+    @override_settings(GCS_MEMORY_CACHE_ENTRIES=10)
+    def test_memory_cache_settings(self):
+        gcs_client = GCSClient()
+        self.assertIsInstance(gcs_client.client.memory_cache, MemoryCache)
+        self.assertEqual(gcs_client.client.memory_cache.max_entries, 10)
+        self.assertEqual(gcs_client.client.memory_cache.max_bytes,
+                         64 * 1024 * 1024)
+        self.assertIs(gcs_client.memory_cache, gcs_client.client.memory_cache)
+
+    @override_settings(GCS_DISK_CACHE_DIR="/tmp/gcs-cache",
+                       GCS_DISK_CACHE_BYTES=1024)
+    def test_disk_cache_settings(self):
+        self.assertEqual(self.gcs_client.client.disk_cache, None)
+        gcs_client = GCSClient()
+        self.assertIsInstance(gcs_client.client.disk_cache, DiskCache)
+        self.assertEqual(gcs_client.client.disk_cache.path, "/tmp/gcs-cache")
+        self.assertEqual(gcs_client.client.disk_cache.max_bytes, 1024)
+        self.assertIs(gcs_client.disk_cache, gcs_client.client.disk_cache)
+
+
+class TestCacheBlob(TestCase):
+    def test_extract_headers_from_download(self):
+        blob = CacheBlob("abc", MagicMock())
+        response = MagicMock()
+        response.headers = {
+            "X-Goog-Custom-Time": "2021-05-01T12:30:00.000Z",
+            "X-goog-generation": "1"}
+        blob._extract_headers_from_download(response)
+        self.assertEqual(blob.custom_time,
+                         datetime(2021, 5, 1, 12, 30, tzinfo=timezone.utc))
+        self.assertEqual(blob.generation, 1)
+        response.headers = {"X-Goog-Custom-Time": "invalid"}
+        blob._extract_headers_from_download(response)
+        self.assertEqual(blob.custom_time, None)
+        response.headers = {}
+        blob._extract_headers_from_download(response)
+        self.assertEqual(blob.custom_time, None)
+        blob.custom_time = datetime(2021, 5, 1, 12, 30, tzinfo=timezone.utc)
+        self.assertEqual(blob._properties["customTime"],
+                         "2021-05-01T12:30:00.000000Z")
 
 
 class TestGCSBucketClient(TestCase):
     def setUp(self):
         self.mock_blob, self.gcs_client = get_default_client()
+        patcher = patch('gcs_clients.base.CacheBlob',
+                        return_value=self.mock_blob)
+        self.mock_cache_blob = patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_get(self):
         self.mock_blob.custom_time = \
@@ -77,6 +307,192 @@ class TestGCSBucketClient(TestCase):
             self.gcs_client.get("/api/v1/test", expire=59.99),
             None
         )
+        self.mock_cache_blob.assert_called_with(
+            "/api/v1/test", self.gcs_client.client.bucket)
+        self.mock_blob.download_as_bytes.assert_called_with(
+            raw_download=True, timeout=self.gcs_client.client.timeout)
+        assert not self.mock_blob.reload.called
+        assert not self.gcs_client.client.bucket.get_blob.called
+
+    def test_get_single_flight(self):
+        single_flight = SingleFlight()
+        self.gcs_client.client.single_flight = single_flight
+        self.mock_blob.custom_time = \
+            datetime.utcnow() - timedelta(minutes=1)
+        with patch.object(single_flight, 'do',
+                          wraps=single_flight.do) as mock_do:
+            self.assertEqual(
+                self.gcs_client.get("/api/v1/test", expire=120),
+                self.mock_blob.download_as_bytes.return_value)
+            self.assertEqual(
+                self.gcs_client.get("/api/v1/test", expire=30), None)
+        mock_do.assert_called_with(
+            "/api/v1/test", self.gcs_client.client._fetch, "/api/v1/test")
+
+    def test_get_negative_cache(self):
+        self.gcs_client.client.negative_cache = NegativeCache()
+        self.mock_blob.download_as_bytes.side_effect = NotFound("missing")
+        self.assertEqual(self.gcs_client.get("/api/v1/test"), None)
+        self.assertEqual(self.gcs_client.get("/api/v1/test"), None)
+        self.assertEqual(self.mock_blob.download_as_bytes.call_count, 1)
+        # invalidated by set
+        self.gcs_client.set("/api/v1/test", "content")
+        self.assertNotIn("/api/v1/test",
+                         self.gcs_client.client.negative_cache)
+        self.gcs_client.get("/api/v1/test")
+        self.assertEqual(self.mock_blob.download_as_bytes.call_count, 2)
+        # added by delete
+        self.gcs_client.client.negative_cache.clear()
+        self.gcs_client.delete("/api/v1/test")
+        self.assertIn("/api/v1/test", self.gcs_client.client.negative_cache)
+
+    def test_get_stale(self):
+        self.mock_blob.custom_time = \
+            datetime.utcnow() - timedelta(minutes=1)
+        content = self.mock_blob.download_as_bytes.return_value
+        self.assertEqual(self.gcs_client.get_stale(
+            "/api/v1/test", expire=120, grace=30), (content, False))
+        self.assertEqual(self.gcs_client.get_stale(
+            "/api/v1/test", expire=45, grace=30), (content, True))
+        self.assertEqual(self.gcs_client.get_stale(
+            "/api/v1/test", expire=25, grace=30), (None, False))
+        self.assertEqual(self.gcs_client.get_stale(
+            "/api/v1/test", expire=45), (None, False))
+        # stale content isn't kept in memory
+        self.gcs_client.client.memory_cache = MemoryCache()
+        self.gcs_client.get_stale("/api/v1/test", expire=45, grace=30)
+        self.assertEqual(len(self.gcs_client.client.memory_cache), 0)
+
+    def test_get_reload(self):
+        # custom time not returned with the download
+        self.mock_blob.custom_time = None
+        self.assertEqual(self.gcs_client.get("/api/v1/test"), None)
+        self.mock_blob.reload.assert_called_once_with(
+            if_generation_match=self.mock_blob.generation,
+            timeout=self.gcs_client.client.timeout)
+
+    def test_get_missing(self):
+        self.mock_blob.download_as_bytes.side_effect = NotFound("missing")
+        self.assertEqual(self.gcs_client.get("/api/v1/test"), None)
+        self.mock_blob.download_as_bytes.side_effect = None
+        self.mock_blob.custom_time = None
+        self.mock_blob.reload.side_effect = PreconditionFailed("replaced")
+        self.assertEqual(self.gcs_client.get("/api/v1/test"), None)
+
+    def test_get_replaced(self):
+        negative_cache = self.gcs_client.client.negative_cache = \
+            NegativeCache(ttl=60)
+        self.mock_blob.custom_time = None
+        self.mock_blob.download_as_bytes.return_value = b"content"
+        self.mock_blob.reload.side_effect = PreconditionFailed("replaced")
+        self.assertEqual(self.gcs_client.get("/api/v1/test"), None)
+        self.assertEqual(self.mock_blob.reload.call_count, 2)
+        # Replaced content isn't cached as missing
+        self.assertNotIn("/api/v1/test", negative_cache)
+
+        # The replacement is read on retry
+        def reload(**kwargs):
+            self.mock_blob.reload.side_effect = None
+            self.mock_blob.custom_time = datetime.utcnow()
+            raise PreconditionFailed("replaced")
+
+        self.mock_blob.reload.side_effect = reload
+        self.assertEqual(self.gcs_client.get("/api/v1/test"), b"content")
+
+    def test_get_memory_cache(self):
+        self.gcs_client.client.memory_cache = MemoryCache()
+        self.mock_blob.custom_time = \
+            datetime.utcnow() - timedelta(minutes=1)
+        self.mock_blob.download_as_bytes.return_value = b"content"
+        self.assertEqual(
+            self.gcs_client.get("/api/v1/test", expire=120), b"content")
+        self.assertEqual(
+            self.gcs_client.get("/api/v1/test", expire=120), b"content")
+        self.assertEqual(self.mock_blob.download_as_bytes.call_count, 1)
+        # expired in memory, checks GCS again
+        self.assertEqual(
+            self.gcs_client.get("/api/v1/test", expire=30), None)
+        self.assertEqual(self.mock_blob.download_as_bytes.call_count, 2)
+        # invalidated by set and delete
+        self.gcs_client.set("/api/v1/test", "content")
+        self.assertEqual(
+            self.gcs_client.client.memory_cache.get("/api/v1/test"), None)
+        self.gcs_client.get("/api/v1/test", expire=120)
+        self.gcs_client.delete("/api/v1/test")
+        self.assertEqual(
+            self.gcs_client.client.memory_cache.get("/api/v1/test"), None)
+
+    def test_get_memory_cache_deleted(self):
+        memory_cache = self.gcs_client.client.memory_cache = MemoryCache()
+        self.mock_blob.custom_time = datetime.utcnow()
+
+        # A read overlapping a write doesn't cache the replaced content
+        def download(**kwargs):
+            memory_cache.delete("/api/v1/test")
+            return b"old"
+
+        self.mock_blob.download_as_bytes.side_effect = download
+        self.assertEqual(self.gcs_client.get("/api/v1/test"), b"old")
+        self.assertEqual(memory_cache.get("/api/v1/test"), None)
+
+    @patch('gcs_clients.GCSBucketClient.get')
+    def test_get_many(self, mock_get):
+        mock_get.side_effect = lambda url_key, expire: {
+            "a": b"content", "b": None}[url_key]
+        results, errors = self.gcs_client.get_many(["a", "b"], expire=60)
+        self.assertEqual(results, {"a": b"content", "b": None})
+        self.assertEqual(errors, {})
+        mock_get.assert_any_call("a", expire=60)
+
+        mock_get.side_effect = GoogleAPIError("fail")
+        results, errors = self.gcs_client.get_many(
+            ["a", "b"], expire={"a": 10, "b": 20})
+        self.assertEqual(results, {})
+        self.assertEqual(list(errors), ["a", "b"])
+        mock_get.assert_any_call("b", expire=20)
+
+    @patch('gcs_clients.GCSBucketClient.set')
+    def test_set_many(self, mock_set):
+        mock_set.side_effect = [None, GoogleAPIError("fail")]
+        errors = self.gcs_client.set_many({"a": "1", "b": "2"}, expire=60)
+        self.assertEqual(list(errors), ["b"])
+        mock_set.assert_any_call("a", "1", expire=60)
+
+    @patch('gcs_clients.base.ResponseBatch')
+    def test_delete_many(self, mock_batch):
+        def response(status_code):
+            response = Response()
+            response.status_code = status_code
+            response.request = Request("DELETE", "https://test").prepare()
+            return response
+
+        self.gcs_client.client.batch_size = 2
+        mock_batch.return_value.responses = [response(204), response(404)]
+        errors = self.gcs_client.delete_many(["a", "b", "c"])
+        self.assertEqual(mock_batch.call_count, 2)
+        self.assertEqual(list(errors), ["b"])
+        self.assertIsInstance(errors["b"], NotFound)
+        self.gcs_client.client.bucket.delete_blob.assert_any_call(
+            "c", timeout=self.gcs_client.client.timeout)
+
+        mock_batch.return_value.__exit__.side_effect = GoogleAPIError("fail")
+        errors = self.gcs_client.delete_many(["a", "b", "c"])
+        self.assertEqual(list(errors), ["a", "b", "c"])
+
+    @patch('gcs_clients.base.ResponseBatch')
+    def test_delete_many_new_bucket(self, mock_batch):
+        client = self.gcs_client.client
+        client._bucket = None
+
+        # The bucket lookup mustn't be deferred into the batch
+        def batch(storage_client):
+            storage_client.get_bucket.assert_called_once_with(
+                client.bucket_name)
+            return MagicMock(responses=[])
+
+        mock_batch.side_effect = batch
+        self.assertEqual(self.gcs_client.delete_many(["a"]), {})
+        mock_batch.assert_called_once_with(client.client)
 
     def test_delete(self):
         with patch.object(self.gcs_client.client._bucket.get_blob(),
@@ -164,3 +580,432 @@ class TestGCSBucketClient(TestCase):
         # mock accessing already set storage client
         self.assertEqual(self.gcs_client.client.client, mock_storage_client())
         assert not mock_storage_client().called
+
+
+class TestGCSBucketClientFakeServer(TestCase):
+    def setUp(self):
+        self.server = FakeGCSServer().start()
+        self.client = GCSBucketClient("test", pool_maxsize=4)
+        storage_client = storage.Client
+        with patch('google.cloud.storage.Client',
+                   lambda: storage_client(
+                       project="test", credentials=AnonymousCredentials(),
+                       client_options={"api_endpoint": self.server.url})):
+            self.client.client
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_get_set(self):
+        self.client.set("abc/api/v1/test?a=1", "content")
+        self.assertEqual(self.client.get("abc/api/v1/test?a=1", expire=60),
+                         b"content")
+        self.assertEqual(self.server.requests[-1], (
+            "GET",
+            "/download/storage/v1/b/test/o/abc%2Fapi%2Fv1%2Ftest%3Fa%3D1"))
+        self.assertEqual(self.client.get("missing"), None)
+
+    def test_get_entry_touch(self):
+        self.client.memory_cache = MemoryCache()
+        self.assertEqual(self.client.get_entry("abc"), (None, None))
+        self.client.set("abc", "content")
+        content, custom_time = self.client.get_entry("abc")
+        self.assertEqual(content, b"content")
+        metadata, _ = self.server.objects["abc"]
+
+        del self.server.requests[:]
+        self.client.touch("abc")
+        self.assertEqual([request[0] for request in self.server.requests],
+                         ["PATCH"])
+        patched, _ = self.server.objects["abc"]
+        self.assertEqual(patched["generation"], metadata["generation"])
+        content, touched = self.client.get_entry("abc")
+        self.assertEqual(content, b"content")
+        self.assertGreater(touched, custom_time)
+        self.assertEqual(self.client.memory_cache.get("abc")[1], touched)
+        self.assertRaises(NotFound, self.client.touch, "missing")
+
+    def test_disk_cache(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.client.disk_cache = DiskCache(path)
+        self.client.set("abc", "content")
+        self.assertEqual(self.client.get("abc"), b"content")
+        metadata, _ = self.server.objects["abc"]
+        entry = self.client.disk_cache.get("abc")
+        self.assertEqual(entry.content, b"content")
+        self.assertEqual(entry.generation, int(metadata["generation"]))
+
+        # Another process sharing the directory reads the local copy
+        client = GCSBucketClient("test", disk_cache=DiskCache(path))
+        client.client = self.client.client
+        del self.server.requests[:]
+        self.assertEqual(client.get("abc", expire=60), b"content")
+        self.assertEqual(self.server.requests, [])
+
+        self.client.touch("abc")
+        self.assertGreater(self.client.disk_cache.get("abc").custom_time,
+                           entry.custom_time)
+        self.client.set("abc", "new")
+        self.assertEqual(self.client.disk_cache.get("abc"), None)
+        self.assertEqual(client.get("abc"), b"new")
+        self.client.delete("abc")
+        self.assertEqual(client.get("abc"), None)
+
+    def test_disk_cache_expired(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.client.disk_cache = DiskCache(path)
+        self.client.set("abc", "content")
+        self.client.get("abc")
+        self.client.disk_cache.set(
+            "abc", b"old", datetime.now(timezone.utc) - timedelta(
+                seconds=60))
+        self.assertEqual(self.client.get("abc", expire=30), b"content")
+        self.assertEqual(self.client.get_entry("abc")[0], b"content")
+
+    def test_disk_cache_set_unchanged(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        disk_cache = self.client.disk_cache = DiskCache(path)
+        content = os.urandom(100 * 1024)
+        self.client.set("abc", content)
+        self.assertEqual(self.client.get("abc"), content)
+        expired = datetime.now(timezone.utc) - timedelta(seconds=60)
+        entry = disk_cache.get("abc")
+        disk_cache.set("abc", entry.content, expired, entry.generation,
+                       entry.metageneration)
+        self.server.patch("abc", {"customTime": expired.isoformat().replace(
+            "+00:00", "Z")})
+
+        # Writing identical content keeps the local copy
+        del self.server.requests[:]
+        self.client.set("abc", content)
+        self.assertEqual(self.client.get("abc", expire=30), content)
+        self.assertFalse([request for request in self.server.requests
+                          if request[1].startswith("/download")])
+        entry = disk_cache.get("abc")
+        self.assertTrue(is_fresh(entry.custom_time, 30))
+        self.assertEqual(entry.metageneration, int(
+            self.server.objects["abc"][0]["metageneration"]))
+
+    def test_disk_cache_revalidate(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        disk_cache = self.client.disk_cache = DiskCache(path)
+        metrics = self.client.metrics = PrometheusMetrics()
+        self.client.set("abc", "content")
+        self.client.get("abc")
+        expired = datetime.now(timezone.utc) - timedelta(seconds=60)
+        entry = disk_cache.get("abc")
+        disk_cache.set("abc", entry.content, expired, entry.generation,
+                       entry.metageneration)
+
+        # Expired in GCS too
+        self.server.objects["abc"][0]["customTime"] = expired.isoformat(
+            ).replace("+00:00", "Z")
+        del self.server.requests[:]
+        self.assertEqual(self.client.get("abc", expire=30), None)
+        self.assertEqual(self.server.requests,
+                         [("GET", "/storage/v1/b/test/o/abc")])
+
+        # Touched by another host
+        metadata = self.server.patch("abc", {"customTime": datetime.now(
+            timezone.utc).isoformat().replace("+00:00", "Z")})
+        del self.server.requests[:]
+        self.assertEqual(self.client.get("abc", expire=30), b"content")
+        self.assertEqual(self.server.requests,
+                         [("GET", "/storage/v1/b/test/o/abc")])
+        entry = disk_cache.get("abc")
+        self.assertEqual(entry.metageneration,
+                         int(metadata["metageneration"]))
+        self.assertTrue(is_fresh(entry.custom_time, 30))
+        del self.server.requests[:]
+        self.assertEqual(self.client.get("abc", expire=30), b"content")
+        self.assertEqual(self.server.requests, [])
+
+        # Replaced by another host
+        disk_cache.set("abc", entry.content, expired, entry.generation,
+                       entry.metageneration)
+        self.server.put("test", "abc", b"new", {"customTime": metadata[
+            "customTime"]})
+        del self.server.requests[:]
+        self.assertEqual(self.client.get("abc", expire=30), b"new")
+        self.assertEqual([request[0] for request in self.server.requests],
+                         ["GET", "GET"])
+        self.assertEqual(disk_cache.get("abc").content, b"new")
+
+        # Deleted by another host
+        entry = disk_cache.get("abc")
+        disk_cache.set("abc", entry.content, expired, entry.generation,
+                       entry.metageneration)
+        del self.server.objects["abc"]
+        self.assertEqual(self.client.get("abc", expire=30), None)
+        self.assertEqual(disk_cache.get("abc"), None)
+        for result in ("unchanged", "changed", "missing"):
+            self.assertEqual(metrics.get(
+                "gcs_revalidations_total", result=result),
+                2 if result == "unchanged" else 1)
+
+    def test_sweep(self):
+        def custom_time(seconds):
+            return (datetime.now(timezone.utc) - timedelta(
+                seconds=seconds)).isoformat().replace("+00:00", "Z")
+
+        for i in range(5):
+            self.server.put("test", "abc/old/{}".format(i), b"old",
+                            {"customTime": custom_time(120)})
+        self.server.put("test", "abc/new", b"new",
+                        {"customTime": custom_time(0)})
+        self.server.put("test", "abc/none", b"none")
+        self.server.put("test", "xyz/old", b"old",
+                        {"customTime": custom_time(120)})
+        self.client.batch_size = 2
+        self.assertEqual(self.client.sweep("abc/", expire=60, page_size=3), {
+            "listed": 7, "selected": 5, "deleted": 5, "skipped": 0,
+            "errors": 0})
+        self.assertEqual(sorted(self.server.objects),
+                         ["abc/new", "abc/none", "xyz/old"])
+        self.assertEqual(
+            self.client.sweep("abc/", match=lambda name: name != "abc/new",
+                              all=True),
+            {"listed": 2, "selected": 1, "deleted": 1, "skipped": 0,
+             "errors": 0})
+        self.assertEqual(sorted(self.server.objects), ["abc/new", "xyz/old"])
+        # An expiry of 0 means never expired, rather than select everything
+        for expire in (0, -1, None):
+            self.assertRaises(ValueError, self.client.sweep, "abc/",
+                              expire=expire)
+        self.assertEqual(sorted(self.server.objects), ["abc/new", "xyz/old"])
+
+    def test_sweep_updated(self):
+        self.server.put("test", "abc/a", b"a")
+        self.server.put("test", "abc/b", b"b")
+        versions = {name: (int(metadata["generation"]),
+                           int(metadata["metageneration"]))
+                    for name, (metadata, _) in self.server.objects.items()}
+        self.server.patch("abc/a", {"customTime": "2021-01-01T00:00:00Z"})
+        errors = self.client.delete_many(["abc/a", "abc/b", "abc/c"],
+                                         versions=versions)
+        self.assertIsInstance(errors["abc/a"], PreconditionFailed)
+        self.assertIsInstance(errors["abc/c"], NotFound)
+        self.assertEqual(list(errors), ["abc/a", "abc/c"])
+        self.assertEqual(list(self.server.objects), ["abc/a"])
+
+    def test_metrics(self):
+        metrics = self.client.metrics = PrometheusMetrics()
+        self.client.get("abc")
+        self.client.set("abc", "content")
+        self.client.set("abc", "content")
+        self.client.get("abc")
+        self.server.patch("abc", {"customTime": (
+            datetime.now(timezone.utc) - timedelta(
+                seconds=60)).isoformat().replace("+00:00", "Z")})
+        self.client.get("abc", expire=30)
+        for result, count in (("miss", 1), ("hit", 1), ("expired", 1)):
+            self.assertEqual(
+                metrics.get("gcs_reads_total", result=result), count)
+        for result in ("uploaded", "unchanged"):
+            self.assertEqual(metrics.get("gcs_writes_total", result=result), 1)
+        self.assertEqual(
+            metrics.get("gcs_bytes_total", direction="upload"), 7)
+        self.assertEqual(
+            metrics.get("gcs_bytes_total", direction="download"), 14)
+        self.assertEqual(
+            metrics.get("gcs_operation_seconds", operation="get"), 3)
+
+    def test_set_unchanged(self):
+        self.client.set("abc", "content")
+        metadata, _ = self.server.objects["abc"]
+        del self.server.requests[:]
+        self.client.set("abc", "content")
+        # only the custom time is updated
+        self.assertEqual([request[0] for request in self.server.requests],
+                         ["GET", "PATCH"])
+        patched, _ = self.server.objects["abc"]
+        self.assertEqual(patched["generation"], metadata["generation"])
+        self.assertGreater(patched["customTime"], metadata["customTime"])
+
+        del self.server.requests[:]
+        self.client.set("abc", b"changed")
+        self.assertEqual([request[0] for request in self.server.requests],
+                         ["GET", "POST"])
+        self.assertEqual(self.server.objects["abc"][1], b"changed")
+
+        # compressed content is compared with the stored content
+        self.client.compression = "gzip"
+        self.client.compression_threshold = 1
+        self.client.set("abc", "content")
+        del self.server.requests[:]
+        self.client.set("abc", "content")
+        self.assertEqual(self.server.requests[-1][0], "PATCH")
+        self.assertEqual(self.client.get("abc"), b"content")
+        self.client.compression = None
+        self.client.set("abc", "content")
+        self.assertEqual(self.server.requests[-1][0], "POST")
+        self.assertEqual(self.server.objects["abc"][1], b"content")
+
+        self.client.replace = True
+        self.client.set("abc", "content")
+        self.assertEqual(self.server.requests[-1][0], "POST")
+
+    def test_compression(self):
+        content = '{"key": "value"}' * 100
+        for encoding in CODECS:
+            self.client.compression = encoding
+            self.client.set("abc", content)
+            metadata, stored = self.server.objects["abc"]
+            self.assertEqual(metadata["contentEncoding"], encoding)
+            self.assertLess(len(stored), len(content))
+            self.assertEqual(self.client.get("abc"), content.encode("utf-8"))
+        # below the threshold
+        self.client.set("abc", "content")
+        metadata, stored = self.server.objects["abc"]
+        self.assertEqual(metadata.get("contentEncoding"), None)
+        self.assertEqual(stored, b"content")
+        self.assertEqual(self.client.get("abc"), b"content")
+
+    def test_get_stream(self):
+        content = os.urandom(1000)
+        self.client.set("abc", content)
+        stream = self.client.get_stream("abc", expire=60, chunk_size=300)
+        self.assertEqual(stream.read(10), content[:10])
+        self.assertEqual(stream.read1(), content[10:300])
+        self.assertEqual(list(stream), [content[300:600], content[600:900],
+                                        content[900:]])
+        self.assertEqual(stream.read(), b"")
+        ranges = [request for request in self.server.requests
+                  if request[1].startswith("/download")]
+        self.assertEqual(len(ranges), 4)
+
+        stream = self.client.get_stream("abc", chunk_size=300)
+        self.assertEqual(stream.read(), content)
+        self.assertEqual(self.client.get_stream("missing"), None)
+
+        # compressed
+        text = '{"key": "value"}' * 1000
+        for encoding in CODECS:
+            self.client.compression = encoding
+            self.client.set("abc", text)
+            stream = self.client.get_stream("abc", chunk_size=100)
+            self.assertEqual(b"".join(stream), text.encode("utf-8"))
+
+        # a new generation fails an open stream
+        self.client.compression = None
+        self.client.set("abc", text)
+        stream = self.client.get_stream("abc", chunk_size=100)
+        stream.read(1)
+        self.client.set("abc", text + "x")
+        self.assertRaises(PreconditionFailed, stream.read)
+
+    def test_get_stream_expired(self):
+        self.server.put("test", "abc", b"content", {
+            "customTime": (datetime.now(timezone.utc) - timedelta(
+                seconds=60)).isoformat().replace("+00:00", "Z")})
+        self.assertEqual(self.client.get_stream("abc", expire=30), None)
+        self.assertEqual(
+            self.client.get_stream("abc", expire=90).read(), b"content")
+        self.server.put("test", "abc", b"content")
+        self.assertEqual(self.client.get_stream("abc"), None)
+
+    def test_parallel_transfers(self):
+        self.client.transfer_threshold = 1000
+        self.client.transfer_chunk_size = 300
+        content = os.urandom(2000)
+        self.client.set("abc", content)
+        metadata, stored = self.server.objects["abc"]
+        self.assertEqual(stored, content)
+        self.assertEqual(metadata["componentCount"], 7)
+        self.assertIn("customTime", metadata)
+        self.assertEqual(list(self.server.objects), ["abc"])
+
+        del self.server.requests[:]
+        self.assertEqual(self.client.get("abc"), content)
+        downloads = [request for request in self.server.requests
+                     if request[1].startswith("/download")]
+        # the first 1000 bytes, then 300 byte parts
+        self.assertEqual(len(downloads), 5)
+
+        # small and empty objects
+        self.client.set("abc", b"content")
+        self.assertNotIn("componentCount", self.server.objects["abc"][0])
+        self.assertEqual(self.client.get("abc"), b"content")
+        self.client.set("abc", b"")
+        self.assertEqual(self.client.get("abc"), b"")
+        self.assertEqual(self.client.get("missing"), None)
+
+        # compressed
+        self.client.compression = "gzip"
+        text = "".join(str(i) for i in range(2000))
+        self.client.set("abc", text)
+        self.assertEqual(self.client.get("abc"), text.encode("utf-8"))
+
+        # corrupted parts
+        metadata, stored = self.server.objects["abc"]
+        self.server.objects["abc"] = (metadata, stored[:-1] + b"x")
+        self.assertRaises(DataCorruption, self.client.get, "abc")
+
+    @patch('google.cloud.storage.Blob.delete')
+    @patch('google.cloud.storage.Blob.compose',
+           side_effect=KeyboardInterrupt)
+    def test_parallel_transfers_interrupted(self, mock_compose,
+                                            mock_delete):
+        self.client.transfer_threshold = 1000
+        self.client.transfer_chunk_size = 300
+        self.assertRaises(KeyboardInterrupt, self.client.set, "abc",
+                          os.urandom(2000))
+        self.assertEqual(len(self.server.objects), 7)
+        for name, (metadata, _) in self.server.objects.items():
+            self.assertIn(".part-", name)
+            self.assertIn("customTime", metadata)
+            self.server.patch(name, {"customTime": "2021-01-01T00:00:00Z"})
+        self.assertEqual(self.client.sweep("abc", expire=60)["deleted"], 7)
+        self.assertEqual(self.server.objects, {})
+
+    def test_chunked_upload(self):
+        self.client.transfer_threshold = 1000
+        self.client.transfer_chunk_size = 256 * 1024
+        content = os.urandom(600 * 1024)
+        self.client.set("abc", BytesIO(content))
+        self.assertEqual(self.server.objects["abc"][1], content)
+        uploads = [request for request in self.server.requests
+                   if request[0] == "PUT"]
+        self.assertEqual(len(uploads), 3)
+        self.assertEqual(self.client.get("abc", expire=60), content)
+
+        # small files are uploaded in a single request
+        del self.server.requests[:]
+        self.client.set("abc", BytesIO(b"content"))
+        self.assertEqual(self.server.objects["abc"][1], b"content")
+        self.assertEqual([request for request in self.server.requests
+                          if request[1].startswith("/upload")],
+                         [("POST", "/upload/storage/v1/b/test/o")])
+
+    def test_unsupported_compression(self):
+        self.assertRaises(ValueError, GCSBucketClient, "test",
+                          compression="unknown")
+
+    def test_warm_up(self):
+        self.client.lazy_bucket = True
+        self.client.warm_up()
+        self.assertEqual(self.server.requests, [
+            ("GET", "/storage/v1/b/test/o/gcs-clients-warm-up")])
+        self.assertEqual(self.client.pool_stats()["idle"], 1)
+
+    def test_warm_up_unavailable(self):
+        self.server.error_rate = 1
+        self.client.timeout = 0.5
+        start = time.monotonic()
+        self.assertRaises(GoogleAPIError, self.client.warm_up)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_pool_stats(self):
+        self.assertEqual(self.client.pool_stats()["pools"], 0)
+        self.client.set("abc", "content")
+        self.client.get("abc")
+        stats = self.client.pool_stats()
+        self.assertEqual(stats["pools"], 1)
+        self.assertEqual(stats["maxsize"], 4)
+        self.assertEqual(stats["connections"], 1)
+        self.assertEqual(stats["idle"], 1)
+        self.assertEqual(stats["requests"], 4)
@@ -0,0 +1,64 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import requests
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from gcs_clients.benchmark import benchmark_clients, measure, percentile
+from gcs_clients.tests.fake_gcs import FakeGCSServer
+
+
+class TestBenchmark(TestCase):
+    def test_percentile(self):
+        values = list(range(100, 0, -1))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([3], 99), 3)
+        self.assertEqual(percentile([], 50), 0.0)
+
+    def test_measure(self):
+        def call(value):
+            if value < 0:
+                raise ValueError(value)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            result = measure(call, [(1,), (-1,), (2,)], executor)
+        self.assertEqual(result["ops"], 3)
+        self.assertEqual(result["errors"], 1)
+        self.assertGreater(result["ops_per_sec"], 0)
+        self.assertLessEqual(result["p50_ms"], result["p99_ms"])
+
+    def test_benchmark_clients(self):
+        results = benchmark_clients(sizes=(100,), threads=(1, 2),
+                                    operations=4)
+        self.assertEqual(
+            [(result["operation"], result["threads"]) for result in results],
+            [(operation, threads) for threads in (1, 2) for operation in (
+                "set", "get", "delete", "updateCache", "getCache")])
+        for result in results:
+            self.assertEqual(result["ops"], 4)
+            self.assertEqual(result["errors"], 0)
+            self.assertEqual(result["size"], 100)
+
+
+class TestFakeGCSServerFaults(TestCase):
+    def test_latency(self):
+        server = FakeGCSServer(latency=0.05).start()
+        try:
+            start = time.monotonic()
+            response = requests.get(server.url + "/storage/v1/b/test")
+            self.assertEqual(response.status_code, 200)
+            self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        finally:
+            server.stop()
+
+    def test_error_rate(self):
+        server = FakeGCSServer(error_rate=1).start()
+        try:
+            response = requests.get(server.url + "/storage/v1/b/test")
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(server.errors, 1)
+        finally:
+            server.stop()
@@ -0,0 +1,71 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+from unittest import TestCase
+from gcs_clients.breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+from mock import MagicMock, patch
+
+
+@patch('gcs_clients.breaker.time.monotonic', return_value=100)
+class TestCircuitBreaker(TestCase):
+    def setUp(self):
+        self.on_change = MagicMock()
+        self.breaker = CircuitBreaker(
+            error_rate=0.5, min_calls=4, window=10, cool_down=30,
+            on_change=self.on_change)
+
+    def call(self, success, duration=0):
+        allowed = self.breaker.allow()
+        if allowed:
+            self.breaker.record(success, duration)
+        return allowed
+
+    def test_open(self, mock_time):
+        for success in (True, False, True):
+            self.assertTrue(self.call(success))
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.call(False))
+        self.assertEqual(self.breaker.state, OPEN)
+        self.on_change.assert_called_once_with(CLOSED, OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_half_open(self, mock_time):
+        for _ in range(4):
+            self.call(False)
+        mock_time.return_value = 129
+        self.assertFalse(self.breaker.allow())
+
+        # a single trial call after the cool down
+        mock_time.return_value = 130
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow())
+
+        mock_time.return_value = 160
+        self.assertTrue(self.call(True))
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual([c[0] for c in self.on_change.call_args_list], [
+            (CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, OPEN),
+            (OPEN, HALF_OPEN), (HALF_OPEN, CLOSED)])
+        # failures before the circuit closed aren't counted
+        self.call(False)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_slow_calls(self, mock_time):
+        self.breaker.slow_call = 1
+        for _ in range(3):
+            self.call(True, duration=0.5)
+        self.assertEqual(self.breaker.state, CLOSED)
+        for _ in range(3):
+            self.call(True, duration=2)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_reset(self, mock_time):
+        for _ in range(4):
+            self.call(False)
+        self.breaker.reset()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow())
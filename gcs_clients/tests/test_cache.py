@@ -0,0 +1,263 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timezone
+from multiprocessing import get_context
+from threading import Event, Thread
+from unittest import TestCase
+from gcs_clients.cache import (
+    DiskCache, DiskEntry, MemoryCache, NegativeCache, SingleFlight)
+from mock import patch
+
+
+def _disk_set(path, key, content):
+    DiskCache(path).set(key, content, datetime.now(timezone.utc), 2, 1)
+
+
+class TestMemoryCache(TestCase):
+    def setUp(self):
+        self.now = datetime.now(timezone.utc)
+
+    def test_get_set_delete(self):
+        cache = MemoryCache()
+        self.assertEqual(cache.get("abc"), None)
+        cache.set("abc", b"content", self.now)
+        self.assertEqual(cache.get("abc"), (b"content", self.now))
+        self.assertEqual(cache.size, 7)
+        cache.set("abc", b"new", self.now)
+        self.assertEqual(cache.get("abc"), (b"new", self.now))
+        self.assertEqual(cache.size, 3)
+        cache.delete("abc")
+        self.assertEqual(cache.get("abc"), None)
+        self.assertEqual(cache.size, 0)
+        cache.delete("abc")
+
+    def test_max_entries(self):
+        cache = MemoryCache(max_entries=2)
+        cache.set("a", b"1", self.now)
+        cache.set("b", b"2", self.now)
+        cache.get("a")
+        cache.set("c", b"3", self.now)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), (b"1", self.now))
+
+    def test_max_bytes(self):
+        cache = MemoryCache(max_bytes=10)
+        cache.set("a", b"12345", self.now)
+        cache.set("b", b"12345", self.now)
+        cache.set("c", b"123", self.now)
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.size, 8)
+        cache.set("d", b"12345678901", self.now)
+        self.assertEqual(cache.get("d"), None)
+        self.assertEqual(len(cache), 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    @patch("gcs_clients.cache.time.monotonic")
+    def test_ttl(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        cache = MemoryCache(ttl=60)
+        cache.set("abc", b"content", self.now)
+        mock_monotonic.return_value = 160
+        self.assertEqual(cache.get("abc"), (b"content", self.now))
+        mock_monotonic.return_value = 161
+        self.assertEqual(cache.get("abc"), None)
+        self.assertEqual(cache.size, 0)
+
+        # The ttl of content starts when it was read
+        cache.set("abc", b"content", self.now, since=100)
+        self.assertEqual(cache.get("abc"), None)
+
+        cache = MemoryCache(ttl=0)
+        cache.set("abc", b"content", self.now)
+        mock_monotonic.return_value = 100000
+        self.assertEqual(cache.get("abc"), (b"content", self.now))
+
+    @patch("gcs_clients.cache.time.monotonic")
+    def test_set_after_delete(self, mock_monotonic):
+        cache = MemoryCache(max_entries=1)
+        mock_monotonic.return_value = 100
+        cache.delete("abc")
+        # Content read before the delete isn't cached
+        cache.set("abc", b"old", self.now, since=99)
+        self.assertEqual(cache.get("abc"), None)
+        cache.set("abc", b"new", self.now, since=101)
+        self.assertEqual(cache.get("abc"), (b"new", self.now))
+        cache.delete("def")
+        cache.set("abc", b"old", self.now, since=99)
+        self.assertEqual(cache.get("abc"), (b"old", self.now))
+
+
+class TestDiskCache(TestCase):
+    def setUp(self):
+        self.now = datetime.now(timezone.utc)
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_set_delete(self):
+        cache = DiskCache(self.path)
+        self.assertEqual(cache.get("abc"), None)
+        cache.set("abc", b"content", self.now, 123, 2)
+        self.assertEqual(cache.get("abc"),
+                         DiskEntry(b"content", self.now, 123, 2))
+        cache.set("abc", b"new", self.now)
+        self.assertEqual(cache.get("abc"), (b"new", self.now, None, None))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(DiskCache(self.path).get("abc").content, b"new")
+        cache.delete("abc")
+        self.assertEqual(cache.get("abc"), None)
+        cache.delete("abc")
+
+    def test_shared_across_processes(self):
+        process = get_context("spawn").Process(
+            target=_disk_set, args=(self.path, "abc", b"content"))
+        process.start()
+        process.join()
+        entry = DiskCache(self.path).get("abc")
+        self.assertEqual(entry.content, b"content")
+        self.assertEqual(entry.generation, 2)
+
+    def test_invalid_entries(self):
+        cache = DiskCache(self.path)
+        cache.set("abc", b"content", self.now)
+        path = cache._path("abc")
+        with patch.object(DiskCache, "_path", return_value=path):
+            self.assertEqual(cache.get("xyz"), None)  # hash collision
+        with open(path, "wb") as f:
+            f.write(b"GCSC")
+        self.assertEqual(cache.get("abc"), None)
+        with open(path, "wb"):
+            pass
+        self.assertEqual(cache.get("abc"), None)
+
+    def test_max_bytes(self):
+        cache = DiskCache(self.path, max_bytes=200)
+        cache.set("a", b"1" * 50, self.now)
+        cache.set("b", b"2" * 50, self.now)
+        old = time.time() - 600
+        os.utime(cache._path("a"), (old, old))
+        os.utime(cache._path("b"), (old, old))
+        cache.get("a")  # updates its read time
+        cache.set("c", b"3" * 50, self.now)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a").content, b"1" * 50)
+        self.assertEqual(cache.get("c").content, b"3" * 50)
+        self.assertLessEqual(cache.size, 180)
+        cache.set("d", b"4" * 200, self.now)
+        self.assertEqual(cache.get("d"), None)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_write_failure(self):
+        cache = DiskCache(self.path)
+        with patch("os.replace", side_effect=OSError("disk full")):
+            cache.set("abc", b"content", self.now)
+        self.assertEqual(cache.get("abc"), None)
+        self.assertEqual(os.listdir(os.path.dirname(cache._path("abc"))), [])
+
+    def test_abandoned_writes(self):
+        cache = DiskCache(self.path)
+        cache.set("abc", b"content", self.now)
+        shard = os.path.dirname(cache._path("abc"))
+        abandoned = os.path.join(shard, cache.tmp_prefix + "x")
+        with open(abandoned, "wb") as f:
+            f.write(b"partial")
+        self.assertEqual(len(cache), 1)
+        os.utime(abandoned, (0, 0))
+        cache.evict()
+        self.assertFalse(os.path.exists(abandoned))
+
+
+class TestNegativeCache(TestCase):
+    def test_add_delete(self):
+        cache = NegativeCache(ttl=5)
+        self.assertNotIn("abc", cache)
+        cache.add("abc")
+        self.assertIn("abc", cache)
+        cache.delete("abc")
+        self.assertNotIn("abc", cache)
+        cache.delete("abc")
+
+    def test_ttl(self):
+        cache = NegativeCache(ttl=5)
+        with patch("time.monotonic", return_value=100):
+            cache.add("abc")
+        with patch("time.monotonic", return_value=104.9):
+            self.assertIn("abc", cache)
+        with patch("time.monotonic", return_value=105):
+            self.assertNotIn("abc", cache)
+        self.assertEqual(len(cache), 0)
+
+    def test_max_entries(self):
+        cache = NegativeCache(max_entries=2)
+        cache.add("a")
+        cache.add("b")
+        cache.add("a")
+        cache.add("c")
+        self.assertNotIn("b", cache)
+        self.assertIn("a", cache)
+        self.assertIn("c", cache)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class TestSingleFlight(TestCase):
+    def test_do(self):
+        single_flight = SingleFlight()
+        started, finish = Event(), Event()
+        calls, results = [], []
+
+        def fetch(key):
+            calls.append(key)
+            started.set()
+            finish.wait()
+            return "result"
+
+        leader = Thread(target=lambda: results.append(
+            single_flight.do("abc", fetch, "abc")))
+        leader.start()
+        started.wait()
+        followers = [Thread(target=lambda: results.append(
+            single_flight.do("abc", fetch, "abc"))) for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        finish.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual(calls, ["abc"])
+        self.assertEqual(results, ["result"] * 4)
+        # completed calls aren't shared
+        self.assertEqual(single_flight.do("abc", fetch, "abc"), "result")
+        self.assertEqual(calls, ["abc", "abc"])
+
+    def test_do_error(self):
+        single_flight = SingleFlight()
+
+        def fail():
+            raise ValueError("fail")
+
+        self.assertRaises(ValueError, single_flight.do, "abc", fail)
+        self.assertEqual(single_flight.do("abc", lambda: 1), 1)
+
+    def test_claim(self):
+        single_flight = SingleFlight(claim_timeout=30)
+        self.assertFalse(single_flight.is_claimed("abc"))
+        self.assertTrue(single_flight.claim("abc"))
+        self.assertTrue(single_flight.is_claimed("abc"))
+        self.assertFalse(single_flight.claim("abc"))
+        self.assertTrue(single_flight.claim("xyz"))
+        single_flight.release("abc")
+        self.assertTrue(single_flight.claim("abc"))
+        with patch("time.monotonic", return_value=10 ** 9):
+            self.assertFalse(single_flight.is_claimed("abc"))
+            self.assertTrue(single_flight.claim("abc"))
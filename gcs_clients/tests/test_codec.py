@@ -0,0 +1,35 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import gzip
+from unittest import TestCase
+from gcs_clients.benchmark import compare, sample_content
+from gcs_clients.codec import CODECS, compress, decompress
+
+
+class TestCodec(TestCase):
+    def test_codecs(self):
+        content = b'{"key": "value"}' * 100
+        self.assertIn("gzip", CODECS)
+        for encoding in CODECS:
+            compressed = compress(content, encoding)
+            self.assertLess(len(compressed), len(content))
+            self.assertEqual(decompress(compressed, encoding), content)
+
+    def test_gzip(self):
+        content = b'{"key": "value"}' * 100
+        self.assertEqual(gzip.decompress(compress(content, "gzip")), content)
+        # deterministic output
+        self.assertEqual(compress(content, "gzip"), compress(content, "gzip"))
+        self.assertEqual(compress(content, "gzip")[4:8], bytes(4))  # mtime
+
+    def test_decompress_unknown(self):
+        self.assertEqual(decompress(b"content", None), b"content")
+        self.assertEqual(decompress(b"content", "identity"), b"content")
+
+    def test_benchmark(self):
+        results = compare(sample_content(4096), bandwidth=10)
+        self.assertEqual(results[0]["codec"], "none")
+        self.assertEqual(len(results), len(CODECS) + 1)
+        for result in results[1:]:
+            self.assertLess(result["bytes"], results[0]["bytes"])
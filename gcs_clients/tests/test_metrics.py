@@ -0,0 +1,69 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+from unittest import TestCase
+from gcs_clients.metrics import MetricsSink, PrometheusMetrics
+from mock import MagicMock
+
+
+class TestMetricsSink(TestCase):
+    def test_discard(self):
+        sink = MetricsSink()
+        sink.increment("requests_total", result="hit")
+        sink.observe("latency_seconds", 0.1)
+        with sink.timer("operation", operation="get"):
+            pass
+
+    def test_span(self):
+        tracer = MagicMock()
+        sink = MetricsSink(tracer=tracer)
+        with sink.timer("gcs_operation", operation="get"):
+            pass
+        tracer.start_as_current_span.assert_called_once_with(
+            "gcs_operation", attributes={"operation": "get"})
+        span = tracer.start_as_current_span.return_value
+        span.__enter__.assert_called_once_with()
+        span.__exit__.assert_called_once_with(None, None, None)
+
+
+class TestPrometheusMetrics(TestCase):
+    def setUp(self):
+        self.metrics = PrometheusMetrics(buckets=(0.1, 1))
+
+    def test_counters(self):
+        self.metrics.increment("requests_total", result="hit")
+        self.metrics.increment("requests_total", 2, result="hit")
+        self.metrics.increment("requests_total", result="miss")
+        self.assertEqual(self.metrics.get("requests_total", result="hit"), 3)
+        self.assertEqual(self.metrics.get("requests_total", result="miss"), 1)
+        self.assertEqual(self.metrics.get("requests_total"), 0)
+
+    def test_timer(self):
+        with self.metrics.timer("op", operation="get"):
+            pass
+        try:
+            with self.metrics.timer("op", operation="get"):
+                raise ValueError("fail")
+        except ValueError:
+            pass
+        self.assertEqual(self.metrics.get("op_seconds", operation="get"), 2)
+        self.assertEqual(
+            self.metrics.get("op_errors_total", operation="get"), 1)
+
+    def test_render(self):
+        self.metrics.increment("requests_total", result='a"b')
+        self.metrics.observe("op_seconds", 0.05, operation="get")
+        self.metrics.observe("op_seconds", 0.5, operation="get")
+        self.metrics.observe("op_seconds", 5, operation="get")
+        self.assertEqual(self.metrics.render(), "\n".join([
+            '# TYPE requests_total counter',
+            'requests_total{result="a\\"b"} 1',
+            '# TYPE op_seconds histogram',
+            'op_seconds_bucket{operation="get",le="0.1"} 1',
+            'op_seconds_bucket{operation="get",le="1"} 2',
+            'op_seconds_bucket{operation="get",le="+Inf"} 3',
+            'op_seconds_sum{operation="get"} 5.55',
+            'op_seconds_count{operation="get"} 3',
+        ]) + "\n")
+        self.metrics.clear()
+        self.assertEqual(self.metrics.render(), "\n")
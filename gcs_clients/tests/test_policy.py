@@ -0,0 +1,98 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from gcs_clients.policy import ReadPolicy
+from google.api_core.exceptions import ServiceUnavailable
+from google.cloud.storage.retry import DEFAULT_RETRY
+from mock import MagicMock
+
+
+class TestReadPolicy(TestCase):
+    def test_retry(self):
+        self.assertIs(ReadPolicy().retry, DEFAULT_RETRY)
+        self.assertIs(ReadPolicy(deadline=0).retry, None)
+        retry = ReadPolicy(deadline=2, initial=0.2, maximum=1).retry
+        self.assertEqual(retry._deadline, 2)
+        self.assertEqual(retry._initial, 0.2)
+        self.assertEqual(retry._maximum, 1)
+        self.assertTrue(retry._predicate(ServiceUnavailable("fail")))
+
+    def test_delay(self):
+        policy = ReadPolicy(hedge_delay=0.01, min_samples=10)
+        for i in range(9):
+            policy.record(i)
+        self.assertEqual(policy.delay(), 0.01)
+        policy.record(9)
+        self.assertEqual(policy.delay(), 9)
+        policy.hedge_percentile = 50
+        for i in range(10):
+            policy.record(0.001)
+        self.assertEqual(policy.delay(), 0.01)
+
+    def test_call(self):
+        fn = MagicMock(return_value="content")
+        policy = ReadPolicy()
+        self.assertEqual(policy.call(fn, "abc"), "content")
+        fn.assert_called_once_with("abc")
+        self.assertEqual(len(policy._latencies), 1)
+
+    def test_hedge(self):
+        policy = ReadPolicy(hedge=True, hedge_delay=0.05)
+        calls = []
+
+        def fn(key):
+            calls.append(key)
+            if len(calls) == 1:
+                time.sleep(0.2)
+                raise ServiceUnavailable("fail")
+            return "hedge"
+
+        # the hedge is used when the first request fails
+        self.assertEqual(policy.call(fn, "abc"), "hedge")
+        self.assertEqual(policy.hedged, 1)
+
+        # the first request is used when it succeeds
+        calls[:] = []
+
+        def slow(key):
+            calls.append(key)
+            if len(calls) == 1:
+                time.sleep(0.2)
+                return "slow"
+            raise ServiceUnavailable("fail")
+
+        self.assertEqual(policy.call(slow, "abc"), "slow")
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(policy.hedged, 2)
+
+        # fast reads aren't hedged
+        self.assertEqual(policy.call(MagicMock(return_value="fast"), "abc"),
+                         "fast")
+        self.assertEqual(policy.hedged, 2)
+
+        fn = MagicMock(side_effect=ServiceUnavailable("fail"))
+        self.assertRaises(ServiceUnavailable, policy.call, fn, "abc")
+        self.assertEqual(fn.call_count, 1)
+
+    def test_hedge_concurrent(self):
+        # the first requests of concurrent callers aren't queued behind the
+        # hedge threads
+        policy = ReadPolicy(hedge=True, hedge_delay=0.2, workers=2)
+        calls = []
+
+        def fn(key):
+            calls.append(key)
+            time.sleep(0.05)
+            return key
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=40) as executor:
+            results = list(executor.map(
+                lambda n: policy.call(fn, n), range(40)))
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(results, list(range(40)))
+        self.assertEqual(len(calls), 40)
+        self.assertEqual(policy.hedged, 0)
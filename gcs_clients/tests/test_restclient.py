@@ -2,12 +2,18 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import json
-from datetime import datetime, timedelta
+import os
+from io import BytesIO
+from datetime import datetime, timedelta, timezone
 from unittest import TestCase
 from commonconf import override_settings
 from gcs_clients import RestclientGCSClient
-from gcs_clients.restclient import CachedHTTPResponse
+from gcs_clients.restclient import (
+    CachedHTTPResponse, PAYLOAD_HEADER, PAYLOAD_MAGIC, PAYLOAD_VERSION,
+    parse_cache_control)
+from google.api_core.exceptions import GoogleAPIError
 from mock import MagicMock, patch
+from urllib3._collections import HTTPHeaderDict
 
 
 class MockClientCachePolicy(RestclientGCSClient):
@@ -44,13 +50,29 @@ class TestCachedHTTPResponse(TestCase):
 
         self.assertEqual(self.response.read(), self.test_data)
 
+        response = CachedHTTPResponse(data=memoryview(b"abcdef"))
+        self.assertEqual([response.read(4) for _ in range(3)],
+                         [b"abcd", b"ef", b""])
+        response.data = b"abcdef"
+        self.assertEqual(response.read(2), b"ab")
+        self.assertEqual(response.read(), b"cdef")
+        self.assertEqual(empty.read(2), b"")
+
     def test_getheader(self):
         empty = CachedHTTPResponse()
         self.assertEqual(empty.getheader("cache-control"), "")
+        self.assertEqual(empty.getheader("cache-control", None), None)
 
         self.assertEqual(self.response.getheader("content-disposition"),
                          "attachment; filename='name.ext'")
 
+        response = CachedHTTPResponse(headers=HTTPHeaderDict(
+            {"Content-Type": "text/plain"}))
+        self.assertEqual(response.getheader("content-type"), "text/plain")
+        response.headers = {"Content-Type": "application/json"}
+        self.assertEqual(response.getheader("content-type"),
+                         "application/json")
+
 
 class TestCachePolicy(TestCase):
 
@@ -75,6 +97,122 @@ class TestCachePolicy(TestCase):
                 "abc", "/api/v1/test", 200), 3600)
 
 
+class TestCacheHeaders(TestCase):
+    def setUp(self):
+        self.client = RestclientGCSClient()
+
+    def expiration(self, **headers):
+        response = CachedHTTPResponse(
+            status=200, headers={k.replace("_", "-"): v
+                                 for k, v in headers.items()})
+        return self.client.get_cache_header_expiration_time(
+            "abc", "/api/v1/test", response)
+
+    def test_parse_cache_control(self):
+        self.assertEqual(parse_cache_control(None), {})
+        self.assertEqual(
+            parse_cache_control('Public, max-age=60, no-cache="Set-Cookie"'),
+            {"public": None, "max-age": "60", "no-cache": "Set-Cookie"})
+
+    def test_get_cache_header_expiration_time(self):
+        self.assertEqual(self.expiration(), None)
+        self.assertEqual(self.expiration(Cache_Control="max-age=60"), 60)
+        self.assertEqual(self.expiration(
+            Cache_Control="max-age=60, s-maxage=30"), 30)
+        self.assertEqual(self.expiration(
+            Cache_Control="max-age=60, no-cache"), 0)
+        self.assertEqual(self.expiration(Cache_Control="max-age=x"), None)
+        self.assertEqual(self.expiration(
+            Date="Wed, 21 Oct 2015 07:28:00 GMT",
+            Expires="Wed, 21 Oct 2015 08:28:00 GMT"), 3600)
+        self.assertEqual(self.expiration(
+            Date="Wed, 21 Oct 2015 07:28:00 GMT", Expires="0"), 0)
+        self.assertEqual(self.expiration(
+            Date="Wed, 21 Oct 2015 07:28:00 GMT",
+            Last_Modified="Wed, 20 Oct 2015 07:28:00 GMT"), 8640)
+        self.assertEqual(self.expiration(
+            Cache_Control="max-age=60",
+            Expires="Wed, 21 Oct 2015 08:28:00 GMT"), 60)
+
+    @override_settings(RESTCLIENTS_GCS_CACHE_HEADERS=True,
+                       RESTCLIENTS_GCS_DEFAULT_EXPIRY=60)
+    @patch('gcs_clients.GCSBucketClient.get_entry')
+    def test_getCache(self, mock_get_entry):
+        def cache(seconds, **headers):
+            response = CachedHTTPResponse(status=200, data=b"a", headers={
+                k.replace("_", "-"): v for k, v in headers.items()})
+            mock_get_entry.return_value = (
+                self.client._format_data(response),
+                datetime.now(timezone.utc) - timedelta(seconds=seconds))
+            return self.client.getCache("abc", "/api/v1/test")
+
+        self.assertIsNotNone(cache(20, Cache_Control="max-age=30"))
+        mock_get_entry.assert_called_with("abc/api/v1/test")
+        self.assertIsNone(cache(40, Cache_Control="max-age=30"))
+        self.assertIsNone(cache(0, Cache_Control="no-cache"))
+        # the default expiry without cache headers
+        self.assertIsNotNone(cache(40))
+        self.assertIsNone(cache(80))
+        self.assertIsNotNone(cache(80, Cache_Control="max-age=100"))
+        mock_get_entry.return_value = (None, None)
+        self.assertIsNone(self.client.getCache("abc", "/api/v1/test"))
+
+    @override_settings(RESTCLIENTS_GCS_CACHE_HEADERS=True,
+                       RESTCLIENTS_GCS_DEFAULT_GRACE=30)
+    @patch('gcs_clients.GCSBucketClient.get_entry')
+    def test_getCache_stale(self, mock_get_entry):
+        response = CachedHTTPResponse(status=200, data=b"a", headers={
+            "Cache-Control": "max-age=30"})
+        mock_get_entry.return_value = (
+            self.client._format_data(response),
+            datetime.now(timezone.utc) - timedelta(seconds=40))
+        self.client._refresh_executor = MagicMock()
+        fetch = MagicMock()
+        self.assertIsNone(self.client.getCache("abc", "/api/v1/test"))
+        cached = self.client.getCache("abc", "/api/v1/test", fetch=fetch)
+        self.assertTrue(cached["stale"])
+        self.client._refresh_executor.submit.assert_called_once_with(
+            self.client._refresh, "abc", "/api/v1/test", fetch)
+
+    @patch('gcs_clients.GCSBucketClient.get_entry')
+    def test_getCacheValidators(self, mock_get_entry):
+        response = CachedHTTPResponse(status=200, data=b"a", headers={
+            "ETag": '"abc"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"})
+        mock_get_entry.return_value = (
+            self.client._format_data(response),
+            datetime.now(timezone.utc) - timedelta(days=1))
+        self.assertEqual(
+            self.client.getCacheValidators("abc", "/api/v1/test"),
+            {"If-None-Match": '"abc"',
+             "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT"})
+        mock_get_entry.return_value = (None, None)
+        self.assertEqual(
+            self.client.getCacheValidators("abc", "/api/v1/test"), {})
+
+    @override_settings(RESTCLIENTS_GCS_CACHE_HEADERS=True)
+    @patch('gcs_clients.GCSBucketClient.set_many', return_value={})
+    @patch('gcs_clients.GCSBucketClient.set')
+    @patch('gcs_clients.GCSBucketClient.touch')
+    def test_updateCache(self, mock_touch, mock_set, mock_set_many):
+        not_modified = CachedHTTPResponse(status=304, headers={})
+        self.client.updateCache("abc", "/api/v1/test", not_modified)
+        mock_touch.assert_called_once_with("abc/api/v1/test")
+        assert not mock_set.called
+
+        no_store = CachedHTTPResponse(status=200, data=b"a", headers={
+            "Cache-Control": "no-store"})
+        self.client.updateCache("abc", "/api/v1/test", no_store)
+        assert not mock_set.called
+
+        response = CachedHTTPResponse(status=200, data=b"a", headers={})
+        self.client.updateCacheMany("abc", {
+            "/api/v1/a": not_modified, "/api/v1/b": no_store,
+            "/api/v1/c": response})
+        mock_touch.assert_called_with("abc/api/v1/a")
+        mock_set_many.assert_called_once_with(
+            {"abc/api/v1/c": self.client._format_data(response)})
+
+
 class TestRestclientGCSClient(TestCase):
     def setUp(self):
         # mock blob
@@ -105,10 +243,12 @@ class TestRestclientGCSClient(TestCase):
 
     @patch('gcs_clients.RestclientGCSClient._create_key',
            return_value="abc/api/v1/test")
-    def test_getCache_expired(self, mock_create_key):
+    @patch('gcs_clients.base.CacheBlob')
+    def test_getCache_expired(self, mock_cache_blob, mock_create_key):
+        mock_cache_blob.return_value = self.mock_blob
         self.mock_blob.custom_time = \
             datetime.utcnow() - timedelta(seconds=11)
-        self.mock_blob.download_as_string = MagicMock(
+        self.mock_blob.download_as_bytes = MagicMock(
             return_value='{'
             '"status": 200,'
             '"headers": "\'Content-Disposition\': \'attachment; '
@@ -127,6 +267,94 @@ class TestRestclientGCSClient(TestCase):
         self.assertIn("response", response)
         self.assertEqual(CachedHTTPResponse, type(response["response"]))
 
+    @patch('gcs_clients.GCSBucketClient.get_many')
+    def test_getCacheMany(self, mock_get_many):
+        mock_get_many.return_value = (
+            {"abc/api/v1/a": '{"status": 200, "headers": {}, "data": "a"}',
+             "abc/api/v1/b": None},
+            {"abc/api/v1/c": GoogleAPIError("fail")})
+        self.client.get_cache_expiration_time = MagicMock(
+            side_effect=[60, 60, 60, None])
+        response = self.client.getCacheMany(
+            "abc", ["/api/v1/a", "/api/v1/b", "/api/v1/c", "/api/v1/d"])
+        mock_get_many.assert_called_once_with(
+            ["abc/api/v1/a", "abc/api/v1/b", "abc/api/v1/c"],
+            expire={"abc/api/v1/a": 60, "abc/api/v1/b": 60,
+                    "abc/api/v1/c": 60})
+        self.assertEqual(response["/api/v1/a"]["response"].data, "a")
+        self.assertEqual(response["/api/v1/b"], None)
+        self.assertEqual(response["/api/v1/c"], None)
+        self.assertEqual(response["/api/v1/d"], None)
+
+    @patch('gcs_clients.GCSBucketClient.delete_many', return_value={})
+    def test_deleteCacheMany(self, mock_delete_many):
+        self.client.deleteCacheMany("abc", ["/api/v1/a", "/api/v1/b"])
+        mock_delete_many.assert_called_once_with(
+            ["abc/api/v1/a", "abc/api/v1/b"])
+
+    @patch('gcs_clients.GCSBucketClient.set_many', return_value={})
+    def test_updateCacheMany(self, mock_set_many):
+        response = CachedHTTPResponse(status=200, data=b"a", headers={})
+        self.client.get_cache_expiration_time = MagicMock(
+            side_effect=[60, None])
+        self.client.updateCacheMany(
+            "abc", {"/api/v1/a": response, "/api/v1/b": response})
+        mock_set_many.assert_called_once_with(
+            {"abc/api/v1/a": self.client._format_data(response)})
+
+    @override_settings(RESTCLIENTS_GCS_REFRESH_WORKERS=3)
+    def test_refresh_executor(self):
+        client = RestclientGCSClient()
+        self.assertEqual(client.refresh_executor._max_workers, 3)
+        self.assertIs(client.refresh_executor, client.refresh_executor)
+        self.assertIsNot(client.refresh_executor, client.executor)
+
+    @override_settings(RESTCLIENTS_GCS_DEFAULT_EXPIRY=60,
+                       RESTCLIENTS_GCS_DEFAULT_GRACE=30)
+    @patch('gcs_clients.GCSBucketClient.set')
+    @patch('gcs_clients.GCSBucketClient.get_stale')
+    def test_getCache_stale(self, mock_get_stale, mock_set):
+        data = '{"status": 200, "headers": {}, "data": "a"}'
+        response = CachedHTTPResponse(status=200, data=b"b", headers={})
+        fetch = MagicMock(return_value=response)
+        self.client._refresh_executor = MagicMock()
+
+        mock_get_stale.return_value = (data, False)
+        cached = self.client.getCache("abc", "/api/v1/test", fetch=fetch)
+        mock_get_stale.assert_called_once_with(
+            "abc/api/v1/test", expire=60, grace=30)
+        self.assertNotIn("stale", cached)
+        assert not self.client._refresh_executor.submit.called
+
+        mock_get_stale.return_value = (data, True)
+        cached = self.client.getCache("abc", "/api/v1/test", fetch=fetch)
+        self.assertTrue(cached["stale"])
+        self.assertEqual(cached["response"].data, "a")
+        self.client._refresh_executor.submit.assert_called_once_with(
+            self.client._refresh, "abc", "/api/v1/test", fetch)
+        # a single refresh while one is in progress
+        self.client.getCache("abc", "/api/v1/test", fetch=fetch)
+        self.assertEqual(self.client._refresh_executor.submit.call_count, 1)
+        self.client._refresh("abc", "/api/v1/test", fetch)
+        mock_set.assert_called_once_with(
+            "abc/api/v1/test", self.client._format_data(response), expire=60)
+        self.assertTrue(self.client.claimRefresh("abc", "/api/v1/test"))
+
+        # failed refresh releases the claim
+        fetch.side_effect = ValueError("fail")
+        self.client._refresh("abc", "/api/v1/test", fetch)
+        self.assertTrue(self.client.claimRefresh("abc", "/api/v1/test"))
+
+    @override_settings(RESTCLIENTS_GCS_DEFAULT_GRACE=30)
+    @patch('gcs_clients.GCSBucketClient.get', return_value=None)
+    def test_getCache_no_grace(self, mock_get):
+        # no stale responses without fetch, or with no expiry
+        fetch = MagicMock()
+        self.assertEqual(self.client.getCache("abc", "/api/v1/test"), None)
+        self.assertEqual(self.client.getCache(
+            "abc", "/api/v1/test", fetch=fetch), None)
+        mock_get.assert_called_with("abc/api/v1/test", expire=0)
+
     @patch('gcs_clients.GCSBucketClient.delete')
     @patch('gcs_clients.RestclientGCSClient._create_key',
            return_value="abc/api/v1/test")
@@ -151,6 +379,78 @@ class TestRestclientGCSClient(TestCase):
             mock_set.assert_called_once_with("abc/api/v1/test", mock_data,
                                              expire=0)
 
+    @patch('gcs_clients.GCSBucketClient.set')
+    def test_refresh_claims(self, mock_set):
+        self.assertTrue(self.client.claimRefresh("abc", "/api/v1/test"))
+        self.assertFalse(self.client.claimRefresh("abc", "/api/v1/test"))
+        self.client.releaseRefresh("abc", "/api/v1/test")
+        self.assertTrue(self.client.claimRefresh("abc", "/api/v1/test"))
+        # released by updateCache, even on error
+        mock_set.side_effect = GoogleAPIError("fail")
+        response = CachedHTTPResponse(status=200, data=b"a", headers={})
+        self.client.updateCache("abc", "/api/v1/test", response)
+        self.assertTrue(self.client.claimRefresh("abc", "/api/v1/test"))
+        self.client.get_cache_expiration_time = MagicMock(return_value=None)
+        self.client.updateCache("abc", "/api/v1/test", response)
+        self.assertTrue(self.client.claimRefresh("abc", "/api/v1/test"))
+
+    @override_settings(GCS_METRICS=True)
+    @patch('gcs_clients.GCSBucketClient.set')
+    @patch('gcs_clients.GCSBucketClient.get')
+    def test_metrics(self, mock_get, mock_set):
+        client = RestclientGCSClient()
+        response = CachedHTTPResponse(status=200, data=b"a", headers={})
+        mock_get.return_value = None
+        client.getCache("abc", "/api/v1/test")
+        mock_get.return_value = client._format_data(response)
+        client.getCache("abc", "/api/v1/test")
+        client.getCache("xyz", "/api/v1/test")
+        client.updateCache("abc", "/api/v1/test", response)
+        metrics = client.metrics
+        for service, result, count in (("abc", "hit", 1), ("abc", "miss", 1),
+                                       ("xyz", "hit", 1)):
+            self.assertEqual(metrics.get(
+                "restclient_cache_requests_total", service=service,
+                result=result), count)
+        self.assertEqual(metrics.get(
+            "restclient_cache_seconds", operation="getCache", service="abc"),
+            2)
+        self.assertEqual(metrics.get(
+            "restclient_cache_seconds", operation="updateCache",
+            service="abc"), 1)
+
+    @override_settings(GCS_CIRCUIT_BREAKER=True)
+    @patch('gcs_clients.GCSBucketClient.get_many')
+    @patch('gcs_clients.GCSBucketClient.set')
+    def test_circuit_open(self, mock_set, mock_get_many):
+        client = RestclientGCSClient()
+        client.client._client = MagicMock()
+        for _ in range(20):
+            client.circuit_breaker.allow()
+            client.circuit_breaker.record(False)
+        response = CachedHTTPResponse(status=200, data=b"a", headers={})
+        client.updateCache("abc", "/api/v1/test", response)
+        assert not mock_set.called
+        self.assertTrue(client.claimRefresh("abc", "/api/v1/test"))
+        self.assertEqual(client.getCacheMany("abc", ["/api/v1/test"]),
+                         {"/api/v1/test": None})
+        assert not mock_get_many.called
+
+    @override_settings(GCS_WRITE_BEHIND=True)
+    @patch('gcs_clients.GCSBucketClient.set')
+    def test_updateCache_write_behind(self, mock_set):
+        client = RestclientGCSClient()
+        client.client._client = MagicMock()
+        response = CachedHTTPResponse(status=200, data=b"a", headers={})
+        client.updateCache("abc", "/api/v1/test", response)
+        client.updateCacheMany("abc", {"/api/v1/a": response})
+        self.assertTrue(client.flush(timeout=5))
+        mock_set.assert_any_call("abc/api/v1/test",
+                                 client._format_data(response), expire=0)
+        mock_set.assert_any_call("abc/api/v1/a",
+                                 client._format_data(response), expire=0)
+        self.assertTrue(self.client.flush())
+
     def test_create_key(self):
         self.assertEqual(self.client._create_key("abc", "/api/v1/test"),
                          "abc/api/v1/test")
@@ -175,6 +475,139 @@ class TestRestclientGCSClient(TestCase):
             "abc", long_url, base_path='2021-spring/9'),
                          "2021-spring/9/abc{}".format(long_url))
 
+    @override_settings(RESTCLIENTS_GCS_HASHED_KEYS=True)
+    def test_create_key_hashed(self):
+        key = self.client._create_key("abc", "/api/v1/test?b=2&a=1&a=0")
+        base, shard, path = key.split("/", 2)
+        self.assertEqual(base, "abc")
+        self.assertRegex(shard, "^[0-9a-f]{4}$")
+        self.assertEqual(path, "api/v1/test?a=1&a=0&b=2")
+        self.assertEqual(
+            self.client._create_key("abc", "/api/v1/test?a=1&b=2&a=0"), key)
+        self.assertNotEqual(
+            self.client._create_key("abc", "/api/v1/test?a=0&a=1&b=2"), key)
+        self.assertEqual(
+            self.client._create_key("abc", "/api/v1/test?b=2&a=1&a=0",
+                                    base_path="/2021-spring/9/"),
+            "2021-spring/9/" + key)
+        self.assertRegex(self.client._create_key("abc", "/api/v1/test"),
+                         "^abc/[0-9a-f]{4}/api/v1/test$")
+        self.assertEqual(
+            self.client._create_key("abc", "/api/v1/test?b=2&a=1",
+                                    hashed=False),
+            "abc/api/v1/test?b=2&a=1")
+
+        long_url = "/api/v1/test?q={}".format("x" * 300)
+        key = self.client._create_key("abc", long_url)
+        self.assertRegex(key, "^abc/[0-9a-f]{4}/api/v1/test"
+                              "\\?sha256=[0-9a-f]{64}$")
+        self.assertNotEqual(self.client._create_key("abc", long_url + "y"),
+                            key)
+        # Sequential urls are spread over shards
+        shards = {self.client._create_key(
+            "abc", "/api/v1/person/{:06d}".format(i)).split("/")[1]
+            for i in range(20)}
+        self.assertGreater(len(shards), 15)
+
+        with override_settings(RESTCLIENTS_GCS_HASHED_KEYS=True,
+                               RESTCLIENTS_GCS_MAX_QUERY_LENGTH=1000):
+            self.assertTrue(self.client._create_key(
+                "abc", long_url).endswith(long_url))
+
+    @override_settings(RESTCLIENTS_GCS_HASHED_KEYS=True)
+    @patch('gcs_clients.GCSBucketClient.get')
+    def test_getCache_legacy_key(self, mock_get):
+        data = self.client._format_data(
+            CachedHTTPResponse(status=200, data=b"a", headers={}))
+        key = self.client._create_key("abc", "/api/v1/test")
+        mock_get.side_effect = lambda url_key, expire: (
+            data if url_key == "abc/api/v1/test" else None)
+        response = self.client.getCache("abc", "/api/v1/test")
+        self.assertEqual(response["response"].data, b"a")
+        self.assertEqual([call[0][0] for call in mock_get.call_args_list],
+                         [key, "abc/api/v1/test"])
+
+        mock_get.reset_mock()
+        with override_settings(RESTCLIENTS_GCS_HASHED_KEYS=True,
+                               RESTCLIENTS_GCS_LEGACY_KEYS=False):
+            self.assertEqual(self.client.getCache("abc", "/api/v1/test"),
+                             None)
+        mock_get.assert_called_once_with(key, expire=0)
+
+    @override_settings(RESTCLIENTS_GCS_HASHED_KEYS=True)
+    @patch('gcs_clients.GCSBucketClient.get_many')
+    def test_getCacheMany_legacy_key(self, mock_get_many):
+        data = self.client._format_data(
+            CachedHTTPResponse(status=200, data=b"a", headers={}))
+        key_a = self.client._create_key("abc", "/api/v1/a")
+        key_b = self.client._create_key("abc", "/api/v1/b")
+        mock_get_many.side_effect = [
+            ({key_a: data, key_b: None}, {}),
+            ({"abc/api/v1/b": data}, {})]
+        response = self.client.getCacheMany("abc", ["/api/v1/a", "/api/v1/b"])
+        self.assertEqual(response["/api/v1/a"]["response"].data, b"a")
+        self.assertEqual(response["/api/v1/b"]["response"].data, b"a")
+        mock_get_many.assert_called_with(
+            ["abc/api/v1/b"], expire={"abc/api/v1/b": 0})
+
+    @override_settings(RESTCLIENTS_GCS_HASHED_KEYS=True)
+    @patch('gcs_clients.GCSBucketClient.delete_many', return_value={})
+    @patch('gcs_clients.GCSBucketClient.delete')
+    def test_deleteCache_legacy_key(self, mock_delete, mock_delete_many):
+        self.client.deleteCache("abc", "/api/v1/test")
+        mock_delete.assert_called_once_with(
+            self.client._create_key("abc", "/api/v1/test"))
+        mock_delete_many.assert_called_once_with(["abc/api/v1/test"])
+
+        mock_delete_many.reset_mock()
+        self.client.deleteCacheMany("abc", ["/api/v1/a"])
+        self.assertEqual(mock_delete_many.call_args_list[1][0][0],
+                         ["abc/api/v1/a"])
+
+    @patch('gcs_clients.GCSBucketClient.sweep', return_value={})
+    def test_sweep_expired(self, mock_sweep):
+        self.assertEqual(self.client.sweep_expired(60, service="abc"), {})
+        mock_sweep.assert_called_once_with("abc/", expire=60, page_size=1000)
+        with patch.dict(os.environ, {"GCS_BASE_PATH": "/2021-spring/9/"}):
+            self.client.sweep_expired(60, page_size=10)
+            mock_sweep.assert_called_with("2021-spring/9/", expire=60,
+                                          page_size=10)
+        self.client.sweep_expired(60)
+        mock_sweep.assert_called_with("", expire=60, page_size=1000)
+        for expire in (0, -1, None):
+            self.assertRaises(ValueError, self.client.sweep_expired, expire,
+                              service="abc")
+        self.assertEqual(mock_sweep.call_count, 3)
+
+    @patch('gcs_clients.GCSBucketClient.sweep', return_value={})
+    def test_invalidate_prefix(self, mock_sweep):
+        self.client.invalidate_prefix("abc", "/api/v1/person/")
+        mock_sweep.assert_called_once_with("abc/api/v1/person/",
+                                           page_size=1000, all=True)
+
+        urls = ["/api/v1/person/1", "/api/v1/person/2?a=1",
+                "/api/v1/persons", "/api/v1/group/1",
+                "/api/v1/group/api/v1/person/1"]
+        with override_settings(RESTCLIENTS_GCS_HASHED_KEYS=True):
+            self.client.invalidate_prefix("abc", "/api/v1/person/")
+            prefix = mock_sweep.call_args[0][0]
+            match = mock_sweep.call_args[1]["match"]
+            self.assertEqual(prefix, "abc/")
+            hashed = [self.client._create_key("abc", url) for url in urls]
+            legacy = [self.client._create_key("abc", url, hashed=False)
+                      for url in urls]
+        self.assertEqual([match(key) for key in hashed],
+                         [True, True, False, False, False])
+        self.assertEqual([match(key) for key in legacy],
+                         [True, True, False, False, False])
+
+        with override_settings(RESTCLIENTS_GCS_HASHED_KEYS=True,
+                               RESTCLIENTS_GCS_LEGACY_KEYS=False):
+            self.client.invalidate_prefix("abc", "/api/v1/person/")
+            match = mock_sweep.call_args[1]["match"]
+        self.assertEqual([match(key) for key in legacy],
+                         [False, False, False, False, False])
+
     def test_format_data(self):
         self.test_response = CachedHTTPResponse(
             status=200,
@@ -182,11 +615,81 @@ class TestRestclientGCSClient(TestCase):
             headers={"Content-Disposition": "attachment; filename='fname.ext'"}
         )
         formatted_response = self.client._format_data(self.test_response)
+        header_block = json.dumps(
+            {"status": 200,
+             "headers": {"Content-Disposition": "attachment; "
+                         "filename=\'fname.ext\'"}}).encode("utf-8")
         self.assertEqual(
             formatted_response,
-            json.dumps(
-                {"status": 200,
-                 "headers": {"Content-Disposition": "attachment; "
-                             "filename=\'fname.ext\'"},
-                 "data": "{\"a\": 1, \"b\": \"test\", \"c\": []}"}
-            ))
+            PAYLOAD_HEADER.pack(PAYLOAD_MAGIC, PAYLOAD_VERSION,
+                                len(header_block)) +
+            header_block + b'{"a": 1, "b": "test", "c": []}')
+
+    def test_parse_data(self):
+        # binary content survives the round trip
+        content = b"%PDF-1.4\n\xe2\xe3\xcf\xd3\x00\xff"
+        response = CachedHTTPResponse(
+            status=200, data=content,
+            headers={"Content-Type": "application/pdf"})
+        cached = self.client._parse_data(
+            self.client._format_data(response))["response"]
+        self.assertEqual(cached.status, 200)
+        self.assertIsInstance(cached.body, memoryview)
+        self.assertEqual(cached.body, content)
+        self.assertEqual(cached.data, content)
+        self.assertEqual(cached.read(), content)
+        self.assertEqual(cached.getheader("content-type"), "application/pdf")
+
+        empty = CachedHTTPResponse(status=204, data=None, headers=None)
+        cached = self.client._parse_data(
+            self.client._format_data(empty))["response"]
+        self.assertEqual(cached.data, b"")
+        self.assertEqual(cached.headers, {})
+
+        # JSON payloads written by earlier versions
+        cached = self.client._parse_data(
+            '{"status": 200, "headers": {"Content-Type": "text/plain"}, '
+            '"data": "a"}')["response"]
+        self.assertEqual(cached.data, "a")
+        self.assertEqual(cached.getheader("Content-type"), "text/plain")
+        cached = self.client._parse_data(
+            b'{"status": 200, "headers": {}, "data": "a"}')["response"]
+        self.assertEqual(cached.data, "a")
+
+        data = self.client._format_data(response)
+        data = data[:4] + bytes([PAYLOAD_VERSION + 1]) + data[5:]
+        self.assertRaises(ValueError, self.client._parse_data, data)
+
+    def test_parse_stream(self):
+        content = b"x" * 1000
+        response = CachedHTTPResponse(
+            status=200, data=content, headers={"Content-Type": "text/plain"})
+        stream = BytesIO(self.client._format_data(response))
+        cached = self.client._parse_stream(stream)["response"]
+        self.assertEqual(cached.status, 200)
+        self.assertEqual(cached.getheader("content-type"), "text/plain")
+        self.assertEqual(cached.read(10), b"x" * 10)
+        self.assertEqual(list(cached.stream(400)),
+                         [b"x" * 400, b"x" * 400, b"x" * 190])
+        self.assertTrue(stream.closed)
+
+        cached = self.client._parse_stream(BytesIO(
+            self.client._format_data(response)))["response"]
+        self.assertEqual(cached.data, content)
+        self.assertEqual(cached.body, content)
+
+        cached = self.client._parse_stream(BytesIO(
+            b'{"status": 200, "headers": {}, "data": "a"}'))["response"]
+        self.assertEqual(cached.data, "a")
+
+    @patch('gcs_clients.GCSBucketClient.get_stream')
+    def test_getCacheStream(self, mock_get_stream):
+        response = CachedHTTPResponse(status=200, data=b"a", headers={})
+        mock_get_stream.return_value = BytesIO(
+            self.client._format_data(response))
+        cached = self.client.getCacheStream("abc", "/api/v1/test")
+        mock_get_stream.assert_called_once_with("abc/api/v1/test", expire=0)
+        self.assertEqual(cached["response"].read(), b"a")
+        mock_get_stream.return_value = None
+        self.assertEqual(
+            self.client.getCacheStream("abc", "/api/v1/test"), None)
@@ -0,0 +1,33 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+from unittest import TestCase
+from gcs_clients.sweep import main
+from mock import patch
+
+
+class TestSweep(TestCase):
+    @patch('gcs_clients.RestclientGCSClient.sweep_expired',
+           return_value={"deleted": 1})
+    def test_sweep(self, mock_sweep_expired):
+        with patch("sys.stdout"):
+            self.assertEqual(main(["--expire", "60", "--service", "abc"]),
+                             {"deleted": 1})
+        mock_sweep_expired.assert_called_once_with(60, service="abc",
+                                                   page_size=1000)
+
+    @patch('gcs_clients.RestclientGCSClient.invalidate_prefix',
+           return_value={"deleted": 1})
+    def test_invalidate(self, mock_invalidate_prefix):
+        with patch("sys.stdout"):
+            main(["--service", "abc", "--invalidate", "/api/v1/person/",
+                  "--page-size", "100"])
+        mock_invalidate_prefix.assert_called_once_with(
+            "abc", "/api/v1/person/", page_size=100)
+
+    def test_arguments(self):
+        with patch("sys.stderr"):
+            for args in ([], ["--invalidate", "/api/v1/"],
+                         ["--expire", "0"],
+                         ["--expire", "60", "--invalidate", "/api/v1/"]):
+                self.assertRaises(SystemExit, main, args)
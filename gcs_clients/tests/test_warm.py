@@ -0,0 +1,195 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+from commonconf import override_settings
+from gcs_clients.benchmark import BenchmarkGCSClient
+from gcs_clients.restclient import CachedHTTPResponse
+from gcs_clients.tests.fake_gcs import FakeGCSServer
+from gcs_clients.warm import CacheWarmer, Checkpoint, RateLimiter, main
+from mock import patch
+
+
+def fetch(service, url):
+    if url.startswith("/error"):
+        raise ValueError(url)
+    if url.startswith("/missing"):
+        return None
+    return CachedHTTPResponse(status=200, data=url.encode("utf-8"),
+                              headers={"Content-Type": "text/plain"})
+
+
+class TestRateLimiter(TestCase):
+    def test_wait(self):
+        limiter = RateLimiter(rate=100)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+        start = time.monotonic()
+        RateLimiter().wait()
+        self.assertLess(time.monotonic() - start, 0.01)
+
+
+class TestCheckpoint(TestCase):
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, "checkpoint")
+            checkpoint = Checkpoint(path)
+            checkpoint.add("a")
+            checkpoint.add("b")
+            checkpoint.close()
+            checkpoint = Checkpoint(path)
+            self.assertIn("a", checkpoint)
+            self.assertNotIn("c", checkpoint)
+            self.assertEqual(len(checkpoint), 2)
+        self.assertNotIn("a", Checkpoint())
+
+
+class TestCacheWarmer(TestCase):
+    def setUp(self):
+        self.server = FakeGCSServer().start()
+        self.addCleanup(self.server.stop)
+        self.client = BenchmarkGCSClient(self.server.url)
+
+    def test_warm(self):
+        items = [("abc", "/api/v1/{}".format(n)) for n in range(10)] + [
+            ("abc", "/missing"), ("abc", "/error")]
+        progress = []
+        counts = CacheWarmer(self.client, workers=2,
+                             progress=progress.append).warm(items, fetch)
+        self.assertEqual(counts, {"written": 10, "skipped": 1, "failed": 1,
+                                  "resumed": 0})
+        self.assertEqual(len(progress), 11)
+
+        # Warmed entries match those written by updateCache
+        metadata, content = self.server.objects["abc/api/v1/3"]
+        self.assertEqual(content, self.client._format_data(
+            fetch("abc", "/api/v1/3")))
+        self.assertIn("customTime", metadata)
+        self.client.updateCache("abc", "/api/v1/3", fetch("abc", "/api/v1/3"))
+        self.assertEqual(self.server.objects["abc/api/v1/3"][1], content)
+        self.assertEqual(self.client.getCache("abc", "/api/v1/3")[
+            "response"].data, b"/api/v1/3")
+
+    @override_settings(RESTCLIENTS_GCS_HASHED_KEYS=True)
+    def test_warm_hashed(self):
+        counts = CacheWarmer(self.client).warm([("abc", "/api/v1?b=2&a=1")],
+                                               fetch)
+        self.assertEqual(counts["written"], 1)
+        self.assertIn(self.client._create_key("abc", "/api/v1?a=1&b=2"),
+                      self.server.objects)
+
+    def test_warm_not_cached(self):
+        with patch.object(self.client, "get_cache_expiration_time",
+                          return_value=None):
+            counts = CacheWarmer(self.client).warm([("abc", "/api/v1")],
+                                                   fetch)
+        self.assertEqual(counts["skipped"], 1)
+        self.assertEqual(self.server.objects, {})
+
+    def test_warm_resume(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, "checkpoint")
+            items = [("abc", "/api/v1/1"), ("abc", "/error")]
+            counts = CacheWarmer(self.client, checkpoint=path).warm(items,
+                                                                    fetch)
+            self.assertEqual(counts["failed"], 1)
+            del self.server.objects["abc/api/v1/1"]
+
+            # Completed items are skipped and failed items retried
+            with patch("gcs_clients.tests.test_warm.fetch",
+                       side_effect=fetch) as mock_fetch:
+                counts = CacheWarmer(self.client, checkpoint=path).warm(
+                    items, mock_fetch)
+            self.assertEqual(counts, {"written": 0, "skipped": 0,
+                                      "failed": 1, "resumed": 1})
+            mock_fetch.assert_called_once_with("abc", "/error")
+            self.assertNotIn("abc/api/v1/1", self.server.objects)
+
+    def test_warm_disk_cache(self):
+        with tempfile.TemporaryDirectory() as path:
+            with override_settings(GCS_DISK_CACHE_DIR=path):
+                client = BenchmarkGCSClient(self.server.url)
+                CacheWarmer(client).warm([("abc", "/api/v1")], fetch)
+                self.assertIsNotNone(
+                    client.client.disk_cache.get("abc/api/v1"))
+
+    def _put(self, name, age=0):
+        custom_time = datetime.utcnow() - timedelta(seconds=age)
+        self.server.put("benchmark", name, fetch("abc", name).data, {
+            "customTime": custom_time.isoformat() + "Z"})
+
+    def test_copy_prefix(self):
+        self._put("old/abc/api/v1/1")
+        self._put("old/abc/api/v1/2?a=1", age=120)
+        self._put("old/def/api/v1/3")
+        with patch.dict(os.environ, {"GCS_BASE_PATH": "new"}), \
+                override_settings(RESTCLIENTS_GCS_DEFAULT_EXPIRY=60):
+            counts = CacheWarmer(self.client).copy_prefix(
+                source_base_path="old", service="abc")
+            self.assertEqual(counts, {"written": 1, "skipped": 1,
+                                      "failed": 0, "resumed": 0})
+            self.assertEqual(self.server.objects["new/abc/api/v1/1"][1],
+                             b"old/abc/api/v1/1")
+            self.assertEqual(
+                self.server.objects["new/abc/api/v1/1"][0]["customTime"],
+                self.server.objects["old/abc/api/v1/1"][0]["customTime"])
+
+            # Copy every service, to hashed keys
+            with override_settings(RESTCLIENTS_GCS_HASHED_KEYS=True,
+                                   RESTCLIENTS_GCS_DEFAULT_EXPIRY=60):
+                counts = CacheWarmer(self.client).copy_prefix(
+                    source_base_path="old")
+                self.assertEqual(counts["written"], 2)
+                for service, url in (("abc", "/api/v1/1"),
+                                     ("def", "/api/v1/3")):
+                    self.assertIn(self.client._create_key(
+                        service, url, base_path="new"), self.server.objects)
+
+    @override_settings(RESTCLIENTS_GCS_HASHED_KEYS=True)
+    def test_copy_prefix_unhashed(self):
+        # Copying within a base path moves legacy keys to hashed keys
+        self._put("abc/api/v1/1")
+        self._put(self.client._create_key("abc", "/api/v1/2"))
+        counts = CacheWarmer(self.client).copy_prefix()
+        self.assertEqual(counts, {"written": 1, "skipped": 1, "failed": 0,
+                                  "resumed": 0})
+        self.assertIn(self.client._create_key("abc", "/api/v1/1"),
+                      self.server.objects)
+
+
+class TestWarmMain(TestCase):
+    @patch("gcs_clients.warm.CacheWarmer.warm", return_value={})
+    def test_urls(self, mock_warm):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+            f.write("# comment\nabc /api/v1/1\n\nabc /api/v1/2?a=1\n")
+            f.flush()
+            with patch("sys.stdout"):
+                self.assertEqual(main([
+                    f.name, "--fetch", "gcs_clients.tests.test_warm:fetch"]),
+                    {})
+            items, fn = mock_warm.call_args[0]
+            self.assertEqual(list(items), [("abc", "/api/v1/1"),
+                                           ("abc", "/api/v1/2?a=1")])
+            self.assertIs(fn, fetch)
+
+    @patch("gcs_clients.warm.CacheWarmer.copy_prefix", return_value={})
+    def test_copy(self, mock_copy_prefix):
+        with patch("sys.stdout"):
+            main(["--copy-from-base-path", "old", "--service", "abc",
+                  "--rate", "10"])
+        mock_copy_prefix.assert_called_once_with(
+            source_base_path="old", source_bucket=None, service="abc")
+
+    def test_arguments(self):
+        with patch("sys.stderr"):
+            for args in ([], ["urls.txt"], ["--fetch", "a:b"],
+                         ["urls.txt", "--fetch", "a:b",
+                          "--copy-from-base-path", "old"]):
+                self.assertRaises(SystemExit, main, args)
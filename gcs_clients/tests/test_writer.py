@@ -0,0 +1,68 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+from threading import Event, Lock
+from unittest import TestCase
+from gcs_clients.writer import WriteBehindQueue
+from mock import patch
+
+
+class TestWriteBehindQueue(TestCase):
+    def setUp(self):
+        self.writes = []
+        self.started = Event()
+        self.finish = Event()
+        self.lock = Lock()
+
+    def write(self, key, content, expire):
+        self.started.set()
+        self.finish.wait(5)
+        with self.lock:
+            self.writes.append((key, content, expire))
+
+    def test_put_flush(self):
+        queue = WriteBehindQueue(self.write, workers=2)
+        self.assertTrue(queue.put("a", "1", expire=60))
+        self.assertTrue(queue.put("b", "2"))
+        self.finish.set()
+        self.assertTrue(queue.flush(timeout=5))
+        self.assertEqual(sorted(self.writes), [("a", "1", 60), ("b", "2", 0)])
+        self.assertEqual(len(queue), 0)
+        self.assertLessEqual(len(queue._threads), 2)
+
+    def test_coalesce(self):
+        queue = WriteBehindQueue(self.write, workers=2)
+        queue.put("a", "1")
+        self.started.wait(5)
+        # "a" is being written, later writes are queued and coalesced
+        queue.put("a", "2")
+        queue.put("a", "3")
+        self.assertEqual(len(queue), 1)
+        self.assertFalse(queue.flush(timeout=0.01))
+        self.finish.set()
+        self.assertTrue(queue.flush(timeout=5))
+        self.assertEqual(self.writes, [("a", "1", 0), ("a", "3", 0)])
+
+    def test_drop(self):
+        queue = WriteBehindQueue(self.write, max_size=1, workers=1)
+        queue.put("a", "1")
+        self.started.wait(5)
+        self.assertTrue(queue.put("b", "1"))
+        self.assertTrue(queue.put("b", "2"))
+        with patch("logging.warning") as mock_warning:
+            self.assertFalse(queue.put("c", "1"))
+        self.assertTrue(mock_warning.called)
+        self.assertEqual(queue.dropped, 1)
+        self.finish.set()
+        queue.flush(timeout=5)
+        self.assertEqual(self.writes, [("a", "1", 0), ("b", "2", 0)])
+
+    def test_error(self):
+        def fail(key, content, expire):
+            raise ValueError("fail")
+
+        queue = WriteBehindQueue(fail)
+        with patch("logging.error") as mock_error:
+            queue.put("a", "1")
+            self.assertTrue(queue.flush(timeout=5))
+        mock_error.assert_called_once_with("gcs write-behind a: fail")
@@ -0,0 +1,340 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Populate the cache ahead of requests, with upstream responses for a list of
+urls, or by copying cached responses from another bucket or base path:
+
+    python -m gcs_clients.warm [--conf FILE] --fetch MODULE:FUNCTION URLS
+    python -m gcs_clients.warm [--conf FILE] --copy-from-base-path PATH
+        [--copy-from-bucket NAME] [--service NAME]
+
+URLS is a file of "service url" lines, or - for stdin, and fetch(service,
+url) returns a response to cache.  Settings are read from the [GCS]
+section of the --conf file, or else from Django settings.  With
+--checkpoint FILE, an interrupted run resumes where it stopped.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from commonconf.backends import use_configparser_backend
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from gcs_clients.base import is_fresh
+from gcs_clients.restclient import RestclientGCSClient, split_shard
+from importlib import import_module
+from threading import Lock
+
+
+class RateLimiter():
+    """
+    Spaces calls from any number of threads at least 1 / rate seconds apart
+    """
+
+    def __init__(self, rate=0):
+        """
+        :param rate: Maximum calls per second, or 0 for no limit (the
+            default)
+        :type rate: float (optional)
+        """
+        self.rate = rate
+        self._next = 0
+        self._lock = Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + 1 / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class Checkpoint():
+    """
+    A set of completed items, appended to a file so that an interrupted
+    run can skip them when it's resumed
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: File recording completed items, defaults to None for
+            no file
+        :type path: str (optional)
+        """
+        self.path = path
+        self._done = set()
+        self._file = None
+        self._lock = Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._done = {line.rstrip("\n") for line in f}
+
+    def __contains__(self, item):
+        return item in self._done
+
+    def __len__(self):
+        return len(self._done)
+
+    def add(self, item):
+        with self._lock:
+            self._done.add(item)
+            if self.path:
+                if self._file is None:
+                    self._file = open(self.path, "a")
+                self._file.write(item + "\n")
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class CacheWarmer():
+    """
+    Concurrently populates the cache of a RestclientGCSClient, writing the
+    same keys and payloads as updateCache, and loading any disk or memory
+    cache of the client.
+    """
+
+    def __init__(self, client, workers=8, rate=0, checkpoint=None,
+                 progress=None):
+        """
+        :param client: Cache client to populate
+        :type client: gcs_clients.RestclientGCSClient
+        :param workers: Number of threads, defaults to 8
+        :type workers: int (optional)
+        :param rate: Maximum items per second, or 0 for no limit (the
+            default)
+        :type rate: float (optional)
+        :param checkpoint: File recording completed items, which are
+            skipped by later runs, defaults to None
+        :type checkpoint: str (optional)
+        :param progress: Called with a dict of counts as each item completes,
+            defaults to None
+        :type progress: callable (optional)
+        """
+        self.client = client
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate)
+        self.checkpoint = Checkpoint(checkpoint)
+        self.progress = progress
+
+    def warm(self, items, fetch):
+        """
+        Cache the response returned by fetch(service, url) for each
+        (service, url) pair that get_cache_expiration_time allows.  Returns
+        a dict of the number of items written, skipped, failed, and resumed
+        from the checkpoint.
+
+        :param items: (service, url) pairs
+        :type items: iterable
+        :param fetch: Called as fetch(service, url), returning a response,
+            or None to skip the url
+        :type fetch: callable
+        """
+        client = self.client
+
+        def warm(service, url):
+            if client.get_cache_expiration_time(service, url) is None:
+                return False
+            response = fetch(service, url)
+            if response is None:
+                return False
+            expire = client._get_update_expiration_time(
+                service, url, response)
+            if expire is None:
+                return False
+            key = client._create_key(service, url,
+                                     base_path=client.get_base_path())
+            client._guarded(client.client.set, key,
+                            client._format_data(response), expire=expire)
+            self._load_local(key, expire)
+            return True
+
+        return self._run((json.dumps([service, url]), warm, (service, url))
+                         for service, url in items)
+
+    def copy_prefix(self, source_base_path=None, source_bucket=None,
+                    service=None):
+        """
+        Copy the cached responses under another base path, or a service's,
+        from another bucket or the client's bucket.  Each response is copied
+        within GCS to the key the client creates for its url, keeping its
+        custom time, unless get_cache_expiration_time skips the url or the
+        response has expired.  Returns a dict of counts, as for warm.
+
+        :param source_base_path: Base path of the responses to copy,
+            defaults to the client's base path
+        :type source_base_path: str (optional)
+        :param source_bucket: Name of the bucket to copy from, defaults to
+            the client's bucket
+        :type source_bucket: str (optional)
+        :param service: Service of the responses to copy, defaults to every
+            service
+        :type service: str (optional)
+        """
+        client = self.client
+        bucket_client = client.client
+        if source_bucket and source_bucket != bucket_client.bucket_name:
+            source = bucket_client.client.bucket(source_bucket)
+        else:
+            source = bucket_client.bucket
+        if source_base_path is None:
+            source_base_path = client.get_base_path()
+        base_prefix = source_base_path.strip("/")
+        base_prefix = base_prefix + "/" if base_prefix else base_prefix
+        prefix = base_prefix + (service + "/" if service else "")
+        base_path = client.get_base_path()
+
+        def copy(blob):
+            service, _, path = blob.name[len(base_prefix):].partition("/")
+            url = "/" + (split_shard(path) or path)
+            expire = client.get_cache_expiration_time(service, url)
+            if expire is None or blob.custom_time is None or \
+                    not is_fresh(blob.custom_time, expire):
+                return False
+            key = client._create_key(service, url, base_path=base_path)
+            if key == blob.name and source is bucket_client.bucket:
+                return False
+            client._guarded(source.copy_blob, blob, bucket_client.bucket,
+                            key, timeout=bucket_client.timeout)
+            self._load_local(key, expire)
+            return True
+
+        blobs = bucket_client.client.list_blobs(
+            source, prefix=prefix, timeout=bucket_client.timeout,
+            fields="items(name,generation,customTime),nextPageToken")
+        return self._run((blob.name, copy, (blob,)) for blob in blobs)
+
+    def _load_local(self, key, expire):
+        """
+        Download a written key into the client's local caches
+        """
+        bucket_client = self.client.client
+        if bucket_client.disk_cache is not None or \
+                bucket_client.memory_cache is not None:
+            bucket_client.get(key, expire=expire)
+
+    def _call(self, item, fn, args):
+        self.rate_limiter.wait()
+        try:
+            return item, fn(*args), None
+        except Exception as ex:
+            logging.error("gcs warm {}: {}".format(item, ex))
+            return item, None, ex
+
+    def _run(self, tasks):
+        counts = dict.fromkeys(("written", "skipped", "failed", "resumed"), 0)
+
+        def finish(futures):
+            for future in futures:
+                item, written, ex = future.result()
+                if ex is not None:
+                    counts["failed"] += 1
+                    continue
+                counts["written" if written else "skipped"] += 1
+                self.checkpoint.add(item)
+                if self.progress is not None:
+                    self.progress(dict(counts))
+
+        pending = set()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for item, fn, args in tasks:
+                    if item in self.checkpoint:
+                        counts["resumed"] += 1
+                        continue
+                    if len(pending) >= self.workers * 2:
+                        done, pending = wait(pending,
+                                             return_when=FIRST_COMPLETED)
+                        finish(done)
+                    pending.add(executor.submit(self._call, item, fn, args))
+                finish(wait(pending).done)
+        finally:
+            self.checkpoint.close()
+        return counts
+
+
+def _read_urls(path):
+    f = sys.stdin if path == "-" else open(path)
+    try:
+        for line in f:
+            if line.strip() and not line.startswith("#"):
+                service, url = line.split(None, 1)
+                yield service, url.strip()
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _import(path):
+    module, _, name = path.partition(":")
+    return getattr(import_module(module), name)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("urls", nargs="?",
+                        help='file of "service url" lines, or - for stdin')
+    parser.add_argument("--conf", help="settings file for the cache client")
+    parser.add_argument("--fetch", metavar="MODULE:FUNCTION",
+                        help="function called as fetch(service, url), "
+                             "returning a response to cache")
+    parser.add_argument("--copy-from-base-path",
+                        help="base path of cached responses to copy")
+    parser.add_argument("--copy-from-bucket",
+                        help="bucket of cached responses to copy, defaults "
+                             "to GCS_BUCKET_NAME")
+    parser.add_argument("--service", help="service of responses to copy")
+    parser.add_argument("--client", metavar="MODULE:CLASS",
+                        help="cache client class, defaults to "
+                             "RestclientGCSClient")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="number of threads")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="maximum items per second, 0 for no limit")
+    parser.add_argument("--checkpoint",
+                        help="file recording completed items, for resuming")
+    args = parser.parse_args(args)
+    copy = args.copy_from_base_path is not None or args.copy_from_bucket
+    if copy == bool(args.urls or args.fetch):
+        parser.error("give either URLS and --fetch, or --copy-from-*")
+    if not copy and not (args.urls and args.fetch):
+        parser.error("URLS requires --fetch")
+    if args.conf:
+        use_configparser_backend(args.conf, "GCS")
+
+    last = [time.monotonic()]
+
+    def progress(counts):
+        if time.monotonic() - last[0] >= 5:
+            last[0] = time.monotonic()
+            print(json.dumps(counts, sort_keys=True), file=sys.stderr)
+
+    client_class = _import(args.client) if args.client else \
+        RestclientGCSClient
+    warmer = CacheWarmer(client_class(), workers=args.workers,
+                         rate=args.rate, checkpoint=args.checkpoint,
+                         progress=progress)
+    if copy:
+        counts = warmer.copy_prefix(
+            source_base_path=args.copy_from_base_path,
+            source_bucket=args.copy_from_bucket, service=args.service)
+    else:
+        counts = warmer.warm(_read_urls(args.urls), _import(args.fetch))
+    print(json.dumps(counts, sort_keys=True))
+    return counts
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# Copyright 2021 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+import logging
+import time
+from collections import OrderedDict
+from threading import Condition, Thread
+
+
+class WriteBehindQueue():
+    """
+    A bounded queue of cache writes, drained by background worker threads.
+    A write to a key that's already queued replaces the queued content, and
+    writes to the same key are never run concurrently.
+    """
+
+    def __init__(self, write, max_size=1000, workers=2, block=False):
+        """
+        :param write: Called as write(key, content, expire) by the workers
+        :type write: callable
+        :param max_size: Maximum number of queued writes, defaults to 1000
+        :type max_size: int (optional)
+        :param workers: Number of worker threads, defaults to 2
+        :type workers: int (optional)
+        :param block: Whether put waits for space in a full queue, rather
+            than dropping the write, defaults to False
+        :type block: bool (optional)
+        """
+        self.write = write
+        self.max_size = max_size
+        self.workers = workers
+        self.block = block
+        self.dropped = 0
+        self._pending = OrderedDict()
+        self._writing = set()
+        self._threads = []
+        self._cond = Condition()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, key, content, expire=0):
+        """
+        Queue a write, returning False if it was dropped
+        """
+        with self._cond:
+            if key not in self._pending:
+                while len(self._pending) >= self.max_size:
+                    if not self.block:
+                        self.dropped += 1
+                        logging.warning(
+                            "gcs write-behind full: {}".format(key))
+                        return False
+                    self._cond.wait()
+            self._pending[key] = (content, expire)
+            self._cond.notify_all()
+            if len(self._threads) < self.workers:
+                thread = Thread(target=self._run, daemon=True)
+                self._threads.append(thread)
+                thread.start()
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Wait until all queued writes have completed, returning False if the
+        timeout expired first
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._writing:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                self._cond.wait(remaining)
+        return True
+
+    def _next(self):
+        for key in self._pending:
+            if key not in self._writing:
+                return key
+
+    def _run(self):
+        while True:
+            with self._cond:
+                key = self._next()
+                while key is None:
+                    self._cond.wait()
+                    key = self._next()
+                content, expire = self._pending.pop(key)
+                self._writing.add(key)
+                self._cond.notify_all()
+            try:
+                self.write(key, content, expire)
+            except Exception as ex:
+                logging.error("gcs write-behind {}: {}".format(key, ex))
+            finally:
+                with self._cond:
+                    self._writing.discard(key)
+                    self._cond.notify_all()
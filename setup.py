@@ -23,10 +23,15 @@ setup(
     include_package_data=True,
     install_requires=[
         'commonconf~=1.0',
-        'google-cloud-storage>=1.37.1,<2.0',
+        'google-cloud-storage>=1.42.0,<2.0',
         'google-api-core>=1.26.3,<2.0',
         'mock',
     ],
+    extras_require={
+        'async': ['aiohttp'],
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+    },
     license='Apache License, Version 2.0',
     description=('Google Cloud Storage (GCS) Clients'),
     long_description=README,